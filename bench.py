@@ -0,0 +1,361 @@
+from darpins import *
+try:
+    import levenshtein as Clevenshtein
+except:
+    pass
+from argparse import ArgumentParser
+from divergence import DivergenceLibrary, levenshtein_many, distance_many, get_levenshtein_backend, \
+                       get_mask_indexes
+from design import DesignEngine, get_parser, get_design_document
+from storage import SqliteCollection
+from uidcache import UidCache
+from writer import DesignWriter
+import sampler
+import contextlib
+import datetime
+import json
+import platform
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+# benchmarks of the divergence kernels, the design loop and the result
+# parsers on synthetic data: libraries of DEFAULT_SEQUENCE variants mutated
+# within masks of <width> positions of the internal repeats, stored in an
+# in-process (sqlite :memory:) or file-backed (sqlite) stand-in for MongoDB
+# (see storage.py), and
+# scores/sites files of <n> designs. Everything is derived from --seed, so two
+# runs (or two versions of the code) time the same work. Results are saved as
+# JSON in datadir/benchmarks; 'compare' reports the ratios between two files.
+#
+#   python bench.py run [--quick] [--store sqlite]
+#   python bench.py compare old.json new.json
+BENCH_VERSION = 1
+NRES = 4
+NCANDIDATES = 1000
+NTARGETS = 2
+NTOPS = 10
+SCORES = ('score','rmsd','energy')
+# DEFAULT_SEQUENCE positions outside the N- and C-caps
+REPEATS = (33,len(DEFAULT_SEQUENCE)-28)
+C_EXTENSION = 'levenshtein C extension not built (see src/install.sh)'
+
+def parse_args():
+    parser = ArgumentParser()
+
+    parser.add_argument("command", choices=['run','compare'],
+                        help="run the benchmarks, or compare two result files")
+    parser.add_argument("files", nargs='*', help="Result files to compare (old, new)")
+    parser.add_argument("-o", "--output", dest="output", default='',
+                        help="Result file (default: datadir/benchmarks/bench_<time>.json)")
+    parser.add_argument("--only", nargs='+', dest="only", default=['kernels','divergence','design','parsers'],
+                        help="Only run these groups of benchmarks")
+    parser.add_argument("--sizes", nargs='+', dest="sizes", default=[1000,10000,100000], type=int,
+                        help="Library sizes (designs)")
+    parser.add_argument("--widths", nargs='+', dest="widths", default=[20,40], type=int,
+                        help="Mask widths (variable positions)")
+    parser.add_argument("--thresholds", nargs='+', dest="thresholds", default=[2,4], type=int,
+                        help="Divergence thresholds")
+    parser.add_argument("--parse_sizes", nargs='+', dest="parse_sizes", default=[1000,10000], type=int,
+                        help="Designs in the synthetic scores and sites files")
+    parser.add_argument("--max_python_size", dest="max_python_size", default=10000, type=int,
+                        help="Skip the per-design python paths (--div_python) on larger libraries")
+    parser.add_argument("--ndesign", dest="ndesign", default=2000, type=int,
+                        help="Designs generated by the end-to-end benchmarks")
+    parser.add_argument("--store", dest="store", default='memory', choices=['memory','sqlite'],
+                        help="MongoDB stand-in: in-process or file-backed sqlite")
+    parser.add_argument("--repeat", dest="repeat", default=3, type=int,
+                        help="Reports the best of <n> runs")
+    parser.add_argument("--quick", dest="quick", default=False, action="store_true",
+                        help="One small size, width and threshold")
+    parser.add_argument("-s", "--seed", dest="seed", default=0, type=int,
+                        help="Seed of the synthetic data")
+    parser.add_argument("--regression", dest="regression", default=1.2, type=float,
+                        help="compare: flags benchmarks slower by more than <x>")
+
+    return parser.parse_args()
+
+def best_time(fun,repeat):
+    best = None
+    for k in range(repeat):
+        t0 = time.perf_counter()
+        fun()
+        t = time.perf_counter() - t0
+        best = t if best is None else min(best,t)
+    return best
+
+def peak_memory(fun):
+    # peak python allocations during fun, in bytes
+    tracemalloc.start()
+    try:
+        fun()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def has_c_extension():
+    return get_levenshtein_backend() == 'c'
+
+def get_revision():
+    try:
+        return subprocess.check_output(['git','rev-parse','HEAD'],cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError,subprocess.CalledProcessError):
+        return None
+
+def get_mask(width,rng,seq=DEFAULT_SEQUENCE):
+    positions = rng.choice(np.arange(*REPEATS),width,replace=False)
+    return [ 1 if i in positions else 0 for i in range(len(seq)) ]
+
+def build_library(mask,size,rng,seq=DEFAULT_SEQUENCE):
+    # (full sequences as uint8 rows, mutmasks, uids) of <size> distinct variants
+    plan = sampler.MutationPlan(seq,mask,'',False,None)
+    batch, mutmasks = plan.sample(NRES,size,rng)
+    keep = sampler.unique_rows(batch)
+    return batch[keep], mutmasks[keep], sampler.hash_rows(batch[keep])
+
+def get_store(kind,folder):
+    # a new, empty collection every time
+    return SqliteCollection(':memory:' if kind == 'memory' else os.path.join(folder,'bench.db'),'designs')
+
+def fill_store(designs,parent,mask,batch,mutmasks,uids):
+    args = get_parser().parse_args([])
+    docs = [ { 'uid': parent, 'shortuid': parent[0:N_SHORTUID_CHARS], 'seq': DEFAULT_SEQUENCE,
+               'mutmask': [ 0 for c in DEFAULT_SEQUENCE ], 'varmask': [ 0 for c in DEFAULT_SEQUENCE ],
+               'parent': None, 'created': datetime.datetime.utcnow(), 'type': 'template' } ]
+    for row, mutmask, uid in zip(batch,mutmasks,uids):
+        docs.append(get_design_document(uid,row.tobytes().decode('ascii'),mutmask.tolist(),
+                                        { 'merged': mask },parent,'random',args))
+    ensure_design_indexes(designs)
+    for k in range(0,len(docs),10000):
+        designs.insert_many(docs[k:k+10000],ordered=False)
+
+class Bench:
+
+    def __init__(self,args,folder):
+        self.args = args
+        self.folder = folder
+        self.rng = np.random.default_rng(args.seed)
+        self.results = []
+
+    def add(self,group,name,params,**res):
+        entry = { 'group': group, 'name': name, 'params': params }
+        entry.update(res)
+        self.results.append(entry)
+        sys.stderr.write("%-10s %-26s %s %s\n" % (group,name,json.dumps(params),
+                         ' '.join([ '%s=%.4g' % (k,v) if isinstance(v,float) else '%s=%s' % (k,v)
+                                    for k, v in res.items() ])))
+
+    def skip(self,group,name,params,reason):
+        self.add(group,name,params,skipped=reason)
+
+    def time(self,group,name,params,fun,n=1,repeat=None):
+        # seconds of the best run, and per item when a run handles n items
+        t = best_time(fun,repeat if repeat else self.args.repeat)
+        self.add(group,name,params,seconds=t,per_item=t/n,items_per_second=n/t if t > 0 else 0.0)
+
+    def configs(self):
+        # (size, width, library rows, mutmasks, uids, mask) of every setting
+        for width in self.args.widths:
+            mask = get_mask(width,self.rng)
+            batch, mutmasks, uids = build_library(mask,max(self.args.sizes),self.rng)
+            for size in self.args.sizes:
+                yield size, width, batch[:size], mutmasks[:size], uids[:size], mask
+
+    def run_kernels(self,size,width,batch,mask):
+        indexes = get_mask_indexes(mask)
+        lib = np.ascontiguousarray(batch[:,indexes])
+        cands = build_library(mask,NCANDIDATES,self.rng)[0][:,indexes]
+        a = cands[0]
+        sa = a.tobytes().decode('ascii')
+        p = { 'size': size, 'width': width }
+        self.time('kernels','hamming_numpy',p,lambda: distance_many(a,lib),n=size)
+        for t in self.args.thresholds:
+            pt = dict(p,threshold=t)
+            library = DivergenceLibrary([ 1 for i in range(width) ],capacity=1)
+            library.set_base(lib,np.zeros((len(lib),28),dtype=np.uint8))
+            self.time('kernels','divergent_rows',pt,lambda: library.divergent_rows(cands,t),n=len(cands))
+            self.time('kernels','levenshtein_numpy',pt,lambda: levenshtein_many(a,lib,t),n=size)
+            if not has_c_extension():
+                self.skip('kernels','levenshtein_c',pt,C_EXTENSION)
+                self.skip('kernels','multiple_ndiff_c',pt,C_EXTENSION)
+                continue
+            seqs = [ row.tobytes().decode('ascii') for row in lib ]
+            buffer = ''.join(seqs)
+            self.time('kernels','levenshtein_c',pt,lambda: [ Clevenshtein.levenshtein(sa,s) for s in seqs ],n=size)
+            self.time('kernels','multiple_ndiff_c',pt,
+                      lambda: Clevenshtein.multiple_ndiff(sa,buffer,width,t),n=size)
+
+    def get_engine(self,batch,mutmasks,uids,mask,writer=False):
+        # a fresh stand-in store holding the library, and an engine on it
+        folder = tempfile.mkdtemp(dir=self.folder)
+        designs = get_store(self.args.store,folder)
+        parent = hash(DEFAULT_SEQUENCE)
+        fill_store(designs,parent,mask,batch,mutmasks,uids)
+        return DesignEngine(designs,parent,DEFAULT_SEQUENCE,{ 'merged': mask },
+                            uid_cache=UidCache(designs,folder=folder),folder=folder,
+                            writer=DesignWriter(designs) if writer else None)
+
+    def get_design_args(self,options):
+        args = get_parser().parse_args(options)
+        args.parent = hash(DEFAULT_SEQUENCE)
+        return args
+
+    def run_divergence(self,size,width,batch,mutmasks,uids,mask):
+        engine = self.get_engine(batch,mutmasks,uids,mask)
+        cands = [ row.tobytes().decode('ascii') for row in build_library(mask,NCANDIDATES,self.rng)[0] ]
+        p = { 'size': size, 'width': width, 'store': self.args.store }
+        for t in self.args.thresholds:
+            pt = dict(p,threshold=t)
+            variants = [ ('is_divergent_full',[]), ('is_divergent_full_lev',['--lev_full','--lev_python']) ]
+            if size <= self.args.max_python_size:
+                variants.append(('is_divergent_numpy',['--div_python','--lev_python']))
+                if has_c_extension():
+                    variants.append(('is_divergent_c',['--div_python']))
+                else:
+                    self.skip('divergence','is_divergent_c',pt,C_EXTENSION)
+            else:
+                for name in ('is_divergent_numpy','is_divergent_c'):
+                    self.skip('divergence',name,pt,"library larger than --max_python_size")
+            for name, options in variants:
+                args = self.get_design_args(options + ['-l',str(t)])
+                engine.set_state(args)
+                # the first call loads the index, the python paths query every time
+                engine.is_divergent(cands[0],args)
+                n = 5 if args.div_python else 100
+                self.time('divergence',name,pt,lambda: [ engine.is_divergent(c,args) for c in cands[:n] ],n=n)
+
+    def run_design(self,size,width,batch,mutmasks,uids,mask):
+        p = { 'size': size, 'width': width, 'store': self.args.store, 'nres': NRES }
+        for t in self.args.thresholds:
+            pt = dict(p,threshold=t)
+            variants = [ ('design_batch',['--batch','1000'],self.args.ndesign),
+                         ('design_molecule',[],max(1,self.args.ndesign // 10)) ]
+            for name, options, n in variants:
+                # a fresh store every time: designs of one run would change the next
+                engine = self.get_engine(batch,mutmasks,uids,mask,writer=True)
+                args = self.get_design_args(options + ['-l',str(t),'-r',str(NRES),'-n',str(n),
+                                                       '-s',str(self.args.seed)])
+                # the index is loaded before timing, as in a long run
+                engine.set_state(args)
+                engine.sync_library(args)
+                t0 = time.perf_counter()
+                with open(os.devnull,'w') as devnull, contextlib.redirect_stdout(devnull):
+                    ndone = engine.design(args)
+                    engine.writer.flush()
+                seconds = time.perf_counter() - t0
+                counters = engine.metrics.counters
+                self.add('design',name,dict(pt,ndesign=n),seconds=seconds,designs_per_second=ndone/seconds,
+                         acceptance_rate=counters['accepted']/max(1,counters['scanned']))
+
+    def run_parsers(self,ndesign):
+        from scorestore import open_score_store
+        folder = tempfile.mkdtemp(dir=self.folder)
+        scoresfile = os.path.join(folder,'bench.scores')
+        sitesfile = os.path.join(folder,'bench.sites')
+        rng = np.random.default_rng(self.args.seed)
+        designs = [ '%012x' % v for v in rng.integers(0,1 << 48,ndesign) ]
+        residues = [ 'R%d' % i for i in range(1,200) ]
+        with open(scoresfile,'w') as out:
+            for d in designs:
+                for k in range(NTARGETS):
+                    for top in range(NTOPS):
+                        for s, v in zip(SCORES,rng.normal(size=len(SCORES))):
+                            out.write("%s\ttarget%d\t%d\t%s\t%.4f\n" % (d,k,top,s,v))
+        with open(sitesfile,'w') as out:
+            for d in designs:
+                for k in range(NTARGETS):
+                    for top in range(NTOPS):
+                        for mol in ('A','B'):
+                            ir = rng.choice(residues,12,replace=False)
+                            out.write("%s\ttarget%d\t%s\t%d\t%s\n" % (d,k,mol,top,','.join(ir)))
+        p = { 'designs': ndesign, 'scores_lines': ndesign*NTARGETS*NTOPS*len(SCORES),
+              'sites_lines': ndesign*NTARGETS*NTOPS*2 }
+
+        def build_store():
+            # columnar store from scratch, as on the first read of a file
+            for name in os.listdir(folder):
+                if name.startswith('bench.scores.'):
+                    path = os.path.join(folder,name)
+                    shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+            return open_score_store(scoresfile).view()
+
+        parsers = [ ('read_scores_from_file',lambda: read_scores_from_file(scoresfile)),
+                    ('open_score_store_cold',build_store),
+                    ('open_score_store',lambda: open_score_store(scoresfile).view()),
+                    ('read_sites_map_from_file',lambda: read_sites_map_from_file(sitesfile)) ]
+        for name, fun in parsers:
+            seconds = best_time(fun,self.args.repeat)
+            self.add('parsers',name,p,seconds=seconds,peak_bytes=peak_memory(fun))
+
+    def run(self):
+        only = self.args.only
+        for size, width, batch, mutmasks, uids, mask in self.configs():
+            if 'kernels' in only:
+                self.run_kernels(size,width,batch,mask)
+            if 'divergence' in only:
+                self.run_divergence(size,width,batch,mutmasks,uids,mask)
+            if 'design' in only:
+                self.run_design(size,width,batch,mutmasks,uids,mask)
+        if 'parsers' in only:
+            for ndesign in self.args.parse_sizes:
+                self.run_parsers(ndesign)
+        return self.results
+
+def get_environment(args):
+    return { 'version': BENCH_VERSION, 'time': datetime.datetime.utcnow().isoformat(),
+             'host': socket.gethostname(), 'python': platform.python_version(), 'numpy': np.__version__,
+             'revision': get_revision(), 'c_extension': has_c_extension(), 'store': args.store,
+             'seed': args.seed, 'repeat': args.repeat }
+
+def get_result_key(entry):
+    return (entry['group'],entry['name'],json.dumps(entry['params'],sort_keys=True))
+
+def compare_results(old,new,regression=1.2):
+    # (key, old seconds, new seconds, ratio, regressed) of the benchmarks run
+    # in both; regressed when new seconds > regression * old seconds
+    olds = { get_result_key(e): e for e in old['results'] if 'seconds' in e }
+    res = []
+    for e in new['results']:
+        key = get_result_key(e)
+        if 'seconds' not in e or key not in olds: continue
+        ratio = e['seconds'] / olds[key]['seconds'] if olds[key]['seconds'] > 0 else float('inf')
+        res.append((key,olds[key]['seconds'],e['seconds'],ratio,ratio > regression))
+    return res
+
+def main():
+    args = parse_args()
+    if args.command == 'compare':
+        if len(args.files) != 2:
+            sys.stderr.write("CRITICAL: compare needs an old and a new result file\n")
+            sys.exit(1)
+        old, new = [ json.load(open(f)) for f in args.files ]
+        nregressions = 0
+        for (group,name,params), t_old, t_new, ratio, regressed in compare_results(old,new,args.regression):
+            nregressions += 1 if regressed else 0
+            print("%-10s %-26s %-60s %10.4g %10.4g %6.2fx %s" % (group,name,params,t_old,t_new,ratio,
+                                                                  'REGRESSION' if regressed else ''))
+        sys.exit(1 if nregressions else 0)
+    if args.quick:
+        args.sizes, args.widths, args.thresholds, args.parse_sizes = [1000], [20], [2], [1000]
+        args.ndesign, args.repeat = 500, 1
+    folder = tempfile.mkdtemp(prefix='darpins_bench_')
+    try:
+        results = Bench(args,folder).run()
+    finally:
+        shutil.rmtree(folder)
+    if not args.output:
+        build_folder(os.path.join(datadir,'benchmarks'))
+        args.output = os.path.join(datadir,'benchmarks','bench_%s.json' % time.strftime('%Y%m%d-%H%M%S'))
+    data = get_environment(args)
+    data['results'] = results
+    with open(args.output,'w') as out:
+        json.dump(data,out,indent=1)
+    print("results written to %s" % args.output)
+
+if __name__ == '__main__':
+    main()
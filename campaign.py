@@ -0,0 +1,185 @@
+from darpins import *
+from argparse import ArgumentParser, Namespace
+from design import DesignEngine, TargetReached, get_parser, check_args, get_merged_mask
+from uidcache import UidCache
+from writer import DesignWriter, handle_sigterm
+from metrics import Metrics, PROMETHEUS_EXT
+import multiprocessing
+import collections
+import json
+
+# campaign of design jobs: the spec file has one JSON job per line, its fields
+# are the design.py options (by dest name, e.g. {"parent": "...", "mapfile":
+# "map.txt", "ndesign": 5000, "nres": 4, "lev_threshold": 3}). Jobs of the
+# same parent and merged mask form a group, run one after the other by one
+# DesignEngine, so they share the loaded index and divergence library; groups
+# are spread over a pool of worker processes.
+#
+# Jobs run by chunks of --checkpoint designs. Once the designs of a chunk are
+# written, "<job key>\t<designs done>" is appended to the progress file
+# (<spec>.progress), and a resumed campaign only runs what is left.
+#
+#   python campaign.py jobs.jsonl --workers 4 [--test]
+# options of the campaign, not of a job; div_python reads the designs back from
+# the database, which the buffered writer of a worker does not keep up to date
+CAMPAIGN_OPTIONS = ('test','workers','force_parent','flush_size','flush_interval','metrics',
+                    'metrics_interval','profile','div_python')
+
+worker = {}
+
+def parse_args():
+    parser = ArgumentParser()
+
+    parser.add_argument("spec", help="Job spec file, one JSON object of design.py options per line")
+    parser.add_argument("--progress", dest="progress", default='',
+                        help="Progress file (default: <spec>.progress)")
+    parser.add_argument("--workers", dest="workers", default=1, type=int,
+                        help="Runs <n> groups of jobs at the same time")
+    parser.add_argument("--checkpoint", dest="checkpoint", default=1000, type=int,
+                        help="Records the progress of a job every <n> designs")
+    parser.add_argument("--test", dest="test", default=False, action="store_true",
+                        help="Use test collections from MongoDB")
+    parser.add_argument("--flush_size", dest="flush_size", default=1000, type=int,
+                        help="Writes accepted designs to the database by groups of <n>")
+    parser.add_argument("--flush_interval", dest="flush_interval", default=10.0, type=float,
+                        help="Writes pending designs to the database at least every <n> seconds")
+    parser.add_argument("--metrics", dest="metrics", default='',
+                        help="Writes counters and timers of every worker to <file> (JSON lines, or <file>.<pid>.prom for .prom)")
+    parser.add_argument("--metrics_interval", dest="metrics_interval", default=10.0, type=float,
+                        help="Writes the metrics at most every <n> seconds")
+
+    return parser.parse_args()
+
+def read_jobs(file):
+    # (key, job) pairs; identical jobs are told apart by their occurrence
+    defaults = vars(get_parser().parse_args([]))
+    seen = collections.Counter()
+    jobs = []
+    for n, line in enumerate(open(file)):
+        if not line.strip() or line.startswith('#'): continue
+        job = json.loads(line)
+        unknown = [ k for k in job if k not in defaults ]
+        campaign = [ k for k in job if k in CAMPAIGN_OPTIONS ]
+        if unknown or campaign:
+            sys.stderr.write("CRITICAL: job on line %d: %s\n" % (n+1,
+                             "unknown fields %s" % ', '.join(unknown) if unknown else
+                             "%s cannot be set per job" % ', '.join(campaign)))
+            sys.exit(1)
+        key = hash(json.dumps(job,sort_keys=True))[0:N_SHORTUID_CHARS]
+        seen[key] += 1
+        args = Namespace(**dict(defaults,**job))
+        if not args.parent or not args.mapfile:
+            sys.stderr.write("CRITICAL: job on line %d needs a parent and a mapfile\n" % (n+1))
+            sys.exit(1)
+        jobs.append(('%s.%d' % (key,seen[key]),check_args(args)))
+    return jobs
+
+def read_progress(file):
+    progress = {}
+    if not is_log(file):
+        return progress
+    for line in read_locked_lines(file):
+        key, done = line.rstrip('\n').split('\t')
+        progress[key] = max(progress.get(key,0),int(done))
+    return progress
+
+def get_job_size(args):
+    return 1 if args.force_seq else (args.ndesign or 0)
+
+def get_chunk_seed(args,done):
+    # chunks of a seeded job must not sample the same candidates again
+    if args.seed is None or done == 0:
+        return args.seed
+    return '%s:%d' % (args.seed,done)
+
+def build_groups(designs,jobs,progress):
+    # jobs left to run, by (parent, merged mask)
+    parents = {}
+    groups = collections.OrderedDict()
+    for key, args in jobs:
+        if progress.get(key,0) >= get_job_size(args): continue
+        if args.parent not in parents:
+            uid = get_parent_uid(designs,args.parent)
+            if uid is None:
+                sys.stderr.write("CRITICAL: could not find parent entry '%s'\n" % args.parent)
+                sys.exit(1)
+            parents[args.parent] = (uid,designs.find_one({ 'uid': uid })['seq'])
+        uid, seq = parents[args.parent]
+        args.parent = uid
+        masks = get_merged_mask(seq,args)
+        gkey = (uid,''.join([ str(m) for m in masks['merged'] ]))
+        if gkey not in groups:
+            groups[gkey] = { 'parent': uid, 'seq': seq, 'masks': masks, 'jobs': [] }
+        groups[gkey]['jobs'].append((key,args,progress.get(key,0)))
+    return list(groups.values())
+
+def get_worker_metrics_file(file):
+    # a Prometheus file holds the metrics of one process
+    if file.endswith(PROMETHEUS_EXT):
+        return '%s.%d%s' % (file[:-len(PROMETHEUS_EXT)],os.getpid(),PROMETHEUS_EXT)
+    return file
+
+def init_worker(test,flush_size,flush_interval,progressfile,checkpoint,metricsfile,metrics_interval):
+    designs = get_mongo_designs(test=test)
+    metrics = Metrics(get_worker_metrics_file(metricsfile),interval=metrics_interval)
+    worker.update({ 'designs': designs, 'uid_cache': UidCache(designs), 'metrics': metrics,
+                    'writer': DesignWriter(designs,size=flush_size,interval=flush_interval,metrics=metrics),
+                    'progress': progressfile, 'checkpoint': checkpoint })
+
+def record_progress(key,done):
+    # only once the designs are in the database
+    worker['writer'].flush()
+    append_lines_to_file(worker['progress'],[ "%s\t%d\n" % (key,done) ])
+
+def run_group(group):
+    engine = DesignEngine(worker['designs'],group['parent'],group['seq'],group['masks'],
+                          uid_cache=worker['uid_cache'],writer=worker['writer'],metrics=worker['metrics'])
+    res = []
+    for key, args, done in group['jobs']:
+        size = get_job_size(args)
+        while done < size:
+            chunk = Namespace(**vars(args))
+            chunk.ndesign = min(worker['checkpoint'],size - done)
+            chunk.seed = get_chunk_seed(args,done)
+            try:
+                n = engine.design(chunk,force_seq=args.force_seq)
+            except TargetReached:
+                n = size - done
+            except (KeyboardInterrupt,SystemExit):
+                # the designs accepted so far are written at exit anyway
+                record_progress(key,done + engine.naccepted)
+                raise
+            # a forced sequence already in the database is done too
+            done = size if args.force_seq else done + n
+            record_progress(key,done)
+        res.append((key,done))
+    worker['metrics'].write()
+    return res
+
+def main():
+    args = parse_args()
+    progressfile = args.progress if args.progress else args.spec + '.progress'
+    jobs = read_jobs(args.spec)
+    progress = read_progress(progressfile)
+    groups = build_groups(get_mongo_designs(test=args.test),jobs,progress)
+    print("%d jobs, %d left in %d groups" % (len(jobs),sum([ len(g['jobs']) for g in groups ]),len(groups)))
+    # inherited by the workers
+    handle_sigterm()
+    initargs = (args.test,args.flush_size,args.flush_interval,progressfile,args.checkpoint,
+                args.metrics,args.metrics_interval)
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers,initializer=init_worker,initargs=initargs)
+        results = pool.imap_unordered(run_group,groups)
+    else:
+        init_worker(*initargs)
+        results = map(run_group,groups)
+    for res in results:
+        for key, done in res:
+            print("job %s: %d designs" % (key,done))
+    if args.workers > 1:
+        pool.close()
+        pool.join()
+    print("TERMINATED")
+
+if __name__ == '__main__':
+    main()
@@ -36,6 +36,8 @@ N_SHORTUID_CHARS = 12
 # MAX_MOLECULES = 31600 # make sure these values are in sync with the C-programs
 MAX_MOLECULES = 3000 # make sure these values are in sync with the C-programs
 MAX_PREDICTIONS = 1000000000
+# the ids above are the legacy (version 0) prediction ids, see predids.py
+# for the versioned 64-bit layout and the persistent molecule registry
 
 TARGET_PDBS = {
     'BCL2L2' : [ '4k5aA', '4k5bC' ]
@@ -64,7 +66,11 @@ dockingdir = os.path.join(darpinsdir,'docking')
 dockinginputdir = os.path.join(dockingdir,'input')
 dockingoutputdir = os.path.join(dockingdir,'output')
 datadir = os.path.join(darpinsdir,'data')
+indexesdir = os.path.join(datadir,'indexes')
 tmpdir = os.path.join(darpinsdir,'tmp')
+MONGODB_URL = 'mongodb://localhost:27017/darpins'
+STORAGE_URL = os.environ.get('DARPINS_STORAGE',MONGODB_URL)
+ASCENDING = 1 # pymongo.ASCENDING, also understood by the sqlite storage
 workdir = os.path.join(darpinsdir,'work','%d' % os.getpid())
 
 
@@ -85,10 +91,18 @@ def get_parent_uid(designs,parent):
     if not d: return None
     return d['uid']
     
-def is_prepared(mol2file):
-    prmtopfile = mol2file.replace('mol2','prmtop')
-    prepared = os.path.isfile(mol2file) and os.stat(mol2file).st_size > 0 and \
-               os.path.isfile(prmtopfile) and os.stat(prmtopfile).st_size > 0
+def get_prmtop_file(mol2file):
+    # the prmtop of a model: a mol2/ directory of the path maps to prmtop/ too
+    return mol2file.replace('mol2','prmtop')
+
+def is_prepared(mol2file,manifest=None):
+    # with a PreparationManifest of the tree (prepmanifest.py) this is a lookup
+    if manifest is not None:
+        prepared = manifest.is_prepared(mol2file)
+    else:
+        prmtopfile = get_prmtop_file(mol2file)
+        prepared = os.path.isfile(mol2file) and os.stat(mol2file).st_size > 0 and \
+                   os.path.isfile(prmtopfile) and os.stat(prmtopfile).st_size > 0
     if not prepared:
         sys.stderr.write("WARNING: '%s' is not prepared\n" % mol2file)
     return prepared
@@ -99,23 +113,49 @@ def hash(s):
 def hash_seq(seq):
     return hash(''.join(seq))
 
+mongo_clients = {}
+
+def get_mongo_client(url=MONGODB_URL):
+    # one client (and connection pool) per process and url; clients must not be
+    # shared across a fork, so forked workers open their own on first use
+    key = (os.getpid(),url)
+    if key not in mongo_clients:
+        mongo_clients[key] = MongoClient(url,connect=False)
+    return mongo_clients[key]
+
 def get_mongo_collection(coll,test=False):
-    mongodb = 'mongodb://localhost:27017/darpins'
-    client = MongoClient(mongodb)
-    darpins = client.darpins
+    darpins = get_mongo_client().darpins
     return getattr(darpins,'%s%s' % (coll,('_test' if test else '')))
 
+def get_collection(coll,test=False):
+    # mongo collection, or table of the local sqlite file when DARPINS_STORAGE
+    # is sqlite:<file> (see storage.py)
+    if STORAGE_URL.startswith('sqlite:'):
+        from storage import get_sqlite_collection
+        return get_sqlite_collection(STORAGE_URL,'%s%s' % (coll,('_test' if test else '')))
+    return get_mongo_collection(coll,test=test)
+
 def get_mongo_predictions(test=False):
-    return get_mongo_collection('predictions',test=test)
+    return get_collection('predictions',test=test)
 
 def get_mongo_designs(test=False):
-    return get_mongo_collection('designs',test=test)
+    return get_collection('designs',test=test)
+
+def ensure_design_indexes(designs):
+    designs.create_index([('uid', ASCENDING)],unique=True)
+    designs.create_index([('shortuid', ASCENDING)],unique=True)
+    designs.create_index([('type', ASCENDING)])
+    designs.create_index([('parent', ASCENDING)])
 
 def get_designs_from_mongodb(test=False):
     designs = get_mongo_designs(test=test)
-    return designs.find().sort([("uid", pymongo.ASCENDING)])
+    return designs.find().sort([("uid", ASCENDING)])
 
 def get_designs_from_dbfile(file):
+    if file.endswith('.dlib'):
+        # packed library, streamed (see designlib.py)
+        from designlib import open_design_library
+        return open_design_library(file)
     designs = []
     lines = open(file).readlines()
     for line in lines:
@@ -139,8 +179,20 @@ def build_folders():
     build_folder(dockingoutputdir)
     build_folder(workdir)
     build_folder(datadir)
+    build_folder(indexesdir)
+
+def is_sharded(file):
+    return os.path.isdir(file + '.segments')
+
+def is_log(file):
+    return os.path.isfile(file) or is_sharded(file)
 
 def append_lines_to_file(file,lines):
+    if is_sharded(file):
+        # lock-free append to the segment of this process (see shardlog.py)
+        from shardlog import append_lines_to_segment
+        append_lines_to_segment(file,lines)
+        return
     with open(file, "a") as out:
         fcntl.flock(out, fcntl.LOCK_EX)
         for line in lines:
@@ -148,59 +200,73 @@ def append_lines_to_file(file,lines):
         out.flush()
         fcntl.flock(out, fcntl.LOCK_UN)
 
-def read_sites_map_from_file(file):
-    sites = {}
-    if not os.path.isfile(file): return sites
-    lines = []
+def split_sites_line(line):
+    # (design, target, mol, top, interface residues)
+    try:
+        design, target, mol, top, ir_ = line.rstrip('\n').split('\t')
+    except:
+        print("CRITICAL: failed to parse line:\n%s\n" % line)
+        sys.exit(1)
+    return design, target, mol, int(top), ir_.split(',')
+
+def parse_sites_line(sites,line):
+    design, target, mol, top, ir = split_sites_line(line)
+    if design not in sites:
+        sites[design] = {}
+    if target not in sites[design]:
+        sites[design][target] = {}
+    if top not in sites[design][target]:
+        sites[design][target][top] = {}
+    sites[design][target][top][mol] = ir
+
+def split_contacts_line(line):
+    # (design, target, top, contacts)
+    try:
+        design, target, top, conts_ = line.rstrip('\n').split('\t')
+    except:
+        print("CRITICAL: failed to parse line:\n%s\n" % line)
+        sys.exit(1)
+    return design, target, int(top), conts_.split(',')
+
+def parse_contacts_line(contacts,line):
+    design, target, top, conts = split_contacts_line(line)
+    if design not in contacts:
+        contacts[design] = {}
+    if target not in contacts[design]:
+        contacts[design][target] = {}
+    contacts[design][target][top] = conts
+
+def read_locked_lines(file):
+    if is_sharded(file):
+        from shardlog import read_log_lines
+        return read_log_lines(file)
+    # writers hold an exclusive lock while appending, readers can share
     with open(file, "r") as in_:
-        fcntl.flock(in_, fcntl.LOCK_EX)
+        fcntl.flock(in_, fcntl.LOCK_SH)
         lines = in_.readlines()
         fcntl.flock(in_, fcntl.LOCK_UN)
-    for line in lines:
-        try:
-            design, target, mol, top, ir_ = line.rstrip('\n').split('\t')
-        except:
-            print("CRITICAL: failed to parse line:\n%s\n" % line)
-            sys.exit(1)
-        ir = ir_.split(',')
-        top = int(top)
-        if design not in sites:
-            sites[design] = {}
-        if target not in sites[design]:
-            sites[design][target] = {}
-        if top not in sites[design][target]:
-            sites[design][target][top] = {}
-        sites[design][target][top][mol] = ir
+    return lines
+
+def read_sites_map_from_file(file):
+    sites = {}
+    if not is_log(file): return sites
+    for line in read_locked_lines(file):
+        parse_sites_line(sites,line)
     return sites
     
 def read_contacts_map_from_file(file):
     contacts = {}
-    if not os.path.isfile(file): return contacts
-    lines = []
-    with open(file, "r") as in_:
-        fcntl.flock(in_, fcntl.LOCK_EX)
-        lines = in_.readlines()
-        fcntl.flock(in_, fcntl.LOCK_UN)
-    for line in lines:
-        try:
-            design, target, top, conts_ = line.rstrip('\n').split('\t')
-        except:
-            print("CRITICAL: failed to parse line:\n%s\n" % line)
-            sys.exit(1)
-        conts = conts_.split(',')
-        top = int(top)
-        if design not in contacts:
-            contacts[design] = {}
-        if target not in contacts[design]:
-            contacts[design][target] = {}
-        contacts[design][target][top] = conts
+    if not is_log(file): return contacts
+    for line in read_locked_lines(file):
+        parse_contacts_line(contacts,line)
     return contacts
     
 def read_scores_from_file(file):
+    # scores[design][target][top][score] = value; see scorestore.py for a
+    # columnar store of large files
     scores = {}
-    if not os.path.isfile(file): return scores
-    lines = open(file).readlines()
-    for line in lines:
+    if not is_log(file): return scores
+    for line in read_locked_lines(file):
         tmp = line.rstrip().split('\t')
         design, target, top, score, value = line.rstrip().split('\t')
         top = int(top)
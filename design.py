@@ -1,38 +1,47 @@
 from darpins import *
 from subprocess import Popen
+try:
+    import levenshtein as Clevenshtein
+except:
+    pass
 from argparse import ArgumentParser
-import levenshtein as Clevenshtein
+from divergence import DivergenceLibrary, levenshtein_many, get_levenshtein_backend, distance_many
+from seqindex import MaskedIndex
+from uidcache import UidCache
+from writer import DesignWriter, handle_sigterm
+from metrics import Metrics, write_profile
+import sampler
+import parallel
+import multiprocessing
+import collections
 import datetime
 import random
+import tempfile
 import pprint
+import numpy as np
 
-combined_seqs = ''
-ncombined = 0
+class TargetReached(Exception):
+    pass
 
-def unlist_alphabet(ab):
-    li = []
-    for g in ab:
-        li.extend(ab[g])
-    return li
-        
-def validate_mask_lengths(seq,masks):
+def get_mask_error(seq,masks,args):
+    # first problem of the masks read from the mapfile, '' if there is none
     for mask in masks:
         if len(masks[mask]) != len(seq):
-            sys.stderr.write("CRITICAL: mask '%s' does not match sequence length\n" % mask)
-            sys.exit(1)
-            
-def validate_mask_names(names,masks):
-    for name in names:
+            return "mask '%s' does not match sequence length" % mask
+    for name in args.variable + args.fixed:
         if name not in masks:
-            sys.stderr.write("CRITICAL: name '%s' does not match any mask\n" % name)
-            sys.exit(1)
-
-def validate_alphabet_scheme(scheme):
-    if scheme and scheme not in ALPHABETS:
-        sys.stderr.write("CRITICAL: alphabet scheme '%s' does not exist\n" % scheme)
-        sys.exit(1)
-
-def parse_args():
+            return "name '%s' does not match any mask" % name
+    return ''
+
+def get_args_error(args):
+    # first problem of the option combination, '' if there is none
+    if args.steer and (args.permutate or args.lev_full or args.div_python):
+        return "--steer only works with mutations and hamming divergence"
+    if args.alphabet_scheme and args.alphabet_scheme not in ALPHABETS:
+        return "alphabet scheme '%s' does not exist" % args.alphabet_scheme
+    return ''
+
+def get_parser():
     parser = ArgumentParser()
 
     parser.add_argument("-p", "--parent", dest="parent", required=False,
@@ -54,6 +63,8 @@ def parse_args():
                         help="Uses a reduced alphabet when mutating residues")
     parser.add_argument("--alphabet_change", dest="alphabet_change", action="store_true",
                         help="Forces a change in the alphabet group when mutating")
+    parser.add_argument("--residue_weights", dest="residue_weights", default='',
+                        help="File of '[position] residue weight' lines to bias mutated residues")
     
     parser.add_argument("-m", "--mapfile", dest="mapfile",
                       help="Masking file to map residues to mutate")
@@ -69,17 +80,40 @@ def parse_args():
     parser.add_argument("-l", "--lev_threshold", dest="lev_threshold", default=0, type=int,
                       help="Adjust tolerance for sequence divergence")
     parser.add_argument("--lev_python", dest="lev_python", default=False, action="store_true",
-                      help="Use python version of the levenshtein implementation (slower)")
+                      help="Use numpy version of the levenshtein implementation (no C extension needed)")
     parser.add_argument("--div_python", dest="div_python", default=False, action="store_true",
                       help="Use python version to calculate pairwise levenshtein (slower)")
+    parser.add_argument("--lev_full", dest="lev_full", default=False, action="store_true",
+                      help="Use levenshtein instead of hamming distances for the full divergence check")
+    parser.add_argument("--pivots", dest="pivots", default=0, type=int,
+                      help="Index designs against <n> pivots to skip most distance computations")
     parser.add_argument("--no_filter_type", dest="filter_type", default=True, action="store_false",
                       help="Do not filter by type when designing")
     parser.add_argument("--no_filter_parent", dest="filter_parent", default=True, action="store_false",
                       help="Do not filter by parent when designing")
     parser.add_argument("-s", "--seed", dest="seed", default=None,
                       help="Sets the seed of the design")
+    parser.add_argument("--flush_size", dest="flush_size", default=1000, type=int,
+                      help="Writes accepted designs to the database by groups of <n>")
+    parser.add_argument("--flush_interval", dest="flush_interval", default=10.0, type=float,
+                      help="Writes pending designs to the database at least every <n> seconds")
+    parser.add_argument("--workers", dest="workers", default=1, type=int,
+                      help="Generates and filters candidates in <n> processes")
+    parser.add_argument("--batch", dest="batch", default=0, type=int,
+                      help="Samples and filters <n> candidates at a time")
+    parser.add_argument("--steer", dest="steer", default=False, action="store_true",
+                      help="Walks rejected candidates away from their nearest designs (hamming, mutations only)")
+    parser.add_argument("--metrics", dest="metrics", default='',
+                      help="Writes counters and timers to <file> (JSON lines, or Prometheus text for .prom)")
+    parser.add_argument("--metrics_interval", dest="metrics_interval", default=10.0, type=float,
+                      help="Writes the metrics at most every <n> seconds")
+    parser.add_argument("--profile", dest="profile", default=False, action="store_true",
+                      help="Runs the design under cProfile and saves the report in datadir/profiles")
+
+    return parser
 
-    return parser.parse_args()
+def parse_args():
+    return get_parser().parse_args()
 
 def apply_mask(li,mask,val=1):
     for i in range(0,len(li)):
@@ -98,272 +132,521 @@ def apply_sequence_mask(seq,mask,fun):
             elif fun == 'lower':
                 seq[i] = seq[i].lower()
     
-def mutate_residue(from_res,args,to=''):
-    if to: return to
-    if args.alphabet_scheme:
-        ab = dict(ALPHABETS[args.alphabet_scheme])
-        g0 = REVERSED_ALPHABETS[args.alphabet_scheme][from_res]
-        if args.alphabet_change:
-            del ab[g0]
-        li = unlist_alphabet(ab)
-    else:
-        li = list(MUTATABLE_AA)
-    # do not mutate to itself
-    if from_res in li:
-        li.remove(from_res)
-    ipos = random.randint(0,len(li)-1)
-    return li[ipos]
-
 def levenshtein(s, t):
-    if s == "":
-        return len(t)
-    if t == "":
-        return len(s)
-    cost = 0 if s[-1] == t[-1] else 1
-    
-    i1 = (s[:-1], t)
-    if not i1 in memo:
-        memo[i1] = levenshtein(*i1)
-    i2 = (s, t[:-1])
-    if not i2 in memo:
-        memo[i2] = levenshtein(*i2)
-    i3 = (s[:-1], t[:-1])
-    if not i3 in memo:
-        memo[i3] = levenshtein(*i3)
-    res = min([memo[i1]+1, memo[i2]+1, memo[i3]+cost])
-    
-    return res
-    
-def mutate_towards_alphabet(seq,seq2,rab):
-    for i in range(0,len(seq)):
-        if seq2[i].isupper() and \
-           rab[seq[i]] == rab[seq2[i]]:
-            seq[i] = seq2[i]
-    
-def mutate_towards_alphabet_first(seq,rab,ab):
-    for i in range(0,len(seq)):
-        if seq[i].isupper():
-            seq[i] = ab[rab[seq[i]]][0]
-    
-def is_divergent(seq,masks,designs,args):
-    if not args.div_python:
-        return is_divergent_full(seq,masks,designs,args)
-    # print("calculating divergence...")
-    min_l = 100000
-    # max_l = 0
-    seq_ = [ seq[i] for i in range(len(seq)) if masks['merged'][i] ]
-    filterdata = {}
-    if args.filter_type:
-        filterdata.update({ 'type': 'permutate' if args.permutate else 'random' })
-    if args.filter_parent:
-        filterdata.update({ 'parent' : args.parent })
-    lev_fun = levenshtein if args.lev_python else Clevenshtein.levenshtein
-    for d in designs.find(filterdata):
-        # provide a mutated sequence with same aa from group
-        # to consider to take into account convergence based on alphabet
-        global memo
-        memo = {}
-        seq2_ = [ d['seq'][i] for i in range(len(d['seq'])) if masks['merged'][i] ]
-        if args.alphabet_scheme:
-            mutate_towards_alphabet(seq2_,seq_,REVERSED_ALPHABETS[args.alphabet_scheme])
-        l = lev_fun(''.join(seq_),''.join(seq2_))
-        # if l > max_l: max_l = l
-        if l < min_l:
-            min_l = l
-            if min_l < args.lev_threshold: break
-    # print("min_levenshtein", min_l)
-    return min_l >= args.lev_threshold
-    
-def is_divergent_full(seq,masks,designs,args):
-    global combined_seqs;
-    global ncombined;
-    seq_ = [ seq[i] for i in range(len(seq)) if masks['merged'][i] ]
-    if args.alphabet_scheme:
-        mutate_towards_alphabet_first(seq_,REVERSED_ALPHABETS[args.alphabet_scheme],
-                                      ALPHABETS[args.alphabet_scheme])
-    filterdata = { 'type' : 'permutate' if args.permutate else 'random',
-                   'parent' : args.parent
-    }
-    count = designs.count(filterdata)
-    if args.ntarget and count >= args.ntarget:
-        sys.exit(1)
-    elif count > ncombined:
-        for d in designs.find(filterdata)[ncombined:]:
-            lseq_ = [ d['seq'][i] for i in range(len(d['seq'])) if masks['merged'][i] ]
-            if args.alphabet_scheme:
-                mutate_towards_alphabet_first(lseq_,REVERSED_ALPHABETS[args.alphabet_scheme],
-                                              ALPHABETS[args.alphabet_scheme])
-            combined_seqs += ''.join(lseq_)
-            ncombined += 1
-    return Clevenshtein.multiple_ndiff(''.join(seq_),combined_seqs,len(seq_),args.lev_threshold)
-    
-def mutate_sequence(seq,mutmask,indexes,args,force_seq=[]):
-    # find position to mutate
-    mutpos = random.randint(0,len(indexes)-1)
-    i = indexes[mutpos]
-    to = force_seq[i] if force_seq else ''
-    seq[i] = mutate_residue(seq[i],args,to=to)
-    mutmask[i] = 1
-    return mutpos
-
-def permutate_sequence(seq,mutmask,indexes,args,force_seq=[]):
-    # find position to mutate
-    permpos1 = random.randint(0,len(indexes)-1)
-    while True:        
-        permpos2 = random.randint(0,len(indexes)-1)
-        if permpos2 != permpos1: break
-    i = indexes[permpos1]
-    j = indexes[permpos2]
-    seqi = seq[i]
-    seq[i] = seq[j]
-    seq[j] = seqi
-    mutmask[i] = 1
-    mutmask[j] = 1
-    return permpos1, permpos2
-    
-def design_sequence(seq,masks,args,force_seq=''):
-    seq = [ r.lower() for r in seq ]
-    for i in range(0,len(masks['merged'])):
-        if masks['merged'][i]:
-            seq[i] = seq[i].upper()
-    nres = len([c for c in seq if c.isupper()])
-    if args.nres > 0 and args.nres < nres:
-        nres = args.nres
-    mutmask = [0 for c in seq]
-    force_seq = [ r.lower() for r in force_seq ]
-    indexes = []
-    for i in range(0,len(seq)):
-        if seq[i].isupper():
-            indexes.append(i)
-    # print([ r for r in seq if r.isupper() ])
-    while nres > 0:
-        if args.permutate:
-            permpos1, permpos2 = permutate_sequence(seq,mutmask,indexes,args,force_seq=force_seq)
-            # print("permutated %d and %d" % (permpos1,permpos2))
-        else:
-            mutpos = mutate_sequence(seq,mutmask,indexes,args,force_seq=force_seq)
-            # print("mutated %d" % (mutpos))
-            # drop index to not mutate same residue twice
-            indexes.pop(mutpos)
-        nres -= 1
-    # print([ r for r in seq if r.isupper() ])
-    return seq, mutmask
-
-def design_molecule(seq,masks,designs,parent,args,j,force_seq=''):
-    print("generating sequence...")
-    i = j
-    while True:
-        newseq, mutmask = design_sequence(seq,masks,args,force_seq=force_seq)
-        lseq = ''.join(newseq)
-        useq = lseq.upper()
-        uid = hash(useq)
-        if not designs.find_one({ 'uid': uid }) and \
-           (force_seq or is_divergent(newseq,masks,designs,args)): # does it respect Levenshtein distances
-            break
-        i += 1
-        if i % 1000 == 0:
-            print("%d designs scanned" % i)
-        # the next line is executed when a force_seq does not go through because it already exists in the DB
-        if force_seq: return
-            
+    return int(levenshtein_many(np.frombuffer(bytes(s,'ascii'),dtype=np.uint8),
+                                np.frombuffer(bytes(t,'ascii'),dtype=np.uint8).reshape(1,-1))[0])
+
+def get_design_type(args,force_seq=''):
     if force_seq:
-        type = 'manual'
+        return 'manual'
     elif args.permutate:
-        type = 'permutate'
-    else:
-        type = 'random'
-        
-    shortuid = uid[0:N_SHORTUID_CHARS]
-    d = { 'uid': uid, 'shortuid': uid[0:N_SHORTUID_CHARS], 'seq': useq,
-          'mutmask': mutmask, 'varmask': masks['merged'],
-          'parent': parent, 'created': datetime.datetime.utcnow(),
-          'type': type,
-          'alphabet_scheme': args.alphabet_scheme,
-          'alphabet_change': args.alphabet_change,
-          'lev_threshold': args.lev_threshold,
-          'nres': args.nres
+        return 'permutate'
+    return 'random'
+
+def get_divergence_metric(args):
+    return 'levenshtein' if args.lev_full else 'hamming'
+
+def get_residue_weights(args):
+    return sampler.read_residue_weights(args.residue_weights) if args.residue_weights else None
+
+def get_levenshtein_backend_arg(args):
+    return 'numpy' if args.lev_python else ''
+
+def get_design_document(uid,useq,mutmask,masks,parent,type,args):
+    return { 'uid': uid, 'shortuid': uid[0:N_SHORTUID_CHARS], 'seq': useq,
+             'mutmask': mutmask, 'varmask': masks['merged'],
+             'parent': parent, 'created': datetime.datetime.utcnow(),
+             'type': type,
+             'alphabet_scheme': args.alphabet_scheme,
+             'alphabet_change': args.alphabet_change,
+             'lev_threshold': args.lev_threshold,
+             'nres': args.nres
     }
-    print(d)
-    if args.insert: designs.insert_one(d)
-    return i
-
-def design(seq,masks,designs,parent,args,force_seq=''):
-    if force_seq:
-        design_molecule(seq,masks,designs,parent,args,0,force_seq=force_seq)
-    else:
-        j = 0
-        if args.ndesign:
-            for i in range(0,args.ndesign):
-                j = design_molecule(seq,masks,designs,parent,args,j)
-
-
-args = parse_args()
-print(args)
 
-
-designs = get_mongo_designs(test=args.test)
-
-if args.force_parent:
+def normalize_args(args):
+    # option combinations, as design.py applies them before designing
+    if args.force_seq or args.permutate:
+        args.alphabet_scheme = ''
+        args.alphabet_change = False
+        if args.force_seq:
+            args.lev_threshold = 0
+            args.permutate = False
+    if args.steer and args.batch <= 0:
+        args.batch = 1000
+    return args
+
+def check_args(args):
+    error = get_args_error(normalize_args(args))
+    if error:
+        sys.stderr.write("CRITICAL: %s\n" % error)
+        sys.exit(1)
+    return args
+
+def merge_masks(seq,masks,args):
+    # copy of the masks with the 'merged' mask of the variable and fixed ones
+    masks = dict(masks)
+    masks['merged'] = [0 for c in seq]
+    apply_masks(masks['merged'],masks,args.variable,val=1)
+    apply_masks(masks['merged'],masks,args.fixed,val=0)
+    return masks
+
+def get_merged_mask(seq,args):
+    masks = read_masks_from_file(args.mapfile)
+    error = get_mask_error(seq,masks,args)
+    if error:
+        sys.stderr.write("CRITICAL: %s\n" % error)
+        sys.exit(1)
+    return merge_masks(seq,masks,args)
+
+class DesignEngine:
+
+    # design loop of one parent sequence and mask set. The divergence library
+    # and index of every (type, scheme, metric) and the mutation plans are
+    # kept between runs, so several runs with different options (nres,
+    # lev_threshold, ndesign...) share what they loaded. The uid cache and the
+    # writer can be shared with other engines of the same collection.
+    # Candidates scanned, accepted and rejected (duplicate or too close) and
+    # the time of every phase are counted in self.metrics (see metrics.py).
+    # Accepted design documents are passed to self.emit (print by default).
+    # Designs of runs without insert stay out of the shared library and uid
+    # cache, they are only compared with each other.
+
+    def __init__(self,designs,parent,seq,masks,uid_cache=None,writer=None,metrics=None,folder=indexesdir,
+                 emit=print):
+        self.designs = designs
+        self.parent = parent
+        self.seq = seq
+        self.masks = masks
+        self.uid_cache = uid_cache if uid_cache is not None else UidCache(designs)
+        self.writer = writer
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.folder = folder
+        self.emit = emit
+        self.states = {}
+        self.plans = {}
+        self.plan = None
+        self.library = None
+        self.index = None
+        self.count = 0
+        self.max_scanned = 0
+        self.local = []
+        self.local_uids = set()
+
+    def get_plan(self,args):
+        # weight files are read again when they change
+        key = (args.alphabet_scheme,args.alphabet_change,args.residue_weights,
+               os.stat(args.residue_weights).st_mtime if args.residue_weights else 0)
+        if key not in self.plans:
+            self.plans[key] = sampler.MutationPlan(self.seq,self.masks['merged'],args.alphabet_scheme,
+                                                   args.alphabet_change,get_residue_weights(args))
+        return self.plans[key]
+
+    def set_state(self,args):
+        # library and index of the designs these options compare against
+        key = (get_design_type(args),args.alphabet_scheme,get_divergence_metric(args),
+               get_levenshtein_backend_arg(args),args.pivots)
+        if key not in self.states:
+            self.states[key] = [ None, None ]
+        self.state = self.states[key]
+        self.library, self.index = self.state
+        self.plan = self.get_plan(args)
+
+    def mutate_residue(self,i,to=''):
+        # never mutates to itself, see sampler.get_allowed_residues; without
+        # weights, the draw of the original loop so seeded runs do not change
+        if to: return to
+        plan = self.plan
+        if plan.cumweights is not None:
+            return plan.choose(i,random.random())
+        k = plan.positions[i]
+        return chr(plan.table[k,random.randint(0,plan.nallowed[k]-1)])
+
+    def is_divergent(self,seq,args):
+        masks = self.masks
+        if not args.div_python:
+            return self.is_divergent_full(seq,args)
+        # print("calculating divergence...")
+        min_l = 100000
+        # max_l = 0
+        # residues of the same alphabet group compare equal
+        seq_ = self.plan.project(''.join([ seq[i] for i in range(len(seq)) if masks['merged'][i] ]))
+        filterdata = {}
+        if args.filter_type:
+            filterdata.update({ 'type': 'permutate' if args.permutate else 'random' })
+        if args.filter_parent:
+            filterdata.update({ 'parent' : self.parent })
+        if get_levenshtein_backend(get_levenshtein_backend_arg(args)) == 'numpy':
+            # one-vs-many on all library sequences at once
+            seqs2_ = []
+            for d in self.designs.find(filterdata):
+                seqs2_.append(''.join([ d['seq'][i] for i in range(len(d['seq'])) if masks['merged'][i] ]))
+            if not seqs2_: return True
+            rows = np.frombuffer(bytes(''.join(seqs2_),'ascii'),dtype=np.uint8).reshape(len(seqs2_),-1)
+            min_l = levenshtein_many(np.frombuffer(bytes(seq_,'ascii'),dtype=np.uint8),
+                                     self.plan.project(rows),args.lev_threshold).min()
+            return min_l >= args.lev_threshold
+        for d in self.designs.find(filterdata):
+            # provide a mutated sequence with same aa from group
+            # to consider to take into account convergence based on alphabet
+            seq2_ = self.plan.project(''.join([ d['seq'][i] for i in range(len(d['seq'])) if masks['merged'][i] ]))
+            l = Clevenshtein.levenshtein(seq_,seq2_)
+            # if l > max_l: max_l = l
+            if l < min_l:
+                min_l = l
+                if min_l < args.lev_threshold: break
+        # print("min_levenshtein", min_l)
+        return min_l >= args.lev_threshold
+
+    def get_npending(self):
+        # accepted designs not written to the database yet
+        return len(self.writer) if self.writer else 0
+
+    def sync_library(self,args):
+        filterdata = { 'type' : get_design_type(args),
+                       'parent' : self.parent
+        }
+        if self.library is None:
+            self.library = DivergenceLibrary(self.masks['merged'],scheme=args.alphabet_scheme,
+                                             metric=get_divergence_metric(args),
+                                             backend=get_levenshtein_backend_arg(args))
+            if args.pivots: self.library.use_pivots(args.pivots)
+            self.index = MaskedIndex(self.parent,filterdata['type'],self.masks['merged'],
+                                     scheme=args.alphabet_scheme,folder=self.folder)
+            # the index may already be up to date on disk
+            self.library.set_base(self.index.seqs,self.index.uids)
+            self.state[:] = [ self.library, self.index ]
+        with self.metrics.timer('mongo_count',histogram=True):
+            self.count = count = self.designs.count(filterdata)
+        if args.ntarget and count + self.get_npending() >= args.ntarget:
+            raise TargetReached()
+        elif count != len(self.index):
+            with self.metrics.timer('index_sync',histogram=True):
+                self.index.sync(self.designs)
+                self.library.set_base(self.index.seqs,self.index.uids)
+        self.metrics.set('library_size',len(self.library))
+        return self.library
+
+    def is_divergent_full(self,seq,args):
+        library = self.sync_library(args)
+        return library.is_divergent(library.encode(seq),args.lev_threshold)
+
+    def mutate_sequence(self,seq,mutmask,indexes,args,force_seq=[]):
+        # find position to mutate
+        mutpos = random.randint(0,len(indexes)-1)
+        i = indexes[mutpos]
+        to = force_seq[i] if force_seq else ''
+        seq[i] = self.mutate_residue(i,to=to)
+        mutmask[i] = 1
+        return mutpos
+
+    def permutate_sequence(self,seq,mutmask,indexes,args,force_seq=[]):
+        # find position to mutate
+        permpos1 = random.randint(0,len(indexes)-1)
+        while True:
+            permpos2 = random.randint(0,len(indexes)-1)
+            if permpos2 != permpos1: break
+        i = indexes[permpos1]
+        j = indexes[permpos2]
+        seqi = seq[i]
+        seq[i] = seq[j]
+        seq[j] = seqi
+        mutmask[i] = 1
+        mutmask[j] = 1
+        return permpos1, permpos2
+
+    def design_sequence(self,args,force_seq=''):
+        masks = self.masks
+        seq = [ r.lower() for r in self.seq ]
+        for i in range(0,len(masks['merged'])):
+            if masks['merged'][i]:
+                seq[i] = seq[i].upper()
+        nres = len([c for c in seq if c.isupper()])
+        if args.nres > 0 and args.nres < nres:
+            nres = args.nres
+        mutmask = [0 for c in seq]
+        force_seq = [ r.lower() for r in force_seq ]
+        indexes = []
+        for i in range(0,len(seq)):
+            if seq[i].isupper():
+                indexes.append(i)
+        # print([ r for r in seq if r.isupper() ])
+        while nres > 0:
+            if args.permutate:
+                permpos1, permpos2 = self.permutate_sequence(seq,mutmask,indexes,args,force_seq=force_seq)
+                # print("permutated %d and %d" % (permpos1,permpos2))
+            else:
+                mutpos = self.mutate_sequence(seq,mutmask,indexes,args,force_seq=force_seq)
+                # print("mutated %d" % (mutpos))
+                # drop index to not mutate same residue twice
+                indexes.pop(mutpos)
+            nres -= 1
+        # print([ r for r in seq if r.isupper() ])
+        return seq, mutmask
+
+    def design_molecule(self,args,j,force_seq=''):
+        print("generating sequence...")
+        i = j
+        metrics = self.metrics
+        while True:
+            with metrics.timer('generate'):
+                newseq, mutmask = self.design_sequence(args,force_seq=force_seq)
+            lseq = ''.join(newseq)
+            useq = lseq.upper()
+            with metrics.timer('hash'):
+                uid = hash(useq)
+            metrics.add('scanned')
+            with metrics.timer('uid_lookup'):
+                exists = self.uid_cache.exists(uid)
+            if not exists:
+                if force_seq: break
+                with metrics.timer('divergence'):
+                    divergent = self.is_divergent(newseq,args) # does it respect Levenshtein distances
+                if divergent: break
+            metrics.add('rejected_duplicate' if exists else 'rejected_too_close')
+            i += 1
+            if i % 1000 == 0:
+                print("%d designs scanned" % i)
+                if self.writer: self.writer.poll()
+                metrics.poll()
+            # the next line is executed when a force_seq does not go through because it already exists in the DB
+            if force_seq: return
+
+        d = get_design_document(uid,useq,mutmask,self.masks,self.parent,get_design_type(args,force_seq),args)
+        self.emit(d)
+        self.naccepted += 1
+        metrics.add('accepted')
+        if args.insert:
+            with metrics.timer('insert'):
+                self.writer.add(d)
+                self.uid_cache.add([uid])
+                if self.library is not None and not force_seq:
+                    self.library.append(useq,uid)
+        metrics.poll()
+        return i
+
+    def accept_candidates(self,batch,mutmasks,uids,args,nleft):
+        # drops candidates already in the DB, filters the rest against the library
+        # in bulk and accepts them one by one; returns the accepted masked rows
+        metrics = self.metrics
+        with metrics.timer('uid_lookup'):
+            found = self.uid_cache.find_existing(uids) | (self.local_uids & set(uids))
+        keep = [ k for k in range(len(uids)) if uids[k] not in found ]
+        metrics.add('rejected_duplicate',len(uids) - len(keep))
+        library = self.sync_library(args)
+        if args.ntarget:
+            nleft = min(nleft,args.ntarget - self.count - self.get_npending())
+        with metrics.timer('divergence'):
+            rows = library.table[batch[keep][:,library.indexes]]
+            ok = library.divergent_rows(rows,args.lev_threshold)
+        type = get_design_type(args)
+        # candidates passing the bulk filter still have to diverge from the
+        # designs accepted earlier among them (and earlier in a run without insert)
+        accepted = []
+        compared = list(self.local)
+        with metrics.timer('accept'):
+            for k, row, passed in zip(keep,rows,ok):
+                if len(accepted) == nleft: break
+                if not passed or (compared and args.lev_threshold and \
+                   distance_many(row,np.array(compared),library.metric,library.backend,
+                                 args.lev_threshold).min() < args.lev_threshold):
+                    metrics.add('rejected_too_close')
+                    continue
+                useq = batch[k].tobytes().decode('ascii')
+                d = get_design_document(uids[k],useq,mutmasks[k].tolist(),self.masks,self.parent,type,args)
+                self.emit(d)
+                if args.insert:
+                    self.writer.add(d)
+                    self.uid_cache.add([uids[k]])
+                    library.append_row(row,uids[k])
+                else:
+                    self.local.append(row)
+                    self.local_uids.add(uids[k])
+                accepted.append(row)
+                compared.append(row)
+                self.naccepted += 1
+                metrics.add('accepted')
+        return accepted
+
+    def design_batch(self,args,ndesign,rng):
+        # samples args.batch candidates at a time and filters them in bulk
+        plan = self.plan
+        i = 0
+        ndone = 0
+        metrics = self.metrics
+        while ndone < ndesign:
+            if self.max_scanned and i >= self.max_scanned: break
+            with metrics.timer('generate'):
+                batch, mutmasks = plan.sample(args.nres,args.batch,rng,permutate=args.permutate)
+            if args.steer:
+                library = self.sync_library(args)
+                with metrics.timer('steer'):
+                    sampler.steer_candidates(batch,mutmasks,self.seq,plan.indexes,plan.table,plan.nallowed,
+                                             args.nres,library,args.lev_threshold,rng)
+            i += args.batch
+            metrics.add('scanned',args.batch)
+            with metrics.timer('hash'):
+                keep = sampler.unique_rows(batch)
+                batch = batch[keep]
+                mutmasks = mutmasks[keep]
+                uids = sampler.hash_rows(batch)
+            metrics.add('rejected_duplicate',args.batch - len(keep))
+            ndone += len(self.accept_candidates(batch,mutmasks,uids,args,ndesign-ndone))
+            print("%d designs scanned" % i)
+            if self.writer: self.writer.poll()
+            metrics.poll()
+        return i
+
+    def design_parallel(self,args,ndesign):
+        # workers sample and prefilter batches against a snapshot of the library,
+        # this process accepts their survivors in task order so two designs closer
+        # than lev_threshold can never both be accepted
+        library = self.sync_library(args)
+        snapshot = np.concatenate((library.base,library.rows()))
+        batch_size = args.batch if args.batch > 0 else 1000
+        params = { 'nres': args.nres, 'batch': batch_size, 'permutate': args.permutate,
+                   'alphabet_change': args.alphabet_change, 'lev_threshold': args.lev_threshold,
+                   'metric': get_divergence_metric(args),
+                   'backend': get_levenshtein_backend_arg(args),
+                   'pivots': args.pivots,
+                   'steer': args.steer,
+                   'weights': get_residue_weights(args),
+                   'entropy': sampler.get_seed_entropy(args.seed) }
+        # the accepted rows reach the workers through a file, a task only
+        # carries their number
+        rowsfile = tempfile.NamedTemporaryFile(prefix='darpins_accepted_')
+        pool = multiprocessing.Pool(args.workers,initializer=parallel.init_worker,
+                                    initargs=(self.seq,self.masks['merged'],args.alphabet_scheme,snapshot,
+                                              rowsfile.name,params))
+        pending = collections.deque()
+        naccepted = 0
+        task = 0
+        i = 0
+        ndone = 0
+        try:
+            while ndone < ndesign:
+                if self.max_scanned and i >= self.max_scanned: break
+                while len(pending) < 2*args.workers:
+                    pending.append(pool.apply_async(parallel.run_task,(task,naccepted)))
+                    task += 1
+                with self.metrics.timer('wait'):
+                    batch, mutmasks, n = pending.popleft().get()
+                i += n
+                # workers already dropped duplicates within their batch and too
+                # close candidates, both counted as too close
+                self.metrics.add('scanned',n)
+                self.metrics.add('rejected_too_close',n - len(batch))
+                with self.metrics.timer('hash'):
+                    uids = sampler.hash_rows(batch)
+                rows = self.accept_candidates(batch,mutmasks,uids,args,ndesign-ndone)
+                if rows:
+                    rowsfile.write(np.array(rows,dtype=np.uint8).tobytes())
+                    rowsfile.flush()
+                    naccepted += len(rows)
+                ndone += len(rows)
+                print("%d designs scanned" % i)
+                if self.writer: self.writer.poll()
+                self.metrics.poll()
+            # terminate() can deadlock on workers still writing large results
+            for res in pending:
+                res.wait()
+            pool.close()
+            pool.join()
+        finally:
+            # on errors (e.g. TargetReached) the workers are stopped right away
+            pool.terminate()
+            rowsfile.close()
+        return i
+
+    def design(self,args,force_seq='',max_scanned=0):
+        # runs args.ndesign designs (or the forced one), stopping after about
+        # max_scanned candidates if set; returns the number of designs
+        # accepted, TargetReached once the DB holds args.ntarget
+        self.set_state(args)
+        self.naccepted = 0
+        self.max_scanned = max_scanned
+        self.local = []
+        self.local_uids = set()
+        random.seed(args.seed)
+        if force_seq:
+            self.design_molecule(args,0,force_seq=force_seq)
+        elif args.workers > 1 and not args.div_python:
+            if args.ndesign:
+                self.design_parallel(args,args.ndesign)
+        elif args.batch > 0 and not args.div_python:
+            if args.ndesign:
+                self.design_batch(args,args.ndesign,sampler.get_rng(args.seed))
+        else:
+            j = 0
+            if args.ndesign:
+                for i in range(0,args.ndesign):
+                    if self.max_scanned and j >= self.max_scanned: break
+                    j = self.design_molecule(args,j)
+        return self.naccepted
+
+def create_parent(designs,args):
     if not designs.find_one({ 'uid': hash_seq(args.force_parent) }):
         d = { 'uid': hash_seq(args.force_parent), 'shortuid': hash_seq(args.force_parent)[0:N_SHORTUID_CHARS], 'seq': args.force_parent, 
               'mutmask': [0 for c in args.force_parent], 'varmask': [0 for c in args.force_parent], 
               'parent': None, 'created': datetime.datetime.utcnow(), 'type': 'template' }
         if args.insert:
             designs.insert_one(d)
-            designs.create_index([('uid', pymongo.ASCENDING)],unique=True)
-            designs.create_index([('shortuid', pymongo.ASCENDING)],unique=True)
-            designs.create_index([('type', pymongo.ASCENDING)])
-            designs.create_index([('parent', pymongo.ASCENDING)])
+            ensure_design_indexes(designs)
             print("Successfully created the parent: %s" % hash_seq(args.force_parent)[0:N_SHORTUID_CHARS])
     else:
         print("Parent already exists: %s" % hash_seq(args.force_parent)[0:N_SHORTUID_CHARS])
-    sys.exit(1)
-
-print("number of designs in %scollection=" % ('test ' if args.test else ''), designs.count())
 
-MUTATABLE_AA = unlist_alphabet(ALPHABETS['default'])
+def main():
+    args = parse_args()
+    print(args)
 
+    designs = get_mongo_designs(test=args.test)
 
-if args.force_seq or args.permutate:
-    args.alphabet_scheme = ''
-    args.alphabet_change = False
-    if args.force_seq:
-        args.lev_threshold = 0
-        args.permutate = False
-    
-if not args.parent:
-    print("ERROR: need to define a parent sequence from uid (-p)")
-    sys.exit(1)
-
-
-
-    
-random.seed(args.seed)
-
-args.parent = get_parent_uid(designs,args.parent)
-if args.parent is None:
-    sys.stderr.write("CRITICAL: could not find parent entry\n")
-    sys.exit(1)
-
-d = designs.find_one({'uid': args.parent })
-seq = d['seq']
-uid = hash_seq(seq)
-
-
-masks = read_masks_from_file(args.mapfile)
+    if args.force_parent:
+        create_parent(designs,args)
+        sys.exit(1)
 
-validate_mask_lengths(seq,masks)
-validate_mask_names(args.variable,masks)
-validate_mask_names(args.fixed,masks)
-masks['merged'] = [0 for c in seq]
-apply_masks(masks['merged'],masks,args.variable,val=1)
-apply_masks(masks['merged'],masks,args.fixed,val=0)
+    print("number of designs in %scollection=" % ('test ' if args.test else ''), designs.count())
 
+    if not args.parent:
+        print("ERROR: need to define a parent sequence from uid (-p)")
+        sys.exit(1)
+    check_args(args)
 
-validate_alphabet_scheme(args.alphabet_scheme)
+    args.parent = get_parent_uid(designs,args.parent)
+    if args.parent is None:
+        sys.stderr.write("CRITICAL: could not find parent entry\n")
+        sys.exit(1)
 
+    d = designs.find_one({'uid': args.parent })
+    seq = d['seq']
+    uid = hash_seq(seq)
+
+    masks = get_merged_mask(seq,args)
+
+    metrics = Metrics(args.metrics,interval=args.metrics_interval)
+    writer = None
+    if args.insert:
+        # the python divergence path reads designs back from the database
+        writer = DesignWriter(designs,size=1 if args.div_python else args.flush_size,
+                              interval=args.flush_interval,metrics=metrics)
+        handle_sigterm()
+    engine = DesignEngine(designs,uid,seq,masks,writer=writer,metrics=metrics)
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        engine.design(args,force_seq=args.force_seq)
+    except TargetReached:
+        sys.exit(1)
+    finally:
+        if writer: writer.flush()
+        metrics.write()
+        if args.profile:
+            profiler.disable()
+            print("profile written to %s" % write_profile(profiler,'design'))
 
-memo = {}
-design(seq,masks,designs,uid,args,force_seq=args.force_seq)
+    print("TERMINATED")
 
-print("TERMINATED")
+if __name__ == '__main__':
+    main()
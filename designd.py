@@ -0,0 +1,227 @@
+from darpins import *
+from argparse import ArgumentParser, Namespace
+from design import DesignEngine, TargetReached, get_parser, normalize_args, get_args_error, \
+    get_mask_error, merge_masks
+from uidcache import UidCache
+from writer import DesignWriter, handle_sigterm
+from metrics import Metrics
+import collections
+import json
+import socket
+import socketserver
+
+# resident design server: keeps parents, masks, mutation tables, divergence
+# libraries and the uid cache loaded between jobs, so a job only pays for
+# sampling and filtering. Clients connect to a UNIX socket and send one JSON
+# job per line (design.py options by dest name, see JOB_DEFAULTS); the server
+# answers with one line per accepted design and a final {"done": true, ...}
+# line (or {"error": ...}). Jobs are run one at a time, in the order they
+# arrive, by the DesignEngine of their parent and mask, and their designs are
+# in the database when the done line is sent.
+#
+#   python designd.py [--test]                      # serve
+#   echo '{"parent": "...", "ndesign": 5, "mapfile": "map.txt"}' | python designd.py --submit -
+DEFAULT_SOCKET = os.path.join(tmpdir,'designd.sock')
+# job fields are the design.py options (by dest name) plus max_scanned; these
+# defaults differ from design.py's
+JOB_DEFAULTS = { 'ndesign': 1, 'batch': 1000, 'max_scanned': 0 }
+# options of the server process, not of a job
+SERVER_OPTIONS = ('test','force_parent','flush_size','flush_interval','metrics','metrics_interval',
+                  'profile','workers','div_python')
+
+class JobError(Exception):
+    pass
+
+def parse_args():
+    parser = ArgumentParser()
+
+    parser.add_argument("--socket", dest="socket", default=DEFAULT_SOCKET,
+                        help="UNIX socket to serve on (or to submit to)")
+    parser.add_argument("--test", dest="test", default=False, action="store_true",
+                        help="Use test collections from MongoDB")
+    parser.add_argument("--flush_size", dest="flush_size", default=1000, type=int,
+                        help="Writes accepted designs to the database by groups of <n>")
+    parser.add_argument("--flush_interval", dest="flush_interval", default=10.0, type=float,
+                        help="Writes pending designs to the database at least every <n> seconds")
+    parser.add_argument("--max_states", dest="max_states", default=16, type=int,
+                        help="Keeps the divergence state of at most <n> (parent, mask) pairs loaded")
+    parser.add_argument("--metrics", dest="metrics", default='',
+                        help="Writes counters and timers to <file> (JSON lines, or Prometheus text for .prom)")
+    parser.add_argument("--metrics_interval", dest="metrics_interval", default=10.0, type=float,
+                        help="Writes the metrics at most every <n> seconds")
+    parser.add_argument("--submit", dest="submit", default='',
+                        help="Sends the jobs of a JSON lines file ('-' for stdin) to a running server")
+
+    return parser.parse_args()
+
+def get_job(request):
+    # design options of a job request
+    defaults = dict(vars(get_parser().parse_args([])),**JOB_DEFAULTS)
+    unknown = [ k for k in request if k not in defaults ]
+    if unknown:
+        raise JobError("unknown job fields: %s" % ', '.join(sorted(unknown)))
+    server = [ k for k in request if k in SERVER_OPTIONS ]
+    if server:
+        raise JobError("%s cannot be set per job" % ', '.join(sorted(server)))
+    job = normalize_args(Namespace(**dict(defaults,**request)))
+    if not job.parent:
+        raise JobError("need to define a parent sequence from uid")
+    if not job.mapfile:
+        raise JobError("need a masking file")
+    if job.batch <= 0:
+        raise JobError("batch must be positive")
+    error = get_args_error(job)
+    if error:
+        raise JobError(error)
+    return job
+
+def get_design_reply(d):
+    return { k: d[k] for k in ('uid','shortuid','seq','mutmask','type','parent') }
+
+class DesignServer(socketserver.UnixStreamServer):
+
+    # one DesignEngine per (parent, merged mask), the least recently used
+    # ones are dropped beyond max_states
+
+    def __init__(self,socketfile,designs,flush_size=1000,flush_interval=10.0,max_states=16,metrics=None):
+        self.designs = designs
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.uid_cache = UidCache(designs)
+        self.writer = DesignWriter(designs,size=flush_size,interval=flush_interval,metrics=self.metrics)
+        self.max_states = max_states
+        self.engines = collections.OrderedDict()
+        self.parents = {}
+        self.masks = {}
+        socketserver.UnixStreamServer.__init__(self,socketfile,DesignRequestHandler)
+
+    def get_parent(self,parent):
+        # (uid, seq) of a parent given by uid or shortuid
+        if parent not in self.parents:
+            uid = get_parent_uid(self.designs,parent)
+            if uid is None:
+                raise JobError("could not find parent entry '%s'" % parent)
+            self.parents[parent] = (uid,self.designs.find_one({ 'uid': uid })['seq'])
+        return self.parents[parent]
+
+    def get_masks(self,mapfile):
+        # mapfiles are read again only when they change
+        try:
+            mtime = os.stat(mapfile).st_mtime
+        except OSError:
+            raise JobError("masking file '%s' does not exist" % mapfile)
+        if mapfile not in self.masks or self.masks[mapfile][0] != mtime:
+            self.masks[mapfile] = (mtime,read_masks_from_file(mapfile))
+        return self.masks[mapfile][1]
+
+    def get_engine(self,job):
+        parent, seq = self.get_parent(job.parent)
+        masks = self.get_masks(job.mapfile)
+        error = get_mask_error(seq,masks,job)
+        if error:
+            raise JobError(error)
+        masks = merge_masks(seq,masks,job)
+        key = (parent,''.join([ str(m) for m in masks['merged'] ]))
+        if key in self.engines:
+            self.engines.move_to_end(key)
+        else:
+            self.engines[key] = DesignEngine(self.designs,parent,seq,masks,uid_cache=self.uid_cache,
+                                             writer=self.writer,metrics=self.metrics)
+            while len(self.engines) > self.max_states:
+                self.engines.popitem(last=False)
+        return self.engines[key]
+
+    def run_job(self,job,emit):
+        self.uid_cache.refresh()
+        engine = self.get_engine(job)
+        if job.force_seq and len(job.force_seq) != len(engine.seq):
+            raise JobError("forced sequence does not match parent length")
+        try:
+            engine.get_plan(job)
+        except (OSError,IndexError,ValueError) as e:
+            raise JobError("could not use residue weights '%s': %s" % (job.residue_weights,e))
+        engine.emit = lambda d: emit(get_design_reply(d))
+        nscanned = self.metrics.counters['scanned']
+        res = {}
+        try:
+            engine.design(job,force_seq=job.force_seq,max_scanned=job.max_scanned)
+        except TargetReached:
+            res['target_reached'] = True
+        finally:
+            self.writer.flush()
+        res.update({ 'ndesign': engine.naccepted, 'nscanned': self.metrics.counters['scanned'] - nscanned })
+        self.metrics.poll()
+        return res
+
+class DesignRequestHandler(socketserver.StreamRequestHandler):
+
+    def send(self,data):
+        self.wfile.write(bytes(json.dumps(data) + '\n','utf-8'))
+        self.wfile.flush()
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip(): continue
+            try:
+                job = get_job(json.loads(line))
+                res = self.server.run_job(job,self.send)
+                res['done'] = True
+                self.send(res)
+            except (JobError,ValueError,TypeError) as e:
+                self.send({ 'error': str(e) })
+            except BrokenPipeError:
+                # the client left, accepted designs are still written
+                self.server.writer.flush()
+                return
+
+def submit_jobs(jobs,socketfile=DEFAULT_SOCKET):
+    # sends jobs (dicts) to a running server and yields its replies
+    client = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    client.connect(socketfile)
+    with client, client.makefile('rwb') as stream:
+        for job in jobs:
+            stream.write(bytes(json.dumps(job) + '\n','utf-8'))
+            stream.flush()
+            for line in stream:
+                reply = json.loads(line)
+                yield reply
+                if 'done' in reply or 'error' in reply: break
+
+def is_serving(socketfile):
+    client = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    try:
+        client.connect(socketfile)
+        return True
+    except OSError:
+        return False
+    finally:
+        client.close()
+
+def main():
+    args = parse_args()
+    if args.submit:
+        lines = sys.stdin if args.submit == '-' else open(args.submit)
+        jobs = [ json.loads(line) for line in lines if line.strip() ]
+        for reply in submit_jobs(jobs,args.socket):
+            print(json.dumps(reply))
+        return
+    if os.path.exists(args.socket):
+        if is_serving(args.socket):
+            sys.stderr.write("CRITICAL: a server is already listening on '%s'\n" % args.socket)
+            sys.exit(1)
+        os.remove(args.socket)
+    designs = get_mongo_designs(test=args.test)
+    handle_sigterm()
+    metrics = Metrics(args.metrics,interval=args.metrics_interval)
+    server = DesignServer(args.socket,designs,flush_size=args.flush_size,
+                          flush_interval=args.flush_interval,max_states=args.max_states,metrics=metrics)
+    print("serving on %s" % args.socket)
+    try:
+        server.serve_forever()
+    finally:
+        server.writer.flush()
+        metrics.write()
+        server.server_close()
+        os.remove(args.socket)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+from darpins import *
+from argparse import ArgumentParser
+from storage import insert_missing
+import json
+import struct
+import numpy as np
+
+# packed design library (.dlib) for exchanging large sets of designs:
+#
+#   header   magic, version, flags, number of designs and section offsets
+#   data     per design: 5-bit packed sequence, then (with FLAG_MASKS) the
+#            bit-packed mutmask and varmask; written in input order
+#   strings  json list of the parent uids and types referenced by the records
+#   records  fixed-width RECORD_DTYPE entries sorted by key (the first 8 bytes
+#            of the uid digest as an integer), so a shortuid is found by
+#            binary search
+#
+# Readers memory-map the file: streaming reads the data sequentially by chunks
+# (keeping only an 8-byte offset order per design in memory) and lookups only
+# touch the records they need.
+LIBRARY_MAGIC = b'DARPLIB\0'
+LIBRARY_VERSION = 1
+LIBRARY_EXT = '.dlib'
+FLAG_MASKS = 1
+HEADER_FORMAT = '<8sIIQQQQ'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+NO_STRING = 0xFFFF
+UID_BYTES = 28
+RECORD_DTYPE = np.dtype([ ('key','<u8'), ('uid','u1',(UID_BYTES,)), ('parent','<u2'),
+                          ('type','<u2'), ('length','<u2'), ('offset','<u8') ])
+# residue codes: A-Z are 0-25, then the gap and stop symbols
+EXTRA_SYMBOLS = b'-*'
+CHUNK = 4096
+
+def build_code_tables():
+    encode = np.full(256,255,dtype=np.uint8)
+    decode = np.zeros(32,dtype=np.uint8)
+    symbols = bytes(range(ord('A'),ord('Z')+1)) + EXTRA_SYMBOLS
+    for code, c in enumerate(symbols):
+        encode[c] = code
+        decode[code] = c
+    return encode, decode
+
+ENCODE_TABLE, DECODE_TABLE = build_code_tables()
+BIT_WEIGHTS = np.array([ 16, 8, 4, 2, 1 ],dtype=np.uint8)
+
+def pack_sequence(seq):
+    codes = ENCODE_TABLE[np.frombuffer(bytes(seq.upper(),'ascii'),dtype=np.uint8)]
+    if np.any(codes == 255):
+        raise ValueError("sequence has residues that cannot be packed: %s" % seq)
+    bits = (codes[:,None] >> np.arange(4,-1,-1,dtype=np.uint8)) & 1
+    return np.packbits(bits.ravel()).tobytes()
+
+def unpack_sequence(data,length):
+    bits = np.unpackbits(np.frombuffer(data,dtype=np.uint8),count=5*length).reshape(length,5)
+    return DECODE_TABLE[bits @ BIT_WEIGHTS].tobytes().decode('ascii')
+
+def get_packed_size(length,flags):
+    size = (5*length + 7) // 8
+    if flags & FLAG_MASKS:
+        size += 2 * ((length + 7) // 8)
+    return size
+
+def get_uid_key(uid):
+    return int(uid[0:16],16)
+
+class DesignLibraryWriter:
+
+    def __init__(self,file,masks=False):
+        self.file = file
+        self.flags = FLAG_MASKS if masks else 0
+        self.out = open(file + '.tmp','wb')
+        self.out.write(b'\0' * HEADER_SIZE)
+        self.offset = HEADER_SIZE
+        self.strings = {}
+        self.records = np.zeros(1024,dtype=RECORD_DTYPE)
+        self.n = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,type,value,tb):
+        if type is None:
+            self.close()
+        else:
+            self.out.close()
+            os.remove(self.file + '.tmp')
+
+    def get_string(self,s):
+        if s is None: return NO_STRING
+        if s not in self.strings:
+            if len(self.strings) == NO_STRING:
+                raise ValueError("too many parents and types for one library")
+            self.strings[s] = len(self.strings)
+        return self.strings[s]
+
+    def add(self,d):
+        seq = d['seq']
+        data = pack_sequence(seq)
+        if self.flags & FLAG_MASKS:
+            data += np.packbits(np.asarray(d['mutmask'],dtype=np.uint8)).tobytes()
+            data += np.packbits(np.asarray(d['varmask'],dtype=np.uint8)).tobytes()
+        self.out.write(data)
+        if self.n == len(self.records):
+            records = np.zeros(2*self.n,dtype=RECORD_DTYPE)
+            records[:self.n] = self.records
+            self.records = records
+        self.records[self.n] = (get_uid_key(d['uid']),np.frombuffer(bytes.fromhex(d['uid']),dtype=np.uint8),
+                                self.get_string(d.get('parent')),self.get_string(d.get('type')),
+                                len(seq),self.offset)
+        self.n += 1
+        self.offset += len(data)
+
+    def close(self):
+        records = self.records[:self.n]
+        records = records[np.argsort(records['key'],kind='stable')]
+        strings = bytes(json.dumps(sorted(self.strings,key=self.strings.get)),'utf-8')
+        strings_offset = self.offset
+        records_offset = strings_offset + len(strings)
+        self.out.write(strings)
+        self.out.write(records.tobytes())
+        self.out.seek(0)
+        self.out.write(struct.pack(HEADER_FORMAT,LIBRARY_MAGIC,LIBRARY_VERSION,self.flags,len(records),
+                                   HEADER_SIZE,strings_offset,records_offset))
+        self.out.close()
+        os.replace(self.file + '.tmp',self.file)
+
+class DesignLibrary:
+
+    def __init__(self,file):
+        self.file = file
+        self.map = np.memmap(file,dtype=np.uint8,mode='r')
+        magic, version, self.flags, self.n, self.data_offset, strings_offset, records_offset = \
+            struct.unpack(HEADER_FORMAT,self.map[:HEADER_SIZE].tobytes())
+        if magic != LIBRARY_MAGIC or version != LIBRARY_VERSION:
+            raise ValueError("'%s' is not a version %d design library" % (file,LIBRARY_VERSION))
+        self.strings = json.loads(self.map[strings_offset:records_offset].tobytes().decode('utf-8'))
+        self.records = self.map[records_offset:records_offset+self.n*RECORD_DTYPE.itemsize].view(RECORD_DTYPE)
+
+    def __len__(self):
+        return self.n
+
+    def get_string(self,code):
+        return None if code == NO_STRING else self.strings[code]
+
+    def get_design(self,record):
+        length = int(record['length'])
+        offset = int(record['offset'])
+        data = self.map[offset:offset+get_packed_size(length,self.flags)].tobytes()
+        nseq = (5*length + 7) // 8
+        uid = record['uid'].tobytes().hex()
+        d = { 'uid': uid, 'shortuid': uid[0:N_SHORTUID_CHARS], 'seq': unpack_sequence(data[:nseq],length),
+              'parent': self.get_string(record['parent']), 'type': self.get_string(record['type']) }
+        if self.flags & FLAG_MASKS:
+            nmask = (length + 7) // 8
+            masks = np.unpackbits(np.frombuffer(data[nseq:],dtype=np.uint8))
+            d['mutmask'] = masks[:length].tolist()
+            d['varmask'] = masks[8*nmask:8*nmask+length].tolist()
+        return d
+
+    def __iter__(self):
+        # designs in file (export) order, the records of a chunk at a time
+        order = np.argsort(self.records['offset'],kind='stable')
+        for k in range(0,self.n,CHUNK):
+            for record in self.records[order[k:k+CHUNK]]:
+                yield self.get_design(record)
+
+    def find(self,shortuid):
+        # design of a shortuid (or uid), None if it is not in the library
+        try:
+            key = int(shortuid[0:16].ljust(16,'0'),16)
+        except ValueError:
+            return None
+        span = 1 << (4 * (16 - min(16,len(shortuid))))
+        lo = np.searchsorted(self.records['key'],key,side='left')
+        hi = np.searchsorted(self.records['key'],key + span - 1,side='right')
+        for k in range(lo,hi):
+            uid = self.records[k]['uid'].tobytes().hex()
+            if uid.startswith(shortuid):
+                return self.get_design(self.records[k])
+        return None
+
+def open_design_library(file):
+    return DesignLibrary(file)
+
+def is_design_library(file):
+    return file.endswith(LIBRARY_EXT)
+
+def export_library(designs,file,query=None,masks=False):
+    # writes the designs of a collection matching query to a packed library
+    projection = { 'uid': 1, 'seq': 1, 'parent': 1, 'type': 1 }
+    if masks:
+        projection.update({ 'mutmask': 1, 'varmask': 1 })
+    n = 0
+    with DesignLibraryWriter(file,masks=masks) as out:
+        for d in designs.find(query if query else {},projection):
+            out.add(d)
+            n += 1
+    return n
+
+def import_library(file,designs,batch=1000):
+    # inserts the designs of a packed library missing from a collection
+    n = 0
+    docs = []
+    for d in open_design_library(file):
+        docs.append(d)
+        if len(docs) >= batch:
+            n += insert_missing(designs,docs)
+            docs = []
+    if docs:
+        n += insert_missing(designs,docs)
+    return n
+
+def parse_args():
+    parser = ArgumentParser()
+
+    parser.add_argument("command", choices=['export','import','cat','get','info'],
+                        help="export designs to a library, import a library, print it as a dbfile, look up designs or show the header")
+    parser.add_argument("file", help="Packed design library (%s)" % LIBRARY_EXT)
+    parser.add_argument("shortuids", nargs='*', help="Designs to look up with get")
+    parser.add_argument("-t", "--type", dest="type", default='',
+                        help="Only export designs of this type")
+    parser.add_argument("-p", "--parent", dest="parent", default='',
+                        help="Only export designs derived from this parent uid")
+    parser.add_argument("--include_parent", dest="include_parent", default=False, action="store_true",
+                        help="Also export the parent")
+    parser.add_argument("--masks", dest="masks", default=False, action="store_true",
+                        help="Also store the mutation and variable masks")
+    parser.add_argument("--test", dest="test", default=False, action="store_true",
+                        help="Use test collections from MongoDB")
+
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    if args.command in ('export','import'):
+        designs = get_mongo_designs(test=args.test)
+    if args.command == 'export':
+        if args.parent:
+            args.parent = get_parent_uid(designs,args.parent)
+            if args.parent is None:
+                sys.stderr.write("CRITICAL: could not find parent entry\n")
+                sys.exit(1)
+        n = export_library(designs,args.file,get_filter_data(args),masks=args.masks)
+        print("%d designs exported to %s" % (n,args.file))
+    elif args.command == 'import':
+        ensure_design_indexes(designs)
+        print("%d designs imported from %s" % (import_library(args.file,designs),args.file))
+    elif args.command == 'cat':
+        for d in open_design_library(args.file):
+            sys.stdout.write("%s\t%s\n" % (d['shortuid'],d['seq']))
+    elif args.command == 'get':
+        lib = open_design_library(args.file)
+        for shortuid in args.shortuids:
+            d = lib.find(shortuid)
+            if d is None:
+                sys.stderr.write("WARNING: design '%s' not found\n" % shortuid)
+                continue
+            print(json.dumps(d))
+    else:
+        lib = open_design_library(args.file)
+        print(json.dumps({ 'designs': len(lib), 'masks': bool(lib.flags & FLAG_MASKS),
+                           'strings': len(lib.strings), 'size': os.path.getsize(args.file) }))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+from darpins import *
+import numpy as np
+
+try:
+    import levenshtein as Clevenshtein
+except:
+    pass
+
+# masked designs are kept as a 2-D uint8 array (designs x merged mask positions)
+# so a candidate can be compared against the whole library in one pass
+
+def build_projection_table(scheme=''):
+    # maps every byte to itself, or to the first residue of its alphabet group
+    table = np.arange(256,dtype=np.uint8)
+    if scheme:
+        for r,g in REVERSED_ALPHABETS[scheme].items():
+            first = ord(ALPHABETS[scheme][g][0])
+            table[ord(r)] = first
+            table[ord(r.lower())] = first
+    return table
+
+def levenshtein_many(a,rows,max_d=0,chunk=1<<16):
+    # edit distances from a (1-D uint8) to every row of rows (2-D uint8), one
+    # DP row at a time across all library rows; the insertion step is a
+    # running minimum of (cell - j) + j. Rows whose whole DP row reached max_d
+    # are dropped, their distance is reported as max_d (max_d == 0: exact)
+    n = len(a)
+    N, m = rows.shape
+    if max_d == 0: max_d = n + m + 1
+    res = np.full(N,max_d,dtype=np.int64)
+    j = np.arange(m+1,dtype=np.int32)
+    for start in range(0,N,chunk):
+        active = np.arange(start,min(N,start+chunk))
+        sub = np.asarray(rows[start:start+chunk])
+        prev = np.tile(np.minimum(j,max_d),(len(sub),1))
+        for i in range(1,n+1):
+            temp = np.empty_like(prev)
+            temp[:,0] = i
+            np.minimum(prev[:,1:]+1,prev[:,:-1]+(sub != a[i-1]),out=temp[:,1:])
+            prev = np.minimum.accumulate(temp-j,axis=1) + j
+            np.minimum(prev,max_d,out=prev)
+            alive = prev.min(axis=1) < max_d
+            if not alive.all():
+                active = active[alive]
+                sub = sub[alive]
+                prev = prev[alive]
+                if len(active) == 0: break
+        if len(active):
+            res[active] = prev[:,m]
+    return res
+
+def get_levenshtein_backend(backend=''):
+    # 'c' needs the compiled _levenshtein.so, 'numpy' works everywhere
+    if backend: return backend
+    try:
+        Clevenshtein.min_distance_buffer
+        return 'c'
+    except:
+        return 'numpy'
+
+def distance_many(a,rows,metric='hamming',backend='',max_d=0):
+    # distances from a to every row, capped at max_d when given
+    if len(rows) == 0:
+        return np.zeros(0,dtype=np.int64)
+    if metric == 'hamming':
+        dists = np.count_nonzero(rows != a,axis=1)
+        return np.minimum(dists,max_d) if max_d else dists
+    if get_levenshtein_backend(backend) == 'numpy':
+        return levenshtein_many(a,rows,max_d)
+    sa = a.tobytes().decode('ascii')
+    if not max_d: max_d = len(a) + rows.shape[1] + 1
+    return np.array([ Clevenshtein.levenshtein_bounded(sa,len(a),b.tobytes().decode('ascii'),
+                                                        len(b),max_d) for b in rows ],dtype=np.int64)
+
+def get_mask_indexes(mask):
+    return np.flatnonzero(np.asarray(mask,dtype=np.uint8))
+
+class DivergenceLibrary:
+
+    def __init__(self,mask,scheme='',capacity=1024,metric='hamming',backend=''):
+        # metric is 'hamming' or 'levenshtein'; levenshtein distances run on
+        # the C kernel or on numpy (backend 'c' or 'numpy', default: c if built)
+        self.metric = metric
+        self.backend = get_levenshtein_backend(backend) if metric == 'levenshtein' else ''
+        self.indexes = get_mask_indexes(mask)
+        self.width = len(self.indexes)
+        self.scheme = scheme
+        self.table = build_projection_table(scheme)
+        self.seqs = np.zeros((max(capacity,1),self.width),dtype=np.uint8)
+        self.uids = []
+        self.size = 0
+        # optional read-only segment (e.g. a memory-mapped index) scanned
+        # before the in-memory rows; its uids are raw 28-byte sha224 digests
+        self.base = np.zeros((0,self.width),dtype=np.uint8)
+        self.base_uids = np.zeros((0,28),dtype=np.uint8)
+        # optional metric index mirroring every row (see use_pivots)
+        self.pivots = None
+        self.npivots = 0
+
+    def __len__(self):
+        return len(self.base) + self.size
+
+    def set_base(self,seqs,uids):
+        # in-memory rows that the new base now contains are dropped; a base
+        # that does not extend the previous one (e.g. a rebuilt index) is
+        # taken as a whole, pivots included
+        nold = len(self.base)
+        if len(uids) < nold or not np.array_equal(uids[:nold],self.base_uids):
+            nold = 0
+        added = set([ u.tobytes().hex() for u in uids[nold:] ])
+        if self.pivots is not None:
+            if nold:
+                self.pivots.add(seqs[nold:],[ u.tobytes().hex() for u in uids[nold:] ])
+            else:
+                self.pivots = None
+        self.base = seqs
+        self.base_uids = uids
+        keep = [ k for k in range(self.size) if self.uids[k] not in added ]
+        if len(keep) < self.size:
+            self.seqs[:len(keep)] = self.seqs[keep]
+            self.uids = [ self.uids[k] for k in keep ]
+            self.size = len(keep)
+        if self.pivots is None and nold == 0 and self.npivots:
+            self.use_pivots(self.npivots)
+
+    def use_pivots(self,npivots):
+        # divergence and nearest queries go through a PivotIndex; rows that
+        # move from the in-memory part to the base stay indexed twice, which
+        # does not change any answer
+        from metricindex import PivotIndex
+        self.npivots = npivots
+        self.pivots = PivotIndex(self.width,metric=self.metric,backend=self.backend,
+                                 npivots=npivots)
+        for seqs, uids in ((self.base,[ u.tobytes().hex() for u in self.base_uids ]),
+                           (self.rows(),self.uids)):
+            if len(seqs): self.pivots.add(seqs,uids)
+
+    def get_uid(self,k):
+        if k < len(self.base):
+            return self.base_uids[k].tobytes().hex()
+        return self.uids[k-len(self.base)]
+
+    def encode(self,seq):
+        # full length sequence (str or list of chars) -> masked, projected row
+        s = np.frombuffer(bytes(''.join(seq),'ascii'),dtype=np.uint8)
+        return self.table[s[self.indexes]]
+
+    def encode_masked(self,seq):
+        # already masked sequence (str or list of chars) -> projected row
+        return self.table[np.frombuffer(bytes(''.join(seq),'ascii'),dtype=np.uint8)]
+
+    def reserve(self,n):
+        if n <= self.seqs.shape[0]: return
+        capacity = self.seqs.shape[0]
+        while capacity < n:
+            capacity *= 2
+        seqs = np.zeros((capacity,self.width),dtype=np.uint8)
+        seqs[:self.size] = self.seqs[:self.size]
+        self.seqs = seqs
+
+    def append_row(self,row,uid):
+        self.reserve(self.size+1)
+        self.seqs[self.size] = row
+        self.uids.append(uid)
+        self.size += 1
+        if self.pivots is not None:
+            self.pivots.add(row,[ uid ])
+
+    def append(self,seq,uid):
+        self.append_row(self.encode(seq),uid)
+
+    def extend_rows(self,rows,uids):
+        rows = np.asarray(rows,dtype=np.uint8).reshape(-1,self.width)
+        self.reserve(self.size+len(rows))
+        self.seqs[self.size:self.size+len(rows)] = self.table[rows]
+        if self.pivots is not None:
+            self.pivots.add(self.seqs[self.size:self.size+len(rows)],uids)
+        self.uids.extend(uids)
+        self.size += len(rows)
+
+    def rows(self):
+        return self.seqs[:self.size]
+
+    def segments(self):
+        return [ seqs for seqs in (self.base,self.rows()) if len(seqs) ]
+
+    def take(self,ks):
+        # rows at positions ks of distances(), base rows first
+        ks = np.asarray(ks,dtype=np.int64)
+        nbase = len(self.base)
+        res = np.zeros((len(ks),self.width),dtype=np.uint8)
+        inbase = ks < nbase
+        res[inbase] = self.base[ks[inbase]]
+        res[~inbase] = self.seqs[ks[~inbase]-nbase]
+        return res
+
+    def min_levenshtein(self,row,min_t):
+        # smallest edit distance, exact below min_t (or everywhere if min_t == 0)
+        a = row.tobytes().decode('ascii')
+        min_l = None
+        for seqs in self.segments():
+            if self.backend == 'numpy':
+                l = int(levenshtein_many(row,seqs,min_t).min())
+            else:
+                l = Clevenshtein.min_distance_buffer(a,seqs,self.width,min_t,True)
+            if min_l is None or l < min_l: min_l = l
+            if min_t and min_l < min_t: break
+        return self.width if min_l is None else min_l
+
+    def distances(self,row):
+        # distance from a masked row to every design of the library
+        return np.concatenate([ np.zeros(0,dtype=np.int64) ] +
+                              [ distance_many(row,seqs,self.metric,self.backend)
+                                for seqs in self.segments() ])
+
+    def nearest(self,row):
+        # returns (minimum distance, uid of the nearest design)
+        if len(self) == 0:
+            return self.width, None
+        if self.pivots is not None:
+            return self.pivots.nearest(row)[0]
+        dists = self.distances(row)
+        k = int(np.argmin(dists))
+        return int(dists[k]), self.get_uid(k)
+
+    def divergent_rows(self,rows,min_t,max_bytes=1<<26):
+        # boolean mask of the candidate rows at distance >= min_t from every
+        # design; candidates are compared in chunks to bound temporary memory
+        ok = np.ones(len(rows),dtype=bool)
+        if min_t == 0 or len(self) == 0:
+            return ok
+        if self.pivots is not None:
+            for k in range(len(rows)):
+                ok[k] = self.pivots.within(rows[k],min_t)[0] is None
+            return ok
+        if self.metric == 'levenshtein':
+            for k in range(len(rows)):
+                ok[k] = self.min_levenshtein(rows[k],min_t) >= min_t
+            return ok
+        chunk = max(1,max_bytes // max(1,len(self)*self.width))
+        for seqs in (self.base,self.rows()):
+            if len(seqs) == 0: continue
+            for k in range(0,len(rows),chunk):
+                sub = rows[k:k+chunk]
+                dists = np.count_nonzero(seqs[None,:,:] != sub[:,None,:],axis=2)
+                ok[k:k+chunk] &= dists.min(axis=1) >= min_t
+        return ok
+
+    def is_divergent(self,row,min_t):
+        if min_t == 0 or len(self) == 0:
+            return True
+        if self.pivots is not None:
+            return self.pivots.within(row,min_t)[0] is None
+        if self.metric == 'levenshtein':
+            return self.min_levenshtein(row,min_t) >= min_t
+        return bool(self.distances(row).min() >= min_t)
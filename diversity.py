@@ -0,0 +1,193 @@
+from darpins import *
+from divergence import distance_many, build_projection_table, get_mask_indexes
+from argparse import ArgumentParser
+import multiprocessing
+import json
+import numpy as np
+
+# all-pairs distances over a design library, written as a condensed matrix
+# (upper triangle, row by row, like scipy's pdist) to a memory-mapped file in
+# datadir; blocks of rows x columns are computed by a pool of workers that
+# write straight into the file, so the matrix never sits in memory
+
+def parse_args():
+    parser = ArgumentParser()
+
+    parser.add_argument("-t", "--type", dest="type", default='',
+                        help="Only use designs of this type")
+    parser.add_argument("-p", "--parent", dest="parent", default='',
+                        help="Only use designs derived from this parent uid")
+    parser.add_argument("--include_parent", dest="include_parent", default=False, action="store_true",
+                        help="Also include the parent in the library")
+    parser.add_argument("--dbfile", dest="dbfile", default='',
+                        help="Read designs from a tsv file instead of MongoDB")
+    parser.add_argument("--test", dest="test", default=False, action="store_true",
+                        help="Use test collections from MongoDB")
+
+    parser.add_argument("-m", "--mapfile", dest="mapfile", default='',
+                      help="Masking file to restrict distances to some positions")
+    parser.add_argument("-v", "--variable", nargs='+', dest="variable", default=['variable'],
+                        help="Apply variable masking positions defined from mapfile")
+    parser.add_argument("-f", "--fixed", nargs='+', dest="fixed", default=['back_res','below_res'],
+                        help="Apply fixed masking positions defined from mapfile")
+    parser.add_argument("--alphabet_scheme", dest="alphabet_scheme", default='',
+                        help="Compare residues by group of a reduced alphabet")
+
+    parser.add_argument("--levenshtein", dest="metric", default='hamming', action="store_const",
+                        const='levenshtein', help="Use levenshtein instead of hamming distances")
+    parser.add_argument("--lev_python", dest="lev_python", default=False, action="store_true",
+                      help="Use numpy version of the levenshtein implementation")
+    parser.add_argument("-w", "--workers", dest="workers", default=1, type=int,
+                        help="Number of worker processes")
+    parser.add_argument("-b", "--block", dest="block", default=256, type=int,
+                        help="Number of rows and columns computed by a task")
+    parser.add_argument("-o", "--output", dest="output", default='diversity',
+                        help="Prefix of the output files in datadir")
+
+    return parser.parse_args()
+
+def get_library_mask(seq,args):
+    if not args.mapfile:
+        return [ 1 for c in seq ]
+    masks = read_masks_from_file(args.mapfile)
+    merged = [ 0 for c in seq ]
+    for name in args.variable + args.fixed:
+        if name not in masks or len(masks[name]) != len(seq):
+            sys.stderr.write("CRITICAL: mask '%s' does not match the library\n" % name)
+            sys.exit(1)
+    for name in args.variable:
+        merged = [ 1 if m else v for m,v in zip(masks[name],merged) ]
+    for name in args.fixed:
+        merged = [ 0 if m else v for m,v in zip(masks[name],merged) ]
+    return merged
+
+def load_library(args):
+    if args.dbfile:
+        designs = get_designs_from_dbfile(args.dbfile)
+    else:
+        coll = get_mongo_designs(test=args.test)
+        if args.parent:
+            args.parent = get_parent_uid(coll,args.parent)
+            if args.parent is None:
+                sys.stderr.write("CRITICAL: could not find parent entry\n")
+                sys.exit(1)
+        designs = coll.find(get_filter_data(args),{ 'shortuid': 1, 'seq': 1 }).sort([("uid", ASCENDING)])
+    shortuids = []
+    seqs = []
+    for d in designs:
+        shortuids.append(d['shortuid'])
+        seqs.append(bytes(d['seq'],'ascii'))
+    if not seqs:
+        sys.stderr.write("CRITICAL: no designs match the filters\n")
+        sys.exit(1)
+    if len(set([ len(s) for s in seqs ])) > 1:
+        sys.stderr.write("CRITICAL: designs do not all have the same length\n")
+        sys.exit(1)
+    mask = get_library_mask(seqs[0].decode('ascii'),args)
+    table = build_projection_table(args.alphabet_scheme)
+    rows = np.frombuffer(b''.join(seqs),dtype=np.uint8).reshape(len(seqs),-1)
+    return shortuids, table[rows[:,get_mask_indexes(mask)]]
+
+def get_condensed_index(n,i,j):
+    # position of (i,j), i < j, in the condensed matrix
+    return i*n - i*(i+1)//2 + (j - i - 1)
+
+def get_blocks(n,block):
+    for i0 in range(0,n,block):
+        for j0 in range(i0,n,block):
+            yield i0, min(n,i0+block), j0, min(n,j0+block)
+
+worker = {}
+
+def init_worker(seqfile,distfile,n,width,dtype,metric,backend):
+    worker['seqs'] = np.memmap(seqfile,dtype=np.uint8,mode='r',shape=(n,width))
+    worker['dists'] = np.memmap(distfile,dtype=dtype,mode='r+',shape=(n*(n-1)//2,))
+    worker.update({ 'n': n, 'width': width, 'metric': metric, 'backend': backend })
+
+def compute_block(blk):
+    # writes the distances of one block to the condensed matrix; returns the
+    # histogram of the block and the nearest design of its rows and columns
+    i0, i1, j0, j1 = blk
+    seqs = worker['seqs']
+    n = worker['n']
+    a = np.asarray(seqs[i0:i1])
+    b = np.asarray(seqs[j0:j1])
+    if worker['metric'] == 'hamming':
+        d = np.count_nonzero(a[:,None,:] != b[None,:,:],axis=2)
+    else:
+        d = np.stack([ distance_many(row,b,worker['metric'],worker['backend']) for row in a ])
+    dists = worker['dists']
+    hist = np.zeros(worker['width']+1,dtype=np.int64)
+    for k in range(i1-i0):
+        i = i0 + k
+        start = max(j0,i+1)
+        if start >= j1: continue
+        pos = get_condensed_index(n,i,start)
+        dists[pos:pos+j1-start] = d[k,start-j0:]
+        hist += np.bincount(d[k,start-j0:],minlength=len(hist))
+    if i0 == j0:
+        # a design is not its own neighbour
+        np.fill_diagonal(d,np.iinfo(np.int64).max)
+        d[np.tril_indices(i1-i0,-1)] = np.iinfo(np.int64).max
+        d = np.minimum(d,d.T)
+    rowk = np.argmin(d,axis=1)
+    colk = np.argmin(d,axis=0)
+    return blk, hist, d[np.arange(i1-i0),rowk], rowk + j0, d[colk,np.arange(j1-j0)], colk + i0
+
+def main():
+    args = parse_args()
+    print(args)
+    shortuids, rows = load_library(args)
+    n, width = rows.shape
+    if n < 2:
+        sys.stderr.write("CRITICAL: need at least two designs\n")
+        sys.exit(1)
+    dtype = np.uint8 if width <= np.iinfo(np.uint8).max else np.uint16
+    backend = 'numpy' if args.lev_python else ''
+    prefix = os.path.join(datadir,args.output)
+    seqfile = prefix + '.seqs'
+    distfile = prefix + '.dist'
+    rows.tofile(seqfile)
+    np.memmap(distfile,dtype=dtype,mode='w+',shape=(n*(n-1)//2,)).flush()
+    print("computing %d distances over %d positions..." % (n*(n-1)//2,width))
+
+    hist = np.zeros(width+1,dtype=np.int64)
+    mind = np.full(n,np.iinfo(np.int64).max,dtype=np.int64)
+    nearest = np.zeros(n,dtype=np.int64)
+    def merge(lo,vals,ks):
+        better = vals < mind[lo:lo+len(vals)]
+        mind[lo:lo+len(vals)][better] = vals[better]
+        nearest[lo:lo+len(vals)][better] = ks[better]
+
+    initargs = (seqfile,distfile,n,width,dtype,args.metric,backend)
+    blocks = list(get_blocks(n,args.block))
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers,initializer=init_worker,initargs=initargs)
+        results = pool.imap_unordered(compute_block,blocks)
+    else:
+        init_worker(*initargs)
+        results = map(compute_block,blocks)
+    for k, (blk, bhist, rmin, rk, cmin, ck) in enumerate(results):
+        hist += bhist
+        merge(blk[0],rmin,rk)
+        merge(blk[2],cmin,ck)
+        if (k+1) % 1000 == 0:
+            print("%d/%d blocks" % (k+1,len(blocks)))
+    if args.workers > 1:
+        pool.close()
+        pool.join()
+
+    with open(prefix + '.min.tsv','w') as out:
+        for i in range(n):
+            out.write("%s\t%d\t%s\n" % (shortuids[i],mind[i],shortuids[nearest[i]]))
+    npairs = int(hist.sum())
+    summary = { 'ndesigns': n, 'npairs': npairs, 'width': width, 'metric': args.metric,
+                'alphabet_scheme': args.alphabet_scheme, 'dtype': np.dtype(dtype).name,
+                'distfile': distfile, 'histogram': hist.tolist(),
+                'mean': float((hist * np.arange(width+1)).sum() / npairs),
+                'min_histogram': np.bincount(mind,minlength=width+1).tolist() }
+    json.dump(summary,open(prefix + '.json','w'),indent=1)
+    print("distance matrix written to %s" % distfile)
+
+if __name__ == '__main__':
+    main()
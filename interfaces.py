@@ -0,0 +1,239 @@
+from darpins import *
+from tailreader import TailReader
+from argparse import ArgumentParser
+import numpy as np
+
+# interface residues (sites) or contacts of every docked pose as fixed-width
+# bitsets: each target numbers the (mol, residue) pairs it has seen, so the
+# rows of different mols share one numbering, and a (pose, mol) is a row of
+# uint64 words with the bits of its residues set. Overlap and Jaccard queries
+# are then popcounts over the whole words matrix; without a mol, the rows of
+# one pose are merged into its set of (mol, residue) pairs. The
+# index follows its file like the other tail readers, refresh() adds the new
+# lines.
+WORD_BITS = 64
+POPCOUNT_TABLE = np.array([ bin(i).count('1') for i in range(256) ],dtype=np.uint8)
+
+def popcount(words):
+    # number of bits set in every row of a 2-D uint64 array
+    if hasattr(np,'bitwise_count'):
+        return np.bitwise_count(words).sum(axis=-1,dtype=np.int64)
+    return POPCOUNT_TABLE[words.view(np.uint8)].sum(axis=-1,dtype=np.int64)
+
+def get_jaccard(words,ref):
+    # Jaccard index of every row of words with the bitset ref (0 for two empty sets)
+    inter = popcount(words & ref)
+    union = popcount(words | ref)
+    return np.where(union > 0,inter / np.maximum(union,1),0.0)
+
+class InterfaceIndex(TailReader):
+
+    def clear(self):
+        self.names = { 'design': [], 'target': [], 'mol': [] }
+        self.ids = { 'design': {}, 'target': {}, 'mol': {} }
+        # target -> { (mol, residue): bit }
+        self.residues = {}
+        self.keys = {}
+        self.cols = { 'design': [], 'target': [], 'top': [], 'mol': [] }
+        self.bits = []
+        self.dirty = set()
+        self.words = np.zeros((0,1),dtype=np.uint64)
+        self.arrays = { k: np.zeros(0,dtype=np.int64) for k in self.cols }
+
+    def get_id(self,kind,name):
+        ids = self.ids[kind]
+        if name not in ids:
+            ids[name] = len(ids)
+            self.names[kind].append(name)
+        return ids[name]
+
+    def get_bits(self,target,mol,residues):
+        vocab = self.residues.setdefault(target,{})
+        return [ vocab.setdefault((mol,r),len(vocab)) for r in residues if r ]
+
+    def add_pose(self,design,target,top,mol,residues):
+        # a pose seen again replaces the previous one, like the dict readers
+        key = (design,target,top,mol)
+        bits = self.get_bits(target,mol,residues)
+        if key in self.keys:
+            row = self.keys[key]
+            self.bits[row] = bits
+        else:
+            row = len(self.bits)
+            self.keys[key] = row
+            self.cols['design'].append(self.get_id('design',design))
+            self.cols['target'].append(self.get_id('target',target))
+            self.cols['top'].append(top)
+            self.cols['mol'].append(self.get_id('mol',mol))
+            self.bits.append(bits)
+        self.dirty.add(row)
+
+    def get_width(self):
+        nbits = max([ len(v) for v in self.residues.values() ] + [1])
+        return (nbits + WORD_BITS - 1) // WORD_BITS
+
+    def get_words(self):
+        # packs the poses added or changed since the last query
+        if self.dirty:
+            n = len(self.bits)
+            width = self.get_width()
+            words = np.zeros((n,width),dtype=np.uint64)
+            old = self.words[:min(n,len(self.words))]
+            words[:len(old),:old.shape[1]] = old
+            rows = np.array(sorted(self.dirty),dtype=np.int64)
+            words[rows] = 0
+            pairs = [ (row,bit) for row in rows for bit in self.bits[row] ]
+            if pairs:
+                pairs = np.array(pairs,dtype=np.int64)
+                np.bitwise_or.at(words,(pairs[:,0],pairs[:,1] // WORD_BITS),
+                                 np.uint64(1) << (pairs[:,1] % WORD_BITS).astype(np.uint64))
+            self.words = words
+            self.arrays = { k: np.array(v,dtype=np.int64) for k, v in self.cols.items() }
+            self.dirty = set()
+        return self.words
+
+    def select(self,target,mol=None,tops=None,designs=None):
+        # rows of the poses of a target (and mol, tops, designs)
+        self.get_words()
+        sel = self.arrays['target'] == self.ids['target'].get(target,-1)
+        if mol is not None:
+            sel &= self.arrays['mol'] == self.ids['mol'].get(mol,-1)
+        if tops is not None:
+            sel &= np.isin(self.arrays['top'],tops)
+        if designs is not None:
+            sel &= np.isin(self.arrays['design'],[ self.ids['design'].get(d,-1) for d in designs ])
+        return np.flatnonzero(sel)
+
+    def get_bitset(self,target,mol,residues):
+        # bitset of any residue list of mol, in the numbering of target; the
+        # residues of no pose have no bit and are left out, the index is not
+        # changed by a query
+        vocab = self.residues.get(target,{})
+        bits = [ vocab[(mol,r)] for r in residues if vocab.get((mol,r)) is not None ]
+        words = self.get_words()
+        ref = np.zeros(words.shape[1],dtype=np.uint64)
+        for bit in bits:
+            ref[bit // WORD_BITS] |= np.uint64(1) << np.uint64(bit % WORD_BITS)
+        return ref
+
+    def get_union(self,rows):
+        words = self.get_words()
+        if len(rows) == 0:
+            return np.zeros(words.shape[1],dtype=np.uint64)
+        return np.bitwise_or.reduce(words[rows],axis=0)
+
+    def jaccard(self,rows,ref):
+        return get_jaccard(self.get_words()[rows],ref)
+
+    def get_poses(self,rows,mol=None):
+        # (rows, words) of the selected rows; without a mol, one row per pose
+        # (design, top) with the words of all its mols
+        words = self.get_words()[rows]
+        if mol is not None or len(rows) == 0:
+            return rows, words
+        order = np.lexsort((self.arrays['top'][rows],self.arrays['design'][rows]))
+        rows, words = rows[order], words[order]
+        designs, tops = self.arrays['design'][rows], self.arrays['top'][rows]
+        first = np.flatnonzero(np.r_[True,(np.diff(designs) != 0) | (np.diff(tops) != 0)])
+        return rows[first], np.bitwise_or.reduceat(words,first,axis=0)
+
+    def overlap(self,ref,target,mol=None,tops=None,min_jaccard=0.0):
+        # best pose of every design by Jaccard index with ref, as
+        # (design, top, jaccard) sorted from the best, at least min_jaccard
+        rows = self.select(target,mol=mol,tops=tops)
+        if len(rows) == 0: return []
+        rows, words = self.get_poses(rows,mol)
+        jac = get_jaccard(words,ref)
+        order = np.lexsort((-jac,self.arrays['design'][rows]))
+        rows, jac = rows[order], jac[order]
+        first = np.flatnonzero(np.r_[True,np.diff(self.arrays['design'][rows]) != 0])
+        rows, jac = rows[first], jac[first]
+        keep = jac >= min_jaccard
+        rows, jac = rows[keep], jac[keep]
+        best = np.argsort(-jac,kind='stable')
+        return [ (self.names['design'][self.arrays['design'][r]],int(self.arrays['top'][r]),float(j))
+                 for r, j in zip(rows[best],jac[best]) ]
+
+    def get_control_designs(self,name):
+        # controls of a target name that were docked, by shortuid or pdb chain
+        return [ d for d in CONTROLS.get(name,[]) + CONTROL_PDBS.get(name,[]) if d in self.ids['design'] ]
+
+    def control_overlap(self,name,min_jaccard=0.0,tops=None,control_tops=None,mol=None):
+        # for every target pdb of <name>: designs whose poses (in tops) overlap
+        # the epitope of the controls (union of their poses in control_tops)
+        controls = self.get_control_designs(name)
+        res = {}
+        for target in TARGET_PDBS.get(name,[]):
+            ref = self.get_union(self.select(target,mol=mol,tops=control_tops,designs=controls))
+            if not ref.any(): continue
+            res[target] = [ r for r in self.overlap(ref,target,mol=mol,tops=tops,min_jaccard=min_jaccard)
+                            if r[0] not in controls ]
+        return res
+
+    def cluster(self,target,mol=None,tops=None,threshold=0.5):
+        # leader clustering: the first pose not clustered yet takes every
+        # remaining pose with Jaccard >= threshold; returns (rows, labels)
+        rows = self.select(target,mol=mol,tops=tops)
+        words = self.get_words()[rows]
+        labels = np.full(len(rows),-1,dtype=np.int64)
+        nclusters = 0
+        for k in range(len(rows)):
+            if labels[k] >= 0: continue
+            left = np.flatnonzero(labels < 0)
+            members = left[get_jaccard(words[left],words[k]) >= threshold]
+            labels[members] = nclusters
+            labels[k] = nclusters
+            nclusters += 1
+        return rows, labels
+
+    def get_pose(self,row):
+        return (self.names['design'][self.cols['design'][row]],self.names['target'][self.cols['target'][row]],
+                self.cols['top'][row],self.names['mol'][self.cols['mol'][row]])
+
+class SitesIndex(InterfaceIndex):
+
+    def parse_line(self,line):
+        design, target, mol, top, ir = split_sites_line(line)
+        self.add_pose(design,target,top,mol,ir)
+
+class ContactsIndex(InterfaceIndex):
+
+    def parse_line(self,line):
+        design, target, top, conts = split_contacts_line(line)
+        self.add_pose(design,target,top,'',conts)
+
+def open_interface_index(file):
+    index = ContactsIndex(file) if file.endswith('.contacts') else SitesIndex(file)
+    index.refresh()
+    return index
+
+def parse_args():
+    parser = ArgumentParser()
+
+    parser.add_argument("file", help="Sites or contacts file")
+    parser.add_argument("-c", "--controls", dest="controls", default='BCL2L2',
+                        help="Target name whose CONTROLS/CONTROL_PDBS define the epitope")
+    parser.add_argument("-j", "--min_jaccard", dest="min_jaccard", default=0.3, type=float,
+                        help="Only report designs overlapping the epitope by at least <x>")
+    parser.add_argument("--tops", nargs='+', dest="tops", default=None, type=int,
+                        help="Only consider these poses of the designs")
+    parser.add_argument("--control_tops", nargs='+', dest="control_tops", default=None, type=int,
+                        help="Only build the epitope from these poses of the controls")
+    parser.add_argument("--mol", dest="mol", default=None,
+                        help="Only consider the residues of this molecule")
+
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    index = open_interface_index(args.file)
+    res = index.control_overlap(args.controls,min_jaccard=args.min_jaccard,tops=args.tops,
+                                control_tops=args.control_tops,mol=args.mol)
+    if not res:
+        sys.stderr.write("WARNING: no docked control of '%s' found\n" % args.controls)
+    for target in res:
+        for design, top, jac in res[target]:
+            print("%s\t%s\t%d\t%.3f" % (design,target,top,jac))
+
+if __name__ == '__main__':
+    main()
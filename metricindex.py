@@ -0,0 +1,114 @@
+from darpins import *
+from divergence import distance_many
+import numpy as np
+
+# pivot table over masked, alphabet-projected sequences: the distances of every
+# design to a few pivot designs give, by the triangle inequality, the lower
+# bound max_p |d(q,p) - d(r,p)| on d(q,r), so only the designs whose bound is
+# small enough need an actual distance computation. Works for any metric
+# (hamming or levenshtein), designs can be added at any time.
+
+class PivotIndex:
+
+    def __init__(self,width,metric='hamming',backend='',npivots=16,capacity=1024):
+        self.width = width
+        self.metric = metric
+        self.backend = backend
+        self.npivots = npivots
+        self.seqs = np.zeros((max(capacity,1),width),dtype=np.uint8)
+        self.table = np.zeros((max(capacity,1),npivots),dtype=np.int32)
+        self.uids = []
+        self.size = 0
+        self.pivots = None
+        self.ncomputed = 0
+
+    def __len__(self):
+        return self.size
+
+    def distances(self,a,rows,max_d=0):
+        self.ncomputed += len(rows)
+        return distance_many(a,rows,self.metric,self.backend,max_d)
+
+    def reserve(self,n):
+        if n <= self.seqs.shape[0]: return
+        capacity = self.seqs.shape[0]
+        while capacity < n:
+            capacity *= 2
+        seqs = np.zeros((capacity,self.width),dtype=np.uint8)
+        seqs[:self.size] = self.seqs[:self.size]
+        table = np.zeros((capacity,self.npivots),dtype=np.int32)
+        table[:self.size] = self.table[:self.size]
+        self.seqs = seqs
+        self.table = table
+
+    def add(self,rows,uids):
+        rows = np.asarray(rows,dtype=np.uint8).reshape(-1,self.width)
+        n = len(rows)
+        self.reserve(self.size+n)
+        self.seqs[self.size:self.size+n] = rows
+        self.uids.extend(uids)
+        if self.pivots is not None:
+            for p in range(len(self.pivots)):
+                self.table[self.size:self.size+n,p] = self.distances(self.pivots[p],rows)
+        self.size += n
+        if self.pivots is None and self.size >= 4*self.npivots:
+            self.select_pivots()
+
+    def select_pivots(self):
+        # farthest-first traversal, starting from the first design
+        seqs = self.seqs[:self.size]
+        chosen = [ 0 ]
+        dists = [ self.distances(seqs[0],seqs) ]
+        mind = dists[0].copy()
+        while len(chosen) < self.npivots:
+            k = int(np.argmax(mind))
+            if mind[k] == 0: break
+            chosen.append(k)
+            dists.append(self.distances(seqs[k],seqs))
+            np.minimum(mind,dists[-1],out=mind)
+        self.npivots = len(chosen)
+        self.table = self.table[:,:self.npivots].copy()
+        self.table[:self.size] = np.stack(dists,axis=1)
+        self.pivots = seqs[chosen].copy()
+
+    def lower_bounds(self,a):
+        dq = self.distances(a,self.pivots).astype(np.int32)
+        return np.abs(self.table[:self.size] - dq).max(axis=1)
+
+    def within(self,a,k):
+        # (distance, uid) of a design closer than k to a, (None, None) otherwise
+        if self.size == 0 or k == 0:
+            return None, None
+        if self.pivots is None:
+            cand = np.arange(self.size)
+        else:
+            cand = np.flatnonzero(self.lower_bounds(a) < k)
+            if len(cand) == 0:
+                return None, None
+        dists = self.distances(a,self.seqs[cand],k)
+        j = int(np.argmin(dists))
+        if dists[j] < k:
+            return int(dists[j]), self.uids[cand[j]]
+        return None, None
+
+    def nearest(self,a,n=1,chunk=256):
+        # the n nearest designs as (distance, uid), closest first; designs are
+        # visited by increasing lower bound until no bound can beat the n-th
+        if self.size == 0:
+            return []
+        if self.pivots is None:
+            dists = self.distances(a,self.seqs[:self.size])
+            order = np.argsort(dists,kind='stable')[:n]
+            return [ (int(dists[k]),self.uids[k]) for k in order ]
+        lb = self.lower_bounds(a)
+        order = np.argsort(lb,kind='stable')
+        best = []
+        for start in range(0,self.size,chunk):
+            if len(best) >= n and best[n-1][0] <= lb[order[start]]:
+                break
+            cand = order[start:start+chunk]
+            dists = self.distances(a,self.seqs[cand])
+            best.extend([ (int(d),int(k)) for d,k in zip(dists,cand) ])
+            best.sort()
+            best = best[:n]
+        return [ (d,self.uids[k]) for d,k in best ]
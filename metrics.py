@@ -0,0 +1,134 @@
+from darpins import *
+import collections
+import contextlib
+import json
+import time
+
+# counters, phase timers and latency histograms of a design run. They are
+# always collected (a timer is two perf_counter calls); with a file, poll()
+# writes a snapshot at most every <interval> seconds: one JSON object per line
+# appended, or the Prometheus text format (replaced) for a '.prom' file, e.g.
+# for the node exporter textfile collector.
+LATENCY_BUCKETS = (0.001,0.005,0.01,0.05,0.1,0.5,1.0,5.0,float('inf'))
+PROMETHEUS_EXT = '.prom'
+PROMETHEUS_PREFIX = 'darpins_'
+
+class Metrics:
+
+    def __init__(self,file='',interval=10.0):
+        self.file = file
+        self.interval = interval
+        self.counters = collections.Counter()
+        self.gauges = {}
+        # name -> [calls, seconds]
+        self.timers = {}
+        # name -> [count per bucket, count, sum]
+        self.histograms = {}
+        self.start = time.time()
+        self.last = self.start
+
+    def add(self,name,n=1):
+        self.counters[name] += n
+
+    def set(self,name,value):
+        self.gauges[name] = value
+
+    def observe(self,name,seconds,histogram=False):
+        timer = self.timers.setdefault(name,[0,0.0])
+        timer[0] += 1
+        timer[1] += seconds
+        if histogram:
+            h = self.histograms.setdefault(name,[[0]*len(LATENCY_BUCKETS),0,0.0])
+            for k, le in enumerate(LATENCY_BUCKETS):
+                if seconds <= le:
+                    h[0][k] += 1
+                    break
+            h[1] += 1
+            h[2] += seconds
+
+    @contextlib.contextmanager
+    def timer(self,name,histogram=False):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name,time.perf_counter() - t0,histogram=histogram)
+
+    def snapshot(self):
+        now = time.time()
+        scanned = self.counters['scanned']
+        return { 'time': now, 'elapsed': now - self.start, 'pid': os.getpid(),
+                 'counters': dict(self.counters), 'gauges': dict(self.gauges),
+                 'acceptance_rate': self.counters['accepted'] / scanned if scanned else 0.0,
+                 'timers': { k: { 'calls': v[0], 'seconds': v[1] } for k, v in self.timers.items() },
+                 'histograms': { k: { 'buckets': get_cumulative_buckets(v[0]), 'count': v[1], 'sum': v[2] }
+                                 for k, v in self.histograms.items() } }
+
+    def write(self):
+        self.last = time.time()
+        if not self.file: return
+        data = self.snapshot()
+        if self.file.endswith(PROMETHEUS_EXT):
+            tmpfile = '%s.%d.tmp' % (self.file,os.getpid())
+            with open(tmpfile,'w') as out:
+                out.write(format_prometheus(data))
+            os.replace(tmpfile,self.file)
+        else:
+            append_lines_to_file(self.file,[ json.dumps(data) + '\n' ])
+
+    def poll(self):
+        if self.file and time.time() - self.last >= self.interval:
+            self.write()
+
+def get_cumulative_buckets(counts):
+    res = {}
+    total = 0
+    for le, n in zip(LATENCY_BUCKETS,counts):
+        total += n
+        res['+Inf' if le == float('inf') else str(le)] = total
+    return res
+
+def format_prometheus(data):
+    p = PROMETHEUS_PREFIX
+    lines = []
+    for name in sorted(data['counters']):
+        lines.append('# TYPE %s%s_total counter' % (p,name))
+        lines.append('%s%s_total %d' % (p,name,data['counters'][name]))
+    for name in sorted(data['gauges']):
+        lines.append('# TYPE %s%s gauge' % (p,name))
+        lines.append('%s%s %s' % (p,name,data['gauges'][name]))
+    lines.append('# TYPE %sacceptance_rate gauge' % p)
+    lines.append('%sacceptance_rate %s' % (p,data['acceptance_rate']))
+    lines.append('# TYPE %sphase_seconds_total counter' % p)
+    for name in sorted(data['timers']):
+        lines.append('%sphase_seconds_total{phase="%s"} %s' % (p,name,data['timers'][name]['seconds']))
+    lines.append('# TYPE %sphase_calls_total counter' % p)
+    for name in sorted(data['timers']):
+        lines.append('%sphase_calls_total{phase="%s"} %d' % (p,name,data['timers'][name]['calls']))
+    if data['histograms']:
+        lines.append('# TYPE %slatency_seconds histogram' % p)
+    for name in sorted(data['histograms']):
+        h = data['histograms'][name]
+        for le, n in h['buckets'].items():
+            lines.append('%slatency_seconds_bucket{op="%s",le="%s"} %d' % (p,name,le,n))
+        lines.append('%slatency_seconds_sum{op="%s"} %s' % (p,name,h['sum']))
+        lines.append('%slatency_seconds_count{op="%s"} %d' % (p,name,h['count']))
+    return '\n'.join(lines) + '\n'
+
+def get_profile_file(name):
+    folder = os.path.join(datadir,'profiles')
+    build_folder(folder)
+    return os.path.join(folder,'%s_%s_%d' % (name,time.strftime('%Y%m%d-%H%M%S'),os.getpid()))
+
+def write_profile(profiler,name,nlines=40):
+    # raw stats (<prefix>.prof, for snakeviz & co) and a text report sorted by
+    # cumulative time; returns the report file
+    import pstats
+    import io
+    prefix = get_profile_file(name)
+    profiler.dump_stats(prefix + '.prof')
+    out = io.StringIO()
+    pstats.Stats(profiler,stream=out).sort_stats('cumulative').print_stats(nlines)
+    with open(prefix + '.txt','w') as report:
+        report.write(out.getvalue())
+    return prefix + '.txt'
@@ -0,0 +1,53 @@
+from darpins import *
+from divergence import DivergenceLibrary
+import sampler
+import signal
+import numpy as np
+
+# worker side of design --workers: every task samples a batch from its own
+# random stream (derived from the run seed and the task number) and keeps the
+# candidates that diverge from a snapshot of the library plus the designs the
+# coordinator accepted since; the coordinator makes the final decision
+
+worker = {}
+
+def init_worker(seq,mask,scheme,rows,rowsfile,params):
+    # pending designs belong to the coordinator
+    signal.signal(signal.SIGTERM,signal.SIG_DFL)
+    library = DivergenceLibrary(mask,scheme=scheme,capacity=1,metric=params['metric'],
+                                 backend=params['backend'])
+    library.set_base(rows,np.zeros((len(rows),28),dtype=np.uint8))
+    plan = sampler.MutationPlan(seq,mask,scheme,params['alphabet_change'],params['weights'])
+    if params['pivots']: library.use_pivots(params['pivots'])
+    worker.update({ 'seq': seq, 'plan': plan, 'library': library, 'params': params,
+                    'rowsfile': open(rowsfile,'rb') })
+
+def read_accepted_rows(count):
+    # the coordinator appends the rows of the designs it accepts to rowsfile,
+    # count is their number when the task was submitted; a worker takes tasks
+    # in submission order, so it only reads the rows it has not seen yet
+    library = worker['library']
+    known = len(library) - len(library.base)
+    if count <= known: return
+    rowsfile = worker['rowsfile']
+    rowsfile.seek(known*library.width)
+    extra = np.frombuffer(rowsfile.read((count-known)*library.width),dtype=np.uint8)
+    extra = extra.reshape(-1,library.width)
+    library.extend_rows(extra,[ '' for row in extra ])
+
+def run_task(task,count):
+    params = worker['params']
+    library = worker['library']
+    read_accepted_rows(count)
+    rng = sampler.get_task_rng(params['entropy'],task)
+    plan = worker['plan']
+    batch, mutmasks = plan.sample(params['nres'],params['batch'],rng,permutate=params['permutate'])
+    if params['steer']:
+        sampler.steer_candidates(batch,mutmasks,worker['seq'],plan.indexes,plan.table,
+                                 plan.nallowed,params['nres'],library,params['lev_threshold'],rng)
+    keep = sampler.unique_rows(batch)
+    batch = batch[keep]
+    mutmasks = mutmasks[keep]
+    rows = library.table[batch[:,library.indexes]]
+    ok = library.divergent_rows(rows,params['lev_threshold'])
+    return batch[ok], mutmasks[ok], params['batch']
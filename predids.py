@@ -0,0 +1,172 @@
+from darpins import *
+from tailreader import TailReader
+import numpy as np
+
+# prediction ids as 63-bit fields (positive int64, as stored by mongo):
+#
+#   | version | top | molid1 | molid2 |
+#
+# the top field holds the pose in two's complement so negative tops (special
+# predictions) keep their molecules. Version 0 is the legacy
+# MAX_MOLECULES * MAX_MOLECULES * top + MAX_MOLECULES * molid1 + molid2 scheme
+# of get_prediction_id. Run this file to regenerate src/prediction_id.h for
+# the C programs after changing a layout.
+PREDICTION_ID_BITS = 63
+PREDICTION_ID_VERSION_BITS = 3
+PREDICTION_ID_LAYOUTS = {
+    # version: (top bits, molecule bits)
+    1: (12, 24),
+}
+PREDICTION_ID_VERSION = 1
+
+class PredictionIdLayout:
+
+    def __init__(self,version=PREDICTION_ID_VERSION):
+        if version not in PREDICTION_ID_LAYOUTS:
+            sys.stderr.write("CRITICAL: unknown prediction id version %d\n" % version)
+            sys.exit(1)
+        self.version = version
+        self.top_bits, self.mol_bits = PREDICTION_ID_LAYOUTS[version]
+        if PREDICTION_ID_VERSION_BITS + self.top_bits + 2*self.mol_bits > PREDICTION_ID_BITS:
+            sys.stderr.write("CRITICAL: prediction id version %d does not fit in %d bits\n" %
+                             (version,PREDICTION_ID_BITS))
+            sys.exit(1)
+        self.max_molecules = 1 << self.mol_bits
+        self.min_top = -(1 << (self.top_bits-1))
+        self.max_top = (1 << (self.top_bits-1)) - 1
+        self.mol2_shift = 0
+        self.mol1_shift = self.mol_bits
+        self.top_shift = 2*self.mol_bits
+        self.version_shift = PREDICTION_ID_BITS - PREDICTION_ID_VERSION_BITS
+
+    def encode(self,molid1,molid2,top):
+        # scalars or arrays in, int64 id(s) out
+        molid1 = np.asarray(molid1,dtype=np.int64)
+        molid2 = np.asarray(molid2,dtype=np.int64)
+        top = np.asarray(top,dtype=np.int64)
+        if np.any((molid1 < 0) | (molid1 >= self.max_molecules) |
+                  (molid2 < 0) | (molid2 >= self.max_molecules)):
+            sys.stderr.write("CRITICAL: molecule id out of range for prediction id version %d\n" %
+                             self.version)
+            sys.exit(1)
+        if np.any((top < self.min_top) | (top > self.max_top)):
+            sys.stderr.write("CRITICAL: top out of range for prediction id version %d\n" % self.version)
+            sys.exit(1)
+        topfield = top & ((1 << self.top_bits) - 1)
+        ids = (np.int64(self.version) << self.version_shift) | \
+              (topfield << self.top_shift) | \
+              (molid1 << self.mol1_shift) | \
+              (molid2 << self.mol2_shift)
+        return ids if ids.ndim else int(ids)
+
+    def decode(self,ids):
+        # id(s) -> (molid1, molid2, top)
+        ids = np.asarray(ids,dtype=np.int64)
+        molmask = (1 << self.mol_bits) - 1
+        topfield = (ids >> self.top_shift) & ((1 << self.top_bits) - 1)
+        top = np.where(topfield > self.max_top,topfield - (1 << self.top_bits),topfield)
+        molid1 = (ids >> self.mol1_shift) & molmask
+        molid2 = (ids >> self.mol2_shift) & molmask
+        if ids.ndim == 0:
+            return int(molid1), int(molid2), int(top)
+        return molid1, molid2, top
+
+def get_prediction_id_version(ids):
+    return np.asarray(ids,dtype=np.int64) >> (PREDICTION_ID_BITS - PREDICTION_ID_VERSION_BITS)
+
+def encode_prediction_ids(molids1,molids2,tops,version=PREDICTION_ID_VERSION):
+    return PredictionIdLayout(version).encode(molids1,molids2,tops)
+
+def decode_legacy_prediction_ids(ids):
+    ids = np.asarray(ids,dtype=np.int64)
+    special = ids >= MAX_PREDICTIONS - MAX_MOLECULES * MAX_MOLECULES
+    top = np.where(special,ids - MAX_PREDICTIONS,ids // (MAX_MOLECULES * MAX_MOLECULES))
+    molid1 = np.where(special,0,ids // MAX_MOLECULES % MAX_MOLECULES)
+    molid2 = np.where(special,0,ids % MAX_MOLECULES)
+    return molid1, molid2, top
+
+def decode_prediction_ids(ids):
+    # (molid1, molid2, top) arrays for ids of any version, legacy included
+    ids = np.atleast_1d(np.asarray(ids,dtype=np.int64))
+    versions = get_prediction_id_version(ids)
+    molid1 = np.zeros(len(ids),dtype=np.int64)
+    molid2 = np.zeros(len(ids),dtype=np.int64)
+    top = np.zeros(len(ids),dtype=np.int64)
+    for version in np.unique(versions):
+        sel = versions == version
+        if version == 0:
+            res = decode_legacy_prediction_ids(ids[sel])
+        else:
+            res = PredictionIdLayout(int(version)).decode(ids[sel])
+        molid1[sel], molid2[sel], top[sel] = res
+    return molid1, molid2, top
+
+def write_prediction_id_header(file):
+    lines = [ "/* generated by predids.py, do not edit */\n",
+              "#ifndef PREDICTION_ID_H\n", "#define PREDICTION_ID_H\n\n",
+              "#define PREDICTION_ID_BITS %d\n" % PREDICTION_ID_BITS,
+              "#define PREDICTION_ID_VERSION_BITS %d\n" % PREDICTION_ID_VERSION_BITS,
+              "#define PREDICTION_ID_VERSION %d\n" % PREDICTION_ID_VERSION ]
+    for version in sorted(PREDICTION_ID_LAYOUTS):
+        layout = PredictionIdLayout(version)
+        lines.append("\n#define PREDICTION_ID_V%d_TOP_BITS %d\n" % (version,layout.top_bits))
+        lines.append("#define PREDICTION_ID_V%d_MOL_BITS %d\n" % (version,layout.mol_bits))
+        lines.append("#define PREDICTION_ID_V%d_TOP_SHIFT %d\n" % (version,layout.top_shift))
+        lines.append("#define PREDICTION_ID_V%d_MOL1_SHIFT %d\n" % (version,layout.mol1_shift))
+        lines.append("#define PREDICTION_ID_V%d_MOL2_SHIFT %d\n" % (version,layout.mol2_shift))
+    lines.append("\n#endif // PREDICTION_ID_H\n")
+    with open(file,'w') as out:
+        out.writelines(lines)
+
+class MoleculeRegistry(TailReader):
+
+    # append-only molecule name -> id file (one name per line, the id is the
+    # line number), so ids stay the same across runs and processes
+
+    def __init__(self,file=os.path.join(datadir,'molecules.txt')):
+        TailReader.__init__(self,file,lock=True)
+        self.refresh()
+
+    def clear(self):
+        self.molids = {}
+        self.names = []
+
+    def parse_line(self,line):
+        name = line.rstrip('\n')
+        if name not in self.molids:
+            self.molids[name] = len(self.names)
+            self.names.append(name)
+
+    def __len__(self):
+        return len(self.names)
+
+    def register(self,names):
+        # returns the ids of names, appending the unknown ones to the registry
+        with open(self.file,'a') as out:
+            fcntl.flock(out,fcntl.LOCK_EX)
+            self.lock = False
+            self.refresh()
+            self.lock = True
+            new = []
+            for name in names:
+                if name not in self.molids and name not in new:
+                    new.append(name)
+            if new:
+                out.write(''.join([ '%s\n' % name for name in new ]))
+                out.flush()
+            fcntl.flock(out,fcntl.LOCK_UN)
+        self.refresh()
+        return np.array([ self.molids[name] for name in names ],dtype=np.int64)
+
+    def get_ids(self,names):
+        return np.array([ self.molids[name] for name in names ],dtype=np.int64)
+
+def register_molecules_from_file(file,registry=None):
+    # same as assign_molecule_ids_from_file, with ids from the registry
+    registry = registry if registry else MoleculeRegistry()
+    names = [ line.split('\t')[0] for line in open(file).readlines() ]
+    registry.register(names)
+    return { name: registry.molids[name] for name in names }
+
+if __name__ == '__main__':
+    write_prediction_id_header(os.path.join(os.path.dirname(os.path.abspath(__file__)),'src','prediction_id.h'))
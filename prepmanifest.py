@@ -0,0 +1,190 @@
+from darpins import *
+from seqindex import write_json_atomic
+from argparse import ArgumentParser
+import json
+import time
+
+# preparation state of a model tree (modelsdir, targetsdir...): a model is
+# prepared when its mol2 file and the prmtop file get_prmtop_file pairs with
+# it (e.g. mol2/<name>.mol2 and prmtop/<name>.prmtop) are both non-empty. One
+# os.scandir pass per directory records these files, and the manifest is saved
+# in datadir with the mtime of every directory, so a refresh only rescans the
+# directories whose mtime changed. Files seen empty are stat'ed again on every
+# refresh: writing a file does not touch the mtime of its directory.
+MANIFEST_VERSION = 1
+MOL2_EXT = '.mol2'
+PRMTOP_EXT = '.prmtop'
+# a directory modified this recently may change again within the same mtime
+# tick, so it is rescanned on the next refresh
+MTIME_SLACK_NS = 2 * 10**9
+
+def scan_directory(path):
+    # (subdirs, non-empty mol2 stems, non-empty prmtop stems, empty files)
+    subdirs, mol2, prmtop, empty = [], [], [], []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.name)
+                continue
+            stem, ext = os.path.splitext(entry.name)
+            if ext not in (MOL2_EXT,PRMTOP_EXT):
+                continue
+            if entry.stat().st_size == 0:
+                empty.append(entry.name)
+            else:
+                (mol2 if ext == MOL2_EXT else prmtop).append(stem)
+    return sorted(subdirs), mol2, prmtop, empty
+
+class PreparationManifest:
+
+    def __init__(self,root,folder=datadir):
+        self.root = os.path.abspath(root)
+        self.file = os.path.join(folder,'prepared_%s.json' % hash(self.root)[0:N_SHORTUID_CHARS])
+        self.meta = self.read_meta()
+        self.build()
+
+    def empty_meta(self):
+        return { 'version': MANIFEST_VERSION, 'root': self.root, 'dirs': {} }
+
+    def read_meta(self):
+        if not os.path.isfile(self.file):
+            return self.empty_meta()
+        meta = json.load(open(self.file))
+        if meta.get('version') != MANIFEST_VERSION or meta.get('root') != self.root:
+            return self.empty_meta()
+        return meta
+
+    def scan(self,reldir,mtime):
+        subdirs, mol2, prmtop, empty = scan_directory(os.path.join(self.root,reldir))
+        if time.time_ns() - mtime < MTIME_SLACK_NS:
+            mtime = 0
+        self.meta['dirs'][reldir] = { 'mtime': mtime, 'subdirs': subdirs, 'mol2': mol2,
+                                      'prmtop': prmtop, 'empty': empty }
+
+    def recheck_empty(self,reldir):
+        # True if a file seen empty was written (or removed) since
+        entry = self.meta['dirs'][reldir]
+        for name in entry['empty']:
+            try:
+                if os.stat(os.path.join(self.root,reldir,name)).st_size > 0:
+                    return True
+            except FileNotFoundError:
+                return True
+        return False
+
+    def refresh(self,save=True):
+        # returns the number of directories rescanned
+        dirs = self.meta['dirs']
+        seen = set()
+        stack = [ '' ]
+        nscanned = 0
+        while stack:
+            reldir = stack.pop()
+            try:
+                mtime = os.stat(os.path.join(self.root,reldir)).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            seen.add(reldir)
+            if reldir not in dirs or dirs[reldir]['mtime'] != mtime or self.recheck_empty(reldir):
+                self.scan(reldir,mtime)
+                nscanned += 1
+            stack.extend([ os.path.join(reldir,d) for d in dirs[reldir]['subdirs'] ])
+        for reldir in list(dirs):
+            if reldir not in seen:
+                del dirs[reldir]
+                nscanned += 1
+        if nscanned:
+            self.build()
+            if save:
+                build_folder(os.path.dirname(self.file))
+                write_json_atomic(self.file,self.meta)
+        return nscanned
+
+    def has_prmtop(self,mol2path,prmtops):
+        # mol2path relative to the root; a prmtop paired outside the tree is stat'ed
+        prmtopfile = get_prmtop_file(os.path.join(self.root,mol2path))
+        path = os.path.relpath(prmtopfile,self.root)
+        if not path.startswith(os.pardir):
+            return path in prmtops
+        return os.path.isfile(prmtopfile) and os.stat(prmtopfile).st_size > 0
+
+    def build(self):
+        # prepared models by path (relative, without extension) and by name
+        self.prepared = set()
+        self.names = {}
+        prmtops = set([ os.path.join(reldir,stem + PRMTOP_EXT)
+                        for reldir, entry in self.meta['dirs'].items() for stem in entry['prmtop'] ])
+        for reldir, entry in self.meta['dirs'].items():
+            for stem in entry['mol2']:
+                path = os.path.join(reldir,stem)
+                if self.has_prmtop(path + MOL2_EXT,prmtops):
+                    self.prepared.add(path)
+                    self.names.setdefault(stem,[]).append(path)
+
+    def __len__(self):
+        return len(self.prepared)
+
+    def is_prepared(self,mol2file):
+        path = os.path.relpath(os.path.abspath(mol2file),self.root)
+        return os.path.splitext(path)[0] in self.prepared
+
+    def get_prepared_files(self,name):
+        # mol2 files of the prepared models called <name>, wherever in the tree
+        return [ os.path.join(self.root,path + MOL2_EXT) for path in self.names.get(name,[]) ]
+
+    def get_unprepared(self,names):
+        # names (model file stems) without a prepared model anywhere in the tree
+        return [ name for name in names if name not in self.names ]
+
+    def get_unprepared_designs(self,designs):
+        # designs without a prepared model named by their shortuid
+        return [ d for d in designs if d['shortuid'] not in self.names ]
+
+def open_preparation_manifest(root=modelsdir,refresh=True):
+    manifest = PreparationManifest(root)
+    if refresh:
+        manifest.refresh()
+    return manifest
+
+def parse_args():
+    parser = ArgumentParser()
+
+    parser.add_argument("command", choices=['status','todo'],
+                        help="count the prepared models, or list the designs still to prepare")
+    parser.add_argument("-r", "--root", dest="root", default=modelsdir,
+                        help="Model tree to scan")
+    parser.add_argument("-d", "--dbfile", dest="dbfile", default=None,
+                        help="Read designs from a dbfile or design library instead of MongoDB")
+    parser.add_argument("-t", "--type", dest="type", default='',
+                        help="Only list designs of this type")
+    parser.add_argument("-p", "--parent", dest="parent", default='',
+                        help="Only list designs derived from this parent uid")
+    parser.add_argument("--include_parent", dest="include_parent", default=False, action="store_true",
+                        help="Also list the parent")
+    parser.add_argument("--test", dest="test", default=False, action="store_true",
+                        help="Use test collections from MongoDB")
+
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    manifest = open_preparation_manifest(args.root)
+    if args.command == 'status':
+        print(json.dumps({ 'root': manifest.root, 'prepared': len(manifest),
+                           'directories': len(manifest.meta['dirs']) }))
+        return
+    if args.dbfile:
+        designs = get_designs_from_dbfile(args.dbfile)
+    else:
+        coll = get_mongo_designs(test=args.test)
+        if args.parent:
+            args.parent = get_parent_uid(coll,args.parent)
+            if args.parent is None:
+                sys.stderr.write("CRITICAL: could not find parent entry\n")
+                sys.exit(1)
+        designs = coll.find(get_filter_data(args),{ 'shortuid': 1 })
+    for d in manifest.get_unprepared_designs(designs):
+        print(d['shortuid'])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+from darpins import *
+from divergence import build_projection_table
+import numpy as np
+
+# batched counterpart of design_sequence: candidates are rows of a
+# (batch x sequence length) uint8 array of upper case residues
+
+MUTATABLE_AA = [ r for g in ALPHABETS['default'] for r in ALPHABETS['default'][g] ]
+
+def get_seed_entropy(seed=None):
+    if seed is None: return np.random.SeedSequence().entropy
+    return int(hash(str(seed)),16) % (2**63)
+
+def get_rng(seed=None):
+    return np.random.default_rng(get_seed_entropy(seed))
+
+def get_task_rng(entropy,task):
+    # independent stream for every task, derived from the run seed
+    return np.random.default_rng(np.random.SeedSequence(entropy,spawn_key=(task,)))
+
+def get_allowed_residues(from_res,scheme='',alphabet_change=False):
+    # same choices as mutate_residue
+    if scheme:
+        g0 = REVERSED_ALPHABETS[scheme].get(from_res)
+        li = [ r for g in ALPHABETS[scheme] if not (alphabet_change and g == g0)
+               for r in ALPHABETS[scheme][g] ]
+    else:
+        li = list(MUTATABLE_AA)
+    return [ r for r in li if r != from_res ]
+
+def build_mutation_table(seq,indexes,scheme='',alphabet_change=False):
+    # per variable position: padded array of allowed residues and their count
+    allowed = [ get_allowed_residues(seq[i],scheme,alphabet_change) for i in indexes ]
+    nallowed = np.array([ len(li) for li in allowed ],dtype=np.int64)
+    table = np.zeros((len(indexes),max(1,nallowed.max(initial=0))),dtype=np.uint8)
+    for k,li in enumerate(allowed):
+        table[k,:len(li)] = np.frombuffer(bytes(''.join(li),'ascii'),dtype=np.uint8)
+    return table, nallowed
+
+def get_variable_indexes(mask):
+    return np.flatnonzero(np.asarray(mask,dtype=np.uint8))
+
+def get_nres(nindexes,nres):
+    return nres if 0 < nres < nindexes else nindexes
+
+def read_residue_weights(file):
+    # '<residue> <weight>' lines apply to every position, '<position> <residue>
+    # <weight>' lines (1-based sequence positions) override them
+    weights = {}
+    for line in open(file).readlines():
+        tmp = line.split()
+        if not tmp or tmp[0].startswith('#'): continue
+        if len(tmp) == 2:
+            weights[tmp[0].upper()] = float(tmp[1])
+        else:
+            weights.setdefault(int(tmp[0])-1,{})[tmp[1].upper()] = float(tmp[2])
+    return weights
+
+def build_cumulative_weights(seq,indexes,table,nallowed,weights):
+    # per variable position: cumulative probabilities of the allowed residues
+    cum = np.zeros(table.shape,dtype=np.float64)
+    for k,i in enumerate(indexes):
+        w = dict([ (r,v) for r,v in weights.items() if isinstance(r,str) ])
+        w.update(weights.get(int(i),{}))
+        p = np.array([ w.get(chr(r),1.0) for r in table[k,:nallowed[k]] ],dtype=np.float64)
+        if len(p) and (p.min() < 0 or p.sum() <= 0):
+            raise ValueError("residue weights of position %d do not sum to a positive value" % (i+1))
+        cum[k,:len(p)] = np.cumsum(p) / p.sum() if len(p) else 0
+        cum[k,len(p):] = 1.0
+    return cum
+
+def choose_residues(table,nallowed,cumweights,pos,u):
+    # residues of the variable positions pos for uniform draws u (same shape)
+    if cumweights is None:
+        choice = (u * nallowed[pos]).astype(np.int64)
+    else:
+        choice = (cumweights[pos] <= u[...,None]).sum(axis=-1)
+        choice = np.minimum(choice,nallowed[pos]-1)
+    return table[pos,choice]
+
+def sample_mutations(seq,indexes,table,nallowed,nres,n,rng,cumweights=None):
+    # mutates <nres> distinct variable positions of each candidate
+    base = np.frombuffer(bytes(seq.upper(),'ascii'),dtype=np.uint8)
+    batch = np.tile(base,(n,1))
+    mutmasks = np.zeros(batch.shape,dtype=np.uint8)
+    nres = get_nres(len(indexes),nres)
+    if nres == 0: return batch, mutmasks
+    pos = np.argsort(rng.random((n,len(indexes))),axis=1)[:,:nres]
+    rows = np.arange(n)[:,None]
+    batch[rows,indexes[pos]] = choose_residues(table,nallowed,cumweights,pos,rng.random((n,nres)))
+    mutmasks[rows,indexes[pos]] = 1
+    return batch, mutmasks
+
+def sample_permutations(seq,indexes,nres,n,rng):
+    # swaps <nres> pairs of distinct variable positions, one after the other
+    base = np.frombuffer(bytes(seq.upper(),'ascii'),dtype=np.uint8)
+    batch = np.tile(base,(n,1))
+    mutmasks = np.zeros(batch.shape,dtype=np.uint8)
+    nres = get_nres(len(indexes),nres)
+    if len(indexes) < 2: return batch, mutmasks
+    rows = np.arange(n)
+    for _ in range(nres):
+        p1 = rng.integers(0,len(indexes),n)
+        p2 = (p1 + rng.integers(1,len(indexes),n)) % len(indexes)
+        i = indexes[p1]
+        j = indexes[p2]
+        ri = batch[rows,i]
+        batch[rows,i] = batch[rows,j]
+        batch[rows,j] = ri
+        mutmasks[rows,i] = 1
+        mutmasks[rows,j] = 1
+    return batch, mutmasks
+
+def sample_candidates(seq,indexes,nres,n,rng,permutate=False,table=None,nallowed=None,cumweights=None):
+    if permutate:
+        return sample_permutations(seq,indexes,nres,n,rng)
+    return sample_mutations(seq,indexes,table,nallowed,nres,n,rng,cumweights=cumweights)
+
+class MutationPlan:
+
+    # mutation choices of one (parent, mask, scheme, alphabet_change) compiled
+    # once: allowed residues of every variable position (table, nallowed),
+    # optional cumulative weights of these residues and the residue -> group
+    # projection of the scheme, so mutating and projecting are array lookups
+
+    def __init__(self,seq,mask,scheme='',alphabet_change=False,weights=None):
+        self.seq = seq
+        self.scheme = scheme
+        self.alphabet_change = alphabet_change
+        self.indexes = get_variable_indexes(mask)
+        # sequence position -> variable position (-1 if fixed)
+        self.positions = np.full(len(seq),-1,dtype=np.int64)
+        self.positions[self.indexes] = np.arange(len(self.indexes))
+        self.table, self.nallowed = build_mutation_table(seq,self.indexes,scheme,alphabet_change)
+        self.cumweights = None
+        if weights:
+            self.cumweights = build_cumulative_weights(seq,self.indexes,self.table,self.nallowed,weights)
+        self.projection = build_projection_table(scheme)
+
+    def sample(self,nres,n,rng,permutate=False):
+        return sample_candidates(self.seq,self.indexes,nres,n,rng,permutate=permutate,
+                                 table=self.table,nallowed=self.nallowed,cumweights=self.cumweights)
+
+    def choose(self,i,u):
+        # residue for sequence position i given a uniform draw u in [0,1)
+        k = self.positions[i]
+        return chr(choose_residues(self.table,self.nallowed,self.cumweights,
+                                   np.array([k]),np.array([u]))[0])
+
+    def project(self,rows):
+        # uint8 rows (or a str) with every residue replaced by its group
+        if isinstance(rows,str):
+            return self.projection[np.frombuffer(bytes(rows,'ascii'),dtype=np.uint8)].tobytes().decode('ascii')
+        return self.projection[rows]
+
+def steer_candidates(batch,mutmasks,seq,indexes,table,nallowed,nres,library,min_t,rng,
+                     nsteps=0,temperature=0.5):
+    # Metropolis walk of the candidates closer than min_t to some design of the
+    # (hamming) library, modified in place. The energy of a candidate is the sum
+    # of min_t - d over the designs at distance d < min_t; moves change the
+    # residue of a position the candidate shares with its nearest design, or
+    # move a mutation there from another position, so every candidate keeps
+    # exactly nres mutations drawn from the mutation table. Distances are
+    # updated incrementally against the designs a walk of nsteps can reach.
+    # Returns the boolean mask of the candidates that got divergent.
+    ok = np.ones(len(batch),dtype=bool)
+    if min_t == 0 or len(library) == 0 or len(indexes) == 0:
+        return ok
+    nsteps = nsteps if nsteps else 4*min_t
+    nres = get_nres(len(indexes),nres)
+    base = np.frombuffer(bytes(seq.upper(),'ascii'),dtype=np.uint8)[indexes]
+    proj = library.table
+    for k in range(len(batch)):
+        cur = batch[k,indexes]
+        row = proj[cur]
+        dists = library.distances(row)
+        if dists.min() >= min_t: continue
+        near = np.flatnonzero(dists < min_t + 2*nsteps)
+        rows = library.take(near)
+        d = dists[near].astype(np.int64)
+        mutated = mutmasks[k,indexes].astype(bool)
+        energy = np.maximum(0,min_t - d).sum()
+        for step in range(nsteps):
+            if energy == 0: break
+            agree = np.flatnonzero(rows[np.argmin(d)] == row)
+            p = agree[rng.integers(len(agree))] if len(agree) else rng.integers(len(indexes))
+            changes = [ (p,table[p,rng.integers(nallowed[p])]) ]
+            if not mutated[p]:
+                q = np.flatnonzero(mutated)
+                if len(q) == 0: continue
+                q = q[rng.integers(len(q))]
+                changes.append((q,base[q]))
+            newd = d.copy()
+            for pos, res in changes:
+                newd += (rows[:,pos] != proj[res]).astype(np.int64) - (rows[:,pos] != row[pos])
+            newenergy = np.maximum(0,min_t - newd).sum()
+            if newenergy <= energy or rng.random() < np.exp((energy - newenergy) / temperature):
+                for pos, res in changes:
+                    cur[pos] = res
+                    row[pos] = proj[res]
+                    mutated[pos] = res != base[pos]
+                d = newd
+                energy = newenergy
+        batch[k,indexes] = cur
+        mutmasks[k,indexes] = mutated
+        ok[k] = energy == 0
+    return ok
+
+def unique_rows(batch):
+    # indexes of the first occurrence of every distinct candidate, in batch order
+    _, first = np.unique(batch,axis=0,return_index=True)
+    return np.sort(first)
+
+def hash_rows(batch):
+    return [ hashlib.sha224(row.tobytes()).hexdigest() for row in batch ]
@@ -0,0 +1,240 @@
+from darpins import *
+from seqindex import write_json_atomic
+from shardlog import read_manifest, read_segment_lines
+try:
+    from collections.abc import Mapping
+except:
+    from collections import Mapping
+import json
+import numpy as np
+
+# columnar version of the scores tsv (design, target, top, score, value):
+# names are interned into ids and the rows are kept as int32 columns and a
+# float64 value column (the exact values of the tsv) sorted by design, saved
+# as .npy files in <tsv>.store/ and memory-mapped. The store is opt-in
+# (open_score_store), read_scores_from_file still parses the tsv.
+# The store is rebuilt when the tsv is replaced or truncated; lines appended
+# to the tsv are parsed on their own and merged in. Lines of live segments of
+# a sharded tsv (see shardlog.py) are added in memory on top of the store.
+STORE_VERSION = 3
+STORE_COLUMNS = ('design','target','top','score','value')
+
+def parse_scores_lines(lines,ids):
+    # ids: name -> id dicts for 'design', 'target' and 'score', extended in place
+    n = len(lines)
+    cols = { 'design': np.zeros(n,dtype=np.int32), 'target': np.zeros(n,dtype=np.int32),
+             'top': np.zeros(n,dtype=np.int32), 'score': np.zeros(n,dtype=np.int32),
+             'value': np.zeros(n,dtype=np.float64) }
+    designs, targets, scores = ids['design'], ids['target'], ids['score']
+    for k, line in enumerate(lines):
+        design, target, top, score, value = line.rstrip().split('\t')
+        cols['design'][k] = designs.setdefault(design,len(designs))
+        cols['target'][k] = targets.setdefault(target,len(targets))
+        cols['top'][k] = int(top)
+        cols['score'][k] = scores.setdefault(score,len(scores))
+        cols['value'][k] = float(value)
+    return cols
+
+def get_row_order(cols):
+    # rows sorted by (design, target, top, score), keeping only the last line
+    # of a key written again (as read_scores_from_file does)
+    order = np.lexsort((cols['score'],cols['top'],cols['target'],cols['design']))
+    if len(order) == 0: return order
+    keys = np.stack([ cols[c][order] for c in ('design','target','top','score') ])
+    last = np.r_[np.any(keys[:,1:] != keys[:,:-1],axis=0),True]
+    return order[last]
+
+class ScoreStore:
+
+    def __init__(self,file):
+        self.file = file
+        self.folder = file + '.store'
+        self.metafile = os.path.join(self.folder,'meta.json')
+        self.load()
+
+    def get_column_file(self,col):
+        return os.path.join(self.folder,'%s.npy' % col)
+
+    def read_meta(self):
+        if not os.path.isfile(self.metafile): return None
+        meta = json.load(open(self.metafile))
+        if meta.get('version') != STORE_VERSION: return None
+        return meta
+
+    def load(self):
+        manifest = read_manifest(self.file) if is_sharded(self.file) else None
+        self.load_file()
+        if manifest is not None:
+            self.add_lines(read_segment_lines(self.file,manifest))
+
+    def load_file(self):
+        if not os.path.isfile(self.file):
+            self.set_meta(None)
+            return
+        with open(self.file + '.store.lock','a') as lock:
+            fcntl.flock(lock,fcntl.LOCK_EX)
+            meta = self.read_meta()
+            st = os.stat(self.file)
+            if meta is None or meta['inode'] != st.st_ino or meta['offset'] > st.st_size:
+                meta = self.build(st,None)
+            elif meta['offset'] < st.st_size:
+                meta = self.build(st,meta)
+            self.set_meta(meta)
+            fcntl.flock(lock,fcntl.LOCK_UN)
+
+    def set_meta(self,meta):
+        self.meta = meta
+        if meta is None:
+            self.names = { 'design': [], 'target': [], 'score': [] }
+            self.cols = { c: np.zeros(0,dtype=np.float64 if c == 'value' else np.int32)
+                          for c in STORE_COLUMNS }
+        else:
+            self.names = meta['names']
+            self.cols = { c: np.load(self.get_column_file(c),mmap_mode='r') for c in STORE_COLUMNS }
+        self.ids = { k: { name: i for i, name in enumerate(v) } for k, v in self.names.items() }
+        # rows of design d are starts[d]:starts[d+1]
+        self.starts = np.searchsorted(self.cols['design'],np.arange(len(self.names['design'])+1))
+
+    def add_lines(self,lines):
+        # in-memory rows on top of the saved columns
+        lines = [ l for l in lines if l.strip() ]
+        if not lines: return
+        cols = parse_scores_lines(lines,self.ids)
+        cols = { c: np.concatenate((np.asarray(self.cols[c]),cols[c])) for c in STORE_COLUMNS }
+        order = get_row_order(cols)
+        self.cols = { c: cols[c][order] for c in STORE_COLUMNS }
+        self.names = { k: sorted(v,key=v.get) for k, v in self.ids.items() }
+        self.starts = np.searchsorted(self.cols['design'],np.arange(len(self.names['design'])+1))
+
+    def build(self,st,meta):
+        # parses the tsv from the last offset (or from the start) and rewrites the columns
+        offset = meta['offset'] if meta else 0
+        with open(self.file,'rb') as in_:
+            in_.seek(offset)
+            data = in_.read(st.st_size - offset)
+        end = data.rfind(b'\n') + 1
+        lines = data[:end].decode('utf-8').splitlines()
+        names = meta['names'] if meta else { 'design': [], 'target': [], 'score': [] }
+        ids = { k: { name: i for i, name in enumerate(v) } for k, v in names.items() }
+        cols = parse_scores_lines([ l for l in lines if l.strip() ],ids)
+        if meta:
+            old = { c: np.load(self.get_column_file(c)) for c in STORE_COLUMNS }
+            cols = { c: np.concatenate((old[c],cols[c])) for c in STORE_COLUMNS }
+        order = get_row_order(cols)
+        build_folder(self.folder)
+        for c in STORE_COLUMNS:
+            tmpfile = self.get_column_file(c) + '.%d.tmp.npy' % os.getpid()
+            np.save(tmpfile,cols[c][order])
+            os.replace(tmpfile,self.get_column_file(c))
+        meta = { 'version': STORE_VERSION, 'inode': st.st_ino, 'offset': offset + end,
+                 'nrows': int(len(order)),
+                 'names': { k: sorted(v,key=v.get) for k, v in ids.items() } }
+        write_json_atomic(self.metafile,meta)
+        return meta
+
+    def __len__(self):
+        return len(self.cols['value'])
+
+    def get_rows(self,design):
+        d = self.ids['design'][design]
+        return slice(self.starts[d],self.starts[d+1])
+
+    def select(self,score,target=None,tops=None):
+        # boolean mask of the rows of one score, for one target and some poses
+        sel = self.cols['score'] == self.ids['score'].get(score,-1)
+        if target is not None:
+            sel &= self.cols['target'] == self.ids['target'].get(target,-1)
+        if tops is not None:
+            sel &= np.isin(self.cols['top'],tops)
+        return sel
+
+    def aggregate(self,score,target=None,tops=None,agg='min'):
+        # (design names, values) of score aggregated per design over the
+        # selected targets and poses; agg is 'min', 'max' or 'mean'
+        sel = np.flatnonzero(self.select(score,target,tops))
+        if len(sel) == 0:
+            return [], np.zeros(0,dtype=np.float64)
+        designs = self.cols['design'][sel]
+        values = np.asarray(self.cols['value'][sel])
+        ud, first, counts = np.unique(designs,return_index=True,return_counts=True)
+        if agg == 'min':
+            res = np.minimum.reduceat(values,first)
+        elif agg == 'max':
+            res = np.maximum.reduceat(values,first)
+        else:
+            res = np.add.reduceat(values,first) / counts
+        return [ self.names['design'][d] for d in ud ], res
+
+    def top_designs(self,score,target=None,k=10,tops=None,agg='min',largest=False):
+        # k best designs for score as (design, value), lowest first unless largest
+        names, values = self.aggregate(score,target,tops,agg)
+        if len(values) == 0: return []
+        k = min(k,len(values))
+        keys = -values if largest else values
+        best = np.argpartition(keys,k-1)[:k]
+        best = best[np.argsort(keys[best],kind='stable')]
+        return [ (names[i],float(values[i])) for i in best ]
+
+    def get_score_vector(self,design,target,top):
+        # values of every score name for one pose (nan when missing)
+        vec = np.full(len(self.names['score']),np.nan,dtype=np.float64)
+        if design not in self.ids['design']: return vec
+        rows = self.get_rows(design)
+        sel = (self.cols['target'][rows] == self.ids['target'].get(target,-1)) & \
+              (self.cols['top'][rows] == top)
+        vec[self.cols['score'][rows][sel]] = self.cols['value'][rows][sel]
+        return vec
+
+    def view(self):
+        return ScoreView(self)
+
+class ScoreView(Mapping):
+
+    # read-only scores[design][target][top][score] view over a ScoreStore
+
+    def __init__(self,store):
+        self.store = store
+
+    def __getitem__(self,design):
+        if design not in self.store.ids['design']: raise KeyError(design)
+        return ScoreDesignView(self.store,self.store.get_rows(design))
+
+    def __iter__(self):
+        return iter([ d for d in self.store.names['design']
+                      if self.store.starts[self.store.ids['design'][d]+1] >
+                         self.store.starts[self.store.ids['design'][d]] ])
+
+    def __len__(self):
+        return int(np.count_nonzero(np.diff(self.store.starts)))
+
+class ScoreDesignView(Mapping):
+
+    def __init__(self,store,rows):
+        self.store = store
+        cols = store.cols
+        self.targets = np.asarray(cols['target'][rows])
+        self.tops = np.asarray(cols['top'][rows])
+        self.scores = np.asarray(cols['score'][rows])
+        self.values = np.asarray(cols['value'][rows])
+
+    def get_target_poses(self,target):
+        t = self.store.ids['target'].get(target,-1)
+        sel = self.targets == t
+        res = {}
+        for top, score, value in zip(self.tops[sel],self.scores[sel],self.values[sel]):
+            res.setdefault(int(top),{})[self.store.names['score'][score]] = float(value)
+        return res
+
+    def __getitem__(self,target):
+        res = self.get_target_poses(target)
+        if not res: raise KeyError(target)
+        return res
+
+    def __iter__(self):
+        return iter([ self.store.names['target'][t] for t in np.unique(self.targets) ])
+
+    def __len__(self):
+        return len(np.unique(self.targets))
+
+def open_score_store(file):
+    return ScoreStore(file)
@@ -0,0 +1,139 @@
+from darpins import *
+from divergence import build_projection_table, get_mask_indexes
+from storage import find_after, find_before
+import json
+import numpy as np
+
+# on-disk index of masked design sequences for one (parent, type, mask, scheme):
+#   <prefix>.seq   rows x width uint8, masked and alphabet-projected sequences
+#   <prefix>.uid   rows x 28 uint8, raw sha224 digests of the designs
+#   <prefix>.json  header with the number of valid rows and the high-water mark
+#                  (last mongo _id synced); rows past 'nrows' are ignored
+INDEX_VERSION = 1
+UID_BYTES = 28
+# designs below the high-water mark looked for before a rebuild
+SYNC_WINDOW = 1000
+
+def get_index_key(parent,type,mask,scheme=''):
+    return hash('%s:%s:%s:%s' % (parent,type,''.join([ str(m) for m in mask ]),scheme))[0:N_SHORTUID_CHARS]
+
+def write_json_atomic(file,data):
+    tmpfile = '%s.%d.tmp' % (file,os.getpid())
+    with open(tmpfile,'w') as out:
+        json.dump(data,out)
+    os.replace(tmpfile,file)
+
+def append_rows_to_file(file,data,offset):
+    # drops whatever a crashed writer left past the last valid row
+    with open(file,'r+b' if os.path.isfile(file) else 'w+b') as out:
+        out.truncate(offset)
+        out.seek(offset)
+        out.write(data)
+
+class MaskedIndex:
+
+    def __init__(self,parent,type,mask,scheme='',folder=indexesdir):
+        self.parent = parent
+        self.type = type
+        self.mask = [ int(m) for m in mask ]
+        self.scheme = scheme
+        self.indexes = get_mask_indexes(self.mask)
+        self.width = len(self.indexes)
+        self.table = build_projection_table(scheme)
+        self.key = get_index_key(parent,type,self.mask,scheme)
+        prefix = os.path.join(folder,'%s_%s' % (type,self.key))
+        self.seqfile = prefix + '.seq'
+        self.uidfile = prefix + '.uid'
+        self.metafile = prefix + '.json'
+        self.lockfile = prefix + '.lock'
+        self.meta = self.read_meta()
+        self.map()
+
+    def __len__(self):
+        return self.meta['nrows']
+
+    def get_filter_data(self):
+        return { 'type': self.type, 'parent': self.parent }
+
+    def empty_meta(self):
+        return { 'version': INDEX_VERSION, 'parent': self.parent, 'type': self.type,
+                 'mask': ''.join([ str(m) for m in self.mask ]), 'scheme': self.scheme,
+                 'width': self.width, 'nrows': 0, 'hwm': None }
+
+    def read_meta(self):
+        if not os.path.isfile(self.metafile):
+            return self.empty_meta()
+        meta = json.load(open(self.metafile))
+        if meta.get('version') != INDEX_VERSION or meta.get('width') != self.width:
+            sys.stderr.write("WARNING: index '%s' is outdated, rebuilding\n" % self.metafile)
+            return self.empty_meta()
+        return meta
+
+    def map(self):
+        n = self.meta['nrows']
+        if n == 0:
+            self.seqs = np.zeros((0,self.width),dtype=np.uint8)
+            self.uids = np.zeros((0,UID_BYTES),dtype=np.uint8)
+            return
+        self.seqs = np.memmap(self.seqfile,dtype=np.uint8,mode='r',shape=(n,self.width))
+        self.uids = np.memmap(self.uidfile,dtype=np.uint8,mode='r',shape=(n,UID_BYTES))
+
+    def append(self,seqs,uids):
+        if not seqs:
+            return
+        n = len(seqs)
+        rows = np.frombuffer(b''.join(seqs),dtype=np.uint8).reshape(n,-1)
+        rows = self.table[rows[:,self.indexes]]
+        nrows = self.meta['nrows']
+        append_rows_to_file(self.seqfile,rows.tobytes(),nrows*self.width)
+        append_rows_to_file(self.uidfile,b''.join(uids),nrows*UID_BYTES)
+        self.meta['nrows'] = nrows + n
+
+    def fetch(self,designs):
+        seqs = []
+        uids = []
+        hwm = self.meta['hwm']
+        for d in find_after(designs,self.get_filter_data(),{ 'seq': 1, 'uid': 1 },hwm):
+            seqs.append(bytes(d['seq'],'ascii'))
+            uids.append(bytes.fromhex(d['uid']))
+            hwm = str(d['_id'])
+        self.append(seqs,uids)
+        self.meta['hwm'] = hwm
+
+    def fetch_window(self,designs):
+        # adds the designs of the last SYNC_WINDOW up to the high-water mark that
+        # are not indexed (inserted by another process with a lower _id). Rows
+        # are appended in _id order, so the indexed ones are in the last rows
+        nrows = self.meta['nrows']
+        if not self.meta['hwm'] or nrows == 0:
+            return
+        docs = list(find_before(designs,self.get_filter_data(),{ 'seq': 1, 'uid': 1 },
+                                self.meta['hwm'],SYNC_WINDOW))
+        start = max(0,nrows - 2*SYNC_WINDOW)
+        with open(self.uidfile,'rb') as f:
+            f.seek(start*UID_BYTES)
+            tail = f.read((nrows - start)*UID_BYTES)
+        indexed = set([ tail[i:i+UID_BYTES] for i in range(0,len(tail),UID_BYTES) ])
+        docs = [ d for d in reversed(docs) if bytes.fromhex(d['uid']) not in indexed ]
+        self.append([ bytes(d['seq'],'ascii') for d in docs ],[ bytes.fromhex(d['uid']) for d in docs ])
+
+    def sync(self,designs):
+        # appends the designs inserted since the last sync; a design inserted by
+        # another process with an _id below the high-water mark is looked for in
+        # the window below the mark, then a full rebuild fixes the row count
+        with open(self.lockfile,'a') as lock:
+            fcntl.flock(lock,fcntl.LOCK_EX)
+            self.meta = self.read_meta()
+            count = designs.count(self.get_filter_data())
+            if count != self.meta['nrows']:
+                if count < self.meta['nrows']:
+                    self.meta = self.empty_meta()
+                self.fetch(designs)
+                if self.meta['nrows'] < count:
+                    self.fetch_window(designs)
+                if self.meta['nrows'] < count:
+                    self.meta = self.empty_meta()
+                    self.fetch(designs)
+                write_json_atomic(self.metafile,self.meta)
+            fcntl.flock(lock,fcntl.LOCK_UN)
+        self.map()
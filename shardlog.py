@@ -0,0 +1,167 @@
+from darpins import *
+from seqindex import write_json_atomic
+from argparse import ArgumentParser
+import json
+import socket
+
+# sharded mode of the append-only result files: when <file>.segments/ exists,
+# append_lines_to_file writes to a segment of its own process
+# (<host>.<pid>.seg) without any lock, and compact() appends the new segment
+# lines to <file> in the order they were written (segment by segment) and
+# drops exact duplicate lines but their last occurrence, so a parser keeping
+# the last line of a key still gets the latest one. The manifest of the folder
+# records how far every segment has been merged; readers take <file> plus the
+# segment lines past these offsets.
+#
+# compact() replaces <file> before it writes the new manifest and readers
+# read the manifest before <file>, so a reader racing a compaction can see a
+# line twice (an exact duplicate) but never miss one.
+SEGMENTS_SUFFIX = '.segments'
+SEGMENT_EXT = '.seg'
+MANIFEST = 'manifest.json'
+
+segment_fds = {}
+
+def get_segments_folder(file):
+    return file + SEGMENTS_SUFFIX
+
+def get_manifest_file(file):
+    return os.path.join(get_segments_folder(file),MANIFEST)
+
+def enable_sharding(file):
+    build_folder(get_segments_folder(file))
+
+def get_segment_name(host=None,pid=None):
+    return '%s.%d%s' % (host if host else socket.gethostname(),pid if pid else os.getpid(),SEGMENT_EXT)
+
+def append_lines_to_segment(file,lines):
+    # one O_APPEND descriptor per process and file, kept open
+    key = (file,os.getpid())
+    if key not in segment_fds:
+        segment = os.path.join(get_segments_folder(file),get_segment_name())
+        segment_fds[key] = os.open(segment,os.O_WRONLY | os.O_APPEND | os.O_CREAT,0o644)
+    data = bytes(''.join(lines),'utf-8')
+    while data:
+        data = data[os.write(segment_fds[key],data):]
+
+def read_manifest(file):
+    manifest = get_manifest_file(file)
+    if not os.path.isfile(manifest):
+        return { 'segments': {} }
+    return json.load(open(manifest))
+
+def list_segments(file):
+    return sorted([ name for name in os.listdir(get_segments_folder(file)) if name.endswith(SEGMENT_EXT) ])
+
+def read_segment_data(file,name,offset):
+    # complete lines of a segment from offset, and the offset past them
+    try:
+        with open(os.path.join(get_segments_folder(file),name),'rb') as in_:
+            in_.seek(offset)
+            data = in_.read()
+    except FileNotFoundError:
+        return b'', offset
+    end = data.rfind(b'\n') + 1
+    return data[:end], offset + end
+
+def read_segment_lines(file,manifest):
+    lines = []
+    for name in list_segments(file):
+        data, offset = read_segment_data(file,name,manifest['segments'].get(name,0))
+        lines.extend(data.decode('utf-8').splitlines(True))
+    return lines
+
+def read_log_lines(file):
+    # lines of <file> and of the live segments not merged into it yet
+    manifest = read_manifest(file)
+    lines = []
+    if os.path.isfile(file):
+        with open(file,'r') as in_:
+            fcntl.flock(in_,fcntl.LOCK_SH)
+            lines = in_.readlines()
+            fcntl.flock(in_,fcntl.LOCK_UN)
+    return lines + read_segment_lines(file,manifest)
+
+def is_running(name):
+    host, pid = name[:-len(SEGMENT_EXT)].rsplit('.',1)
+    if host != socket.gethostname():
+        return True
+    try:
+        os.kill(int(pid),0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def merge_unique(lines):
+    # lines in their order, exact duplicates only kept at their last occurrence
+    seen = set()
+    res = []
+    for line in reversed(lines):
+        if line not in seen:
+            seen.add(line)
+            res.append(line)
+    res.reverse()
+    return res
+
+def compact(file):
+    # merges the new segment lines into <file>; returns the number of new
+    # lines read and of segments removed (writer gone, fully merged)
+    with open(os.path.join(get_segments_folder(file),'compact.lock'),'a') as lock:
+        fcntl.flock(lock,fcntl.LOCK_EX)
+        manifest = read_manifest(file)
+        new = []
+        offsets = dict(manifest['segments'])
+        for name in list_segments(file):
+            data, offsets[name] = read_segment_data(file,name,offsets.get(name,0))
+            new.extend(data.decode('utf-8').splitlines(True))
+        if new:
+            old = []
+            if os.path.isfile(file):
+                with open(file,'r') as in_:
+                    old = in_.readlines()
+            tmpfile = '%s.%d.tmp' % (file,os.getpid())
+            with open(tmpfile,'w') as out:
+                out.writelines(merge_unique(old + new))
+            os.replace(tmpfile,file)
+        removed = 0
+        for name in list(offsets):
+            segment = os.path.join(get_segments_folder(file),name)
+            if not os.path.isfile(segment):
+                del offsets[name]
+            elif not is_running(name) and os.path.getsize(segment) == offsets[name]:
+                os.remove(segment)
+                del offsets[name]
+                removed += 1
+        write_json_atomic(get_manifest_file(file),{ 'segments': offsets })
+        fcntl.flock(lock,fcntl.LOCK_UN)
+    return len(new), removed
+
+def parse_args():
+    parser = ArgumentParser()
+
+    parser.add_argument("command", choices=['enable','compact','status'],
+                        help="switch files to sharded appends, merge their segments or show pending lines")
+    parser.add_argument("files", nargs='+', help="Result files (sites, contacts, scores...)")
+
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    for file in args.files:
+        if args.command == 'enable':
+            enable_sharding(file)
+            print("%s: sharded" % file)
+        elif not os.path.isdir(get_segments_folder(file)):
+            sys.stderr.write("WARNING: '%s' is not sharded\n" % file)
+        elif args.command == 'compact':
+            n, removed = compact(file)
+            print("%s: %d lines merged, %d segments removed" % (file,n,removed))
+        else:
+            manifest = read_manifest(file)
+            print("%s: %d segments, %d lines pending" % (file,len(list_segments(file)),
+                                                         len(read_segment_lines(file,manifest))))
+
+if __name__ == '__main__':
+    main()
@@ -21,10 +21,26 @@ unsigned int ndiff(const char *a, const char *b);
 
 unsigned int levenshtein(const char *a, const char *b);
 
+/* Thresholded distances: return the distance when it is below `max_d`,
+ * `max_d` otherwise. The levenshtein version only fills a band of
+ * 2*max_d-1 diagonals (Ukkonen) and stops as soon as a whole row of the
+ * band reaches `max_d`. */
+
+unsigned int ndiff_bounded(const char *a, unsigned int aLength,
+						   const char *b, unsigned int bLength, unsigned int max_d);
+unsigned int levenshtein_bounded(const char *a, unsigned int aLength,
+								 const char *b, unsigned int bLength, unsigned int max_d);
+
+/* One-vs-many: `buffer` holds `buflen/stride` sequences of `stride`
+ * characters each (shorter sequences are padded with '\0'). Returns the
+ * minimum distance from `a`, stopping at the first sequence closer than
+ * `min_t`; with `min_t` == 0 the exact minimum is returned. */
+
+unsigned int min_distance_buffer(const char *a, const char *buffer, unsigned int buflen,
+								 unsigned int stride, unsigned int min_t, bool use_levenshtein);
+
 bool multiple_levenshtein(const char *a, const char *b, unsigned int len, unsigned int min_t);
 bool multiple_ndiff(const char *a, const char *b, unsigned int len, unsigned int min_t);
-bool multiple_comp(const char *a, const char *b, unsigned int len, unsigned int min_t,
-				   unsigned int (*f)(const char *, const char *));
 
 /* `levenshtein.c` - levenshtein
  * MIT licensed.
@@ -51,78 +67,137 @@ unsigned int ndiff(const char *a, const char *b){
 unsigned int levenshtein(const char *a, const char *b) {
     unsigned int length = strlen(a);
     unsigned int bLength = strlen(b);
-    unsigned int cache[MAX_LEVLENGTH];
-	memset(&cache[0],0,sizeof(unsigned int)*MAX_LEVLENGTH);
-	/* unsigned int *cache = (unsigned int *)calloc(length, sizeof(unsigned int)); */
+    unsigned int stack_cache[MAX_LEVLENGTH];
+    unsigned int *cache = length > MAX_LEVLENGTH ?
+		(unsigned int *)calloc(length, sizeof(unsigned int)) : &stack_cache[0];
 	unsigned int index = 0;
     unsigned int bIndex = 0;
     unsigned int distance;
     unsigned int bDistance;
-    unsigned int result;
+    unsigned int result = 0;
     char code;
 
     /* Shortcut optimizations / degenerate cases. */
     if (a == b) {
-        return 0;
-    }
-
-    if (length == 0) {
-        return bLength;
-    }
-
-    if (bLength == 0) {
-        return length;
-    }
-
-    /* initialize the vector. */
-    while (index < length) {
-        cache[index] = index + 1;
-        index++;
-    }
-
-    /* Loop. */
-    while (bIndex < bLength) {
-        code = b[bIndex];
-        result = distance = bIndex++;
-        index = -1;
-
-        while (++index < length) {
-            bDistance = code == a[index] ? distance : distance + 1;
-            distance = cache[index];
-
-      cache[index] = result = distance > result
-        ? bDistance > result
-          ? result + 1
-          : bDistance
-          : bDistance > distance
-          ? distance + 1
-          : bDistance;
-        }
-    }
-
-	/* free(cache); */
+        result = 0;
+    } else if (length == 0) {
+        result = bLength;
+    } else if (bLength == 0) {
+        result = length;
+    } else {
+		/* initialize the vector. */
+		while (index < length) {
+			cache[index] = index + 1;
+			index++;
+		}
+
+		/* Loop. */
+		while (bIndex < bLength) {
+			code = b[bIndex];
+			result = distance = bIndex++;
+			index = -1;
+
+			while (++index < length) {
+				bDistance = code == a[index] ? distance : distance + 1;
+				distance = cache[index];
+
+				cache[index] = result = distance > result
+					? bDistance > result
+					? result + 1
+					: bDistance
+					: bDistance > distance
+					? distance + 1
+					: bDistance;
+			}
+		}
+	}
+
+	if (cache != &stack_cache[0]) free(cache);
 	
     return result;
 }
 
-bool multiple_levenshtein(const char *a, const char *b, unsigned int len, unsigned int min_t){
-	return multiple_comp(a,b,len,min_t,levenshtein);
+unsigned int ndiff_bounded(const char *a, unsigned int aLength,
+						   const char *b, unsigned int bLength, unsigned int max_d){
+	unsigned int n = aLength > bLength ? aLength - bLength : bLength - aLength;
+	unsigned int length = aLength < bLength ? aLength : bLength;
+	for(unsigned int index=0;index<length && n<max_d;index++){
+		if(a[index] != b[index]) n++;
+	}
+	return n < max_d ? n : max_d;
 }
 
-bool multiple_ndiff(const char *a, const char *b, unsigned int len, unsigned int min_t){
-	return multiple_comp(a,b,len,min_t,ndiff);
+static unsigned int levenshtein_band(const char *a, unsigned int aLength,
+									 const char *b, unsigned int bLength, unsigned int max_d,
+									 unsigned int *prev, unsigned int *cur){
+	/* cells further than k = max_d-1 from the diagonal are >= max_d, every
+	 * value is clamped to max_d; prev and cur hold bLength+2 values */
+	if (max_d == 0) return 0;
+	unsigned int k = max_d - 1;
+	if ((aLength > bLength ? aLength - bLength : bLength - aLength) > k) return max_d;
+	for (unsigned int j=0;j<=bLength+1;j++){
+		prev[j] = j < max_d ? j : max_d;
+	}
+	for (unsigned int i=1;i<=aLength;i++){
+		unsigned int lo = i > k ? i - k : 1;
+		unsigned int hi = i + k < bLength ? i + k : bLength;
+		unsigned int rowmin;
+		cur[lo-1] = lo == 1 && i < max_d ? i : max_d;
+		rowmin = cur[lo-1];
+		char code = a[i-1];
+		for (unsigned int j=lo;j<=hi;j++){
+			unsigned int v = prev[j-1] + (code == b[j-1] ? 0 : 1);
+			if (prev[j] + 1 < v) v = prev[j] + 1;
+			if (cur[j-1] + 1 < v) v = cur[j-1] + 1;
+			if (v > max_d) v = max_d;
+			cur[j] = v;
+			if (v < rowmin) rowmin = v;
+		}
+		cur[hi+1] = max_d;
+		if (rowmin >= max_d) return max_d;
+		unsigned int *tmp = prev; prev = cur; cur = tmp;
+	}
+	return prev[bLength] < max_d ? prev[bLength] : max_d;
+}
+
+unsigned int levenshtein_bounded(const char *a, unsigned int aLength,
+								 const char *b, unsigned int bLength, unsigned int max_d){
+	unsigned int *ws = (unsigned int *)malloc(2 * (bLength + 2) * sizeof(unsigned int));
+	unsigned int r = levenshtein_band(a,aLength,b,bLength,max_d,ws,ws+bLength+2);
+	free(ws);
+	return r;
+}
+
+unsigned int min_distance_buffer(const char *a, const char *buffer, unsigned int buflen,
+								 unsigned int stride, unsigned int min_t, bool use_levenshtein){
+	unsigned int length = strlen(a);
+	/* nothing can be further than this, so min_t == 0 gives exact distances */
+	unsigned int max_d = min_t != 0 ? min_t : length + stride + 1;
+	unsigned int min_l = max_d;
+	unsigned int *ws = NULL;
+	if (stride == 0) return min_l;
+	if (use_levenshtein) ws = (unsigned int *)malloc(2 * (stride + 2) * sizeof(unsigned int));
+	for (unsigned int i=0;i+stride<=buflen;i+=stride){
+		const char *b = &buffer[i];
+		unsigned int bLength = strnlen(b,stride);
+		/* only distances below the current minimum matter */
+		unsigned int r = use_levenshtein ?
+			levenshtein_band(a,length,b,bLength,min_l,ws,ws+stride+2) :
+			ndiff_bounded(a,length,b,bLength,min_l);
+		if (r < min_l){ min_l = r; if (min_t != 0 && min_l < min_t) break; }
+	}
+	if (ws) free(ws);
+	return min_l;
 }
 
-bool multiple_comp(const char *a, const char *b, unsigned int len, unsigned int min_t,
-				   unsigned int (*f)(const char *, const char *)){
-    char buffer[MAX_LEVLENGTH];
-	unsigned int min_l = 1e9;
-    for(unsigned int i=0;i<(unsigned int)(strlen(b));i+=len){
-        strncpy(&buffer[0],&b[i],len); buffer[len]='\0';
-		unsigned int r = f(a,(const char *)buffer);
-		if(r<min_l){ min_l=r; if(min_t!=0 && min_l<min_t){ return false; } }
-    }
-    return true;
+bool multiple_levenshtein(const char *a, const char *b, unsigned int len, unsigned int min_t){
+	if (min_t == 0) return true;
+	return min_distance_buffer(a,b,strlen(b),len,min_t,true) >= min_t;
+}
+
+bool multiple_ndiff(const char *a, const char *b, unsigned int len, unsigned int min_t){
+	if (min_t == 0) return true;
+	return min_distance_buffer(a,b,strlen(b),len,min_t,false) >= min_t;
 }
 
 #endif // LEVENSHTEIN_H
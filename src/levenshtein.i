@@ -4,4 +4,17 @@
     #include "levenshtein.h"
 %}
 
+/* any object exposing the buffer protocol (bytes, numpy arrays, mmaps) is
+ * passed to the one-vs-many entry points without being copied */
+%typemap(in) (const char *buffer, unsigned int buflen) (Py_buffer view) {
+    if (PyObject_GetBuffer($input, &view, PyBUF_SIMPLE) != 0) {
+        SWIG_fail;
+    }
+    $1 = (char *)view.buf;
+    $2 = (unsigned int)view.len;
+}
+%typemap(freearg) (const char *buffer, unsigned int buflen) {
+    PyBuffer_Release(&view$argnum);
+}
+
 %include "levenshtein.h"
@@ -0,0 +1,15 @@
+/* generated by predids.py, do not edit */
+#ifndef PREDICTION_ID_H
+#define PREDICTION_ID_H
+
+#define PREDICTION_ID_BITS 63
+#define PREDICTION_ID_VERSION_BITS 3
+#define PREDICTION_ID_VERSION 1
+
+#define PREDICTION_ID_V1_TOP_BITS 12
+#define PREDICTION_ID_V1_MOL_BITS 24
+#define PREDICTION_ID_V1_TOP_SHIFT 48
+#define PREDICTION_ID_V1_MOL1_SHIFT 24
+#define PREDICTION_ID_V1_MOL2_SHIFT 0
+
+#endif // PREDICTION_ID_H
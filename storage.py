@@ -0,0 +1,374 @@
+from darpins import *
+import datetime
+import json
+import sqlite3
+
+try:
+    from bson.objectid import ObjectId
+except:
+    pass
+
+# storage backends for the design and prediction collections. The default is
+# MongoDB (one pooled client per process, see get_mongo_client); setting
+#
+#   DARPINS_STORAGE=sqlite:/path/to/darpins.sqlite
+#
+# keeps every collection as a table of a single local SQLite file instead, for
+# runs on a laptop or a cluster node without a mongo server. SqliteCollection
+# implements the part of the pymongo collection API the scripts use: find and
+# find_one with projections, equality/$in/$gt/.../$or filters and sorts,
+# count, insert_one, insert_many and create_index. uid, shortuid, type and
+# parent are real (indexable) columns; other fields are matched on the stored
+# document.
+SQLITE_COLUMNS = ('uid','shortuid','type','parent')
+SQLITE_BATCH = 1000
+DUPLICATE_KEY_ERROR = 11000
+
+class DuplicateKeyError(Exception):
+
+    def __init__(self,message):
+        Exception.__init__(self,message)
+        self.code = DUPLICATE_KEY_ERROR
+
+class BulkWriteError(Exception):
+
+    # same details layout as pymongo's BulkWriteError
+    def __init__(self,details):
+        Exception.__init__(self,"batch op errors occurred")
+        self.details = details
+
+DUPLICATE_KEY_ERRORS = (DuplicateKeyError,)
+BULK_WRITE_ERRORS = (BulkWriteError,)
+try:
+    import pymongo.errors
+    DUPLICATE_KEY_ERRORS += (pymongo.errors.DuplicateKeyError,)
+    BULK_WRITE_ERRORS += (pymongo.errors.BulkWriteError,)
+except:
+    pass
+
+class InsertOneResult:
+
+    def __init__(self,inserted_id):
+        self.inserted_id = inserted_id
+
+class InsertManyResult:
+
+    def __init__(self,inserted_ids):
+        self.inserted_ids = inserted_ids
+
+def encode_value(o):
+    if isinstance(o,datetime.datetime):
+        return { '$date': o.isoformat() }
+    raise TypeError("cannot store %s" % type(o).__name__)
+
+def decode_value(d):
+    if len(d) == 1 and '$date' in d:
+        return datetime.datetime.fromisoformat(d['$date'])
+    return d
+
+def encode_document(d):
+    return json.dumps({ k: v for k,v in d.items() if k != '_id' },default=encode_value)
+
+def decode_document(_id,doc):
+    d = json.loads(doc,object_hook=decode_value)
+    d['_id'] = _id
+    return d
+
+def project_document(d,projection):
+    if not projection: return d
+    if any([ v for k,v in projection.items() if k != '_id' ]):
+        res = { k: d[k] for k in projection if projection[k] and k in d }
+        if projection.get('_id',1): res['_id'] = d['_id']
+        return res
+    return { k: v for k,v in d.items() if projection.get(k,1) }
+
+def match_condition(value,cond):
+    if not isinstance(cond,dict) or not any([ k.startswith('$') for k in cond ]):
+        return value == cond
+    for op, arg in cond.items():
+        if op == '$in': ok = value in arg
+        elif op == '$nin': ok = value not in arg
+        elif op == '$ne': ok = value != arg
+        elif op == '$exists': ok = (value is not None) == bool(arg)
+        elif value is None: ok = False
+        elif op == '$gt': ok = value > arg
+        elif op == '$gte': ok = value >= arg
+        elif op == '$lt': ok = value < arg
+        elif op == '$lte': ok = value <= arg
+        else: raise ValueError("unsupported query operator '%s'" % op)
+        if not ok: return False
+    return True
+
+def match_document(d,query):
+    for k, cond in query.items():
+        if k == '$or':
+            if not any([ match_document(d,q) for q in cond ]): return False
+        elif k == '$and':
+            if not all([ match_document(d,q) for q in cond ]): return False
+        elif not match_condition(d.get(k),cond):
+            return False
+    return True
+
+SQL_OPERATORS = { '$gt': '>', '$gte': '>=', '$lt': '<', '$lte': '<=', '$ne': '!=' }
+
+def compile_condition(column,cond):
+    # (sql, params) of one column condition, None if it has to be matched in python
+    if not isinstance(cond,dict):
+        if cond is None: return '%s IS NULL' % column, []
+        return '%s = ?' % column, [cond]
+    sql = []
+    params = []
+    for op, arg in cond.items():
+        if op == '$in' and None not in arg:
+            sql.append('%s IN (%s)' % (column,','.join([ '?' for v in arg ]) or 'NULL'))
+            params += list(arg)
+        elif op in SQL_OPERATORS and arg is not None:
+            sql.append('%s %s ?' % (column,SQL_OPERATORS[op]))
+            params.append(arg)
+        else:
+            return None
+    return ' AND '.join(sql), params
+
+def compile_query(query):
+    # splits a filter in a sql where clause over the columns and a rest matched
+    # on the documents
+    sql = []
+    params = []
+    rest = {}
+    for k, cond in query.items():
+        res = None
+        if k == '$or':
+            parts = [ compile_query(q) for q in cond ]
+            if parts and all([ not r for s,p,r in parts ]):
+                res = '(%s)' % ' OR '.join([ '(%s)' % (s or '1') for s,p,r in parts ]), \
+                      [ v for s,p,r in parts for v in p ]
+        elif k == '_id' or k in SQLITE_COLUMNS:
+            res = compile_condition(k,cond)
+        if res is None:
+            rest[k] = cond
+        else:
+            sql.append(res[0])
+            params += res[1]
+    return ' AND '.join(sql), params, rest
+
+class SqliteCursor:
+
+    # lazy, pymongo-like cursor: rows are streamed from sqlite in batches
+    def __init__(self,coll,query,projection):
+        self.coll = coll
+        self.query = query if query else {}
+        self.projection = projection
+        self.order = []
+        self.nskip = 0
+        self.nlimit = 0
+
+    def sort(self,keys,direction=None):
+        if isinstance(keys,str):
+            keys = [ (keys,direction if direction else 1) ]
+        self.order = list(keys)
+        return self
+
+    def skip(self,n):
+        self.nskip = n
+        return self
+
+    def limit(self,n):
+        self.nlimit = n
+        return self
+
+    def __getitem__(self,index):
+        if isinstance(index,slice) and index.step is None and index.stop is None:
+            return self.skip(self.nskip + (index.start or 0))
+        if isinstance(index,int):
+            for d in self.skip(self.nskip + index).limit(1):
+                return d
+            raise IndexError("no such item for cursor")
+        raise IndexError("unsupported cursor slice")
+
+    def __iter__(self):
+        where, params, rest = compile_query(self.query)
+        columns = [ k for k,v in self.order ]
+        sql = 'SELECT _id, doc FROM "%s"' % self.coll.name
+        if where: sql += ' WHERE ' + where
+        if all([ c == '_id' or c in SQLITE_COLUMNS for c in columns ]):
+            if self.order:
+                sql += ' ORDER BY ' + ', '.join([ '%s %s' % (k,'DESC' if v < 0 else 'ASC')
+                                                  for k,v in self.order ])
+            if not rest and (self.nlimit or self.nskip):
+                sql += ' LIMIT %d OFFSET %d' % (self.nlimit if self.nlimit else -1,self.nskip)
+                return self.stream(sql,params,{},0,0,self.projection)
+            return self.stream(sql,params,rest,self.nskip,self.nlimit,self.projection)
+        docs = [ d for d in self.stream(sql,params,rest,0,0,None) ]
+        for k, v in reversed(self.order):
+            docs.sort(key=lambda d: (d.get(k) is not None,d.get(k)),reverse=v < 0)
+        docs = docs[self.nskip:self.nskip+self.nlimit if self.nlimit else None]
+        return iter([ project_document(d,self.projection) for d in docs ])
+
+    def stream(self,sql,params,rest,nskip,nlimit,projection):
+        cur = self.coll.get_connection().execute(sql,params)
+        n = 0
+        while True:
+            rows = cur.fetchmany(SQLITE_BATCH)
+            if not rows: break
+            for _id, doc in rows:
+                d = decode_document(_id,doc)
+                if rest and not match_document(d,rest): continue
+                n += 1
+                if n <= nskip: continue
+                yield project_document(d,projection)
+                if nlimit and n - nskip >= nlimit: return
+
+class SqliteCollection:
+
+    def __init__(self,file,name):
+        self.file = file
+        self.name = name
+        self.conn = None
+        self.pid = None
+
+    def get_connection(self):
+        # sqlite connections do not survive a fork, each process opens its own
+        if self.conn is None or self.pid != os.getpid():
+            self.conn = sqlite3.connect(self.file,timeout=600,isolation_level=None)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS "%s" (_id INTEGER PRIMARY KEY AUTOINCREMENT, %s, doc TEXT NOT NULL)' %
+                              (self.name,', '.join([ '%s TEXT' % c for c in SQLITE_COLUMNS ])))
+            self.pid = os.getpid()
+        return self.conn
+
+    def create_index(self,keys,unique=False):
+        if isinstance(keys,str): keys = [ (keys,1) ]
+        columns = [ k for k,v in keys ]
+        name = '%s_%s' % (self.name,'_'.join([ '%s_%s' % (k,v) for k,v in keys ]))
+        if all([ c in SQLITE_COLUMNS for c in columns ]):
+            self.get_connection().execute('CREATE %sINDEX IF NOT EXISTS "%s" ON "%s" (%s)' %
+                                          ('UNIQUE ' if unique else '',name,self.name,', '.join(columns)))
+        return name
+
+    def find(self,query=None,projection=None):
+        return SqliteCursor(self,query,projection)
+
+    def find_one(self,query=None,projection=None):
+        for d in self.find(query,projection).limit(1):
+            return d
+        return None
+
+    def count(self,query=None):
+        where, params, rest = compile_query(query if query else {})
+        if rest:
+            return sum([ 1 for d in self.find(query,{ '_id': 1 }) ])
+        sql = 'SELECT COUNT(*) FROM "%s"' % self.name
+        if where: sql += ' WHERE ' + where
+        return self.get_connection().execute(sql,params).fetchone()[0]
+
+    def count_documents(self,query):
+        return self.count(query)
+
+    def insert_row(self,conn,d):
+        cur = conn.execute('INSERT INTO "%s" (%s, doc) VALUES (%s, ?)' %
+                           (self.name,', '.join(SQLITE_COLUMNS),','.join([ '?' for c in SQLITE_COLUMNS ])),
+                           [ d.get(c) for c in SQLITE_COLUMNS ] + [ encode_document(d) ])
+        d['_id'] = cur.lastrowid
+        return d['_id']
+
+    def insert_one(self,d):
+        try:
+            return InsertOneResult(self.insert_row(self.get_connection(),d))
+        except sqlite3.IntegrityError as e:
+            raise DuplicateKeyError(str(e))
+
+    def insert_many(self,docs,ordered=True):
+        # one transaction; duplicates are reported like mongo does, with the
+        # other documents inserted when not ordered
+        conn = self.get_connection()
+        ids = []
+        errors = []
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for k, d in enumerate(docs):
+                try:
+                    ids.append(self.insert_row(conn,d))
+                except sqlite3.IntegrityError as e:
+                    errors.append({ 'index': k, 'code': DUPLICATE_KEY_ERROR, 'errmsg': str(e) })
+                    if ordered: break
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        if errors:
+            raise BulkWriteError({ 'writeErrors': errors, 'nInserted': len(ids) })
+        return InsertManyResult(ids)
+
+def get_sqlite_file(url):
+    path = url[len('sqlite:'):]
+    if path.startswith('//'): path = path[2:]
+    return path if path else os.path.join(datadir,'darpins.sqlite')
+
+sqlite_collections = {}
+
+def get_sqlite_collection(url,coll):
+    key = (get_sqlite_file(url),coll)
+    if key not in sqlite_collections:
+        sqlite_collections[key] = SqliteCollection(*key)
+    return sqlite_collections[key]
+
+def is_sqlite_collection(coll):
+    return isinstance(coll,SqliteCollection)
+
+def get_id(coll,hwm):
+    # _id of a collection from its str(_id), e.g. a high-water mark
+    if is_sqlite_collection(coll):
+        return int(hwm)
+    return ObjectId(hwm)
+
+def get_id_after(coll,hwm):
+    # _id condition for the documents inserted after the high-water mark hwm,
+    # a str(_id) of the same collection
+    return { '$gt': get_id(coll,hwm) }
+
+def find_after(coll,query,projection,hwm):
+    # documents of query inserted after hwm (all of them if hwm is None), in
+    # insertion order
+    query = dict(query)
+    if hwm:
+        query['_id'] = get_id_after(coll,hwm)
+    return coll.find(query,projection).sort([('_id',ASCENDING)])
+
+def find_before(coll,query,projection,hwm,n):
+    # the n last documents of query up to hwm (included), latest first: the
+    # window where the documents of other writers land below the mark
+    query = dict(query)
+    query['_id'] = { '$lte': get_id(coll,hwm) }
+    return coll.find(query,projection).sort([('_id',-ASCENDING)]).limit(n)
+
+def copy_collection(src,dst,batch=SQLITE_BATCH):
+    # copies documents whose uid is not in dst yet, e.g. from mongo to a sqlite file
+    n = 0
+    docs = []
+    for d in src.find().sort([('_id',ASCENDING)]):
+        d = { k: v for k,v in d.items() if k != '_id' }
+        docs.append(d)
+        if len(docs) >= batch:
+            n += insert_missing(dst,docs)
+            docs = []
+    if docs:
+        n += insert_missing(dst,docs)
+    return n
+
+def insert_missing(coll,docs):
+    try:
+        return len(coll.insert_many(docs,ordered=False).inserted_ids)
+    except BULK_WRITE_ERRORS as e:
+        return e.details.get('nInserted',0)
+
+if __name__ == '__main__':
+    # python storage.py <sqlite file> [--test]: copies the mongo collections to a sqlite file
+    test = '--test' in sys.argv
+    file = [ a for a in sys.argv[1:] if a != '--test' ][0]
+    for coll in [ 'designs', 'predictions' ]:
+        src = get_mongo_collection(coll,test=test)
+        dst = get_sqlite_collection('sqlite:' + file,src.name)
+        if coll == 'designs':
+            ensure_design_indexes(dst)
+        print("%s: %d documents copied" % (src.name,copy_collection(src,dst)))
@@ -0,0 +1,85 @@
+from darpins import *
+from shardlog import read_manifest, list_segments, read_segment_data
+
+# readers for the append-only result files: they remember the inode and the
+# byte offset already consumed, and a refresh only parses the complete lines
+# appended since (a truncated or replaced file is read again from the start).
+# Sharded files are followed the same way, segment by segment (see shardlog.py)
+
+class TailReader:
+
+    def __init__(self,file,lock=True):
+        self.file = file
+        self.lock = lock
+        self.reset()
+
+    def reset(self):
+        self.inode = None
+        self.offset = 0
+        self.segments = None
+        self.clear()
+
+    def clear(self):
+        pass
+
+    def parse_line(self,line):
+        pass
+
+    def read_new_data(self):
+        with open(self.file,'rb') as in_:
+            st = os.fstat(in_.fileno())
+            if st.st_ino != self.inode or st.st_size < self.offset:
+                self.reset()
+                self.inode = st.st_ino
+            if st.st_size == self.offset:
+                return b''
+            if self.lock: fcntl.flock(in_,fcntl.LOCK_SH)
+            in_.seek(self.offset)
+            data = in_.read()
+            if self.lock: fcntl.flock(in_,fcntl.LOCK_UN)
+        # a line still being written is left for the next refresh
+        end = data.rfind(b'\n') + 1
+        self.offset += end
+        return data[:end]
+
+    def read_new_segment_data(self,manifest):
+        # after a compaction (new inode, so a reset) segments are read again
+        # from the offsets merged into the file
+        if self.segments is None:
+            self.segments = dict(manifest['segments'])
+        data = []
+        for name in list_segments(self.file):
+            res, self.segments[name] = read_segment_data(self.file,name,self.segments.get(name,0))
+            data.append(res)
+        return b''.join(data)
+
+    def refresh(self):
+        # returns the number of new lines
+        manifest = read_manifest(self.file) if is_sharded(self.file) else None
+        if os.path.isfile(self.file):
+            data = self.read_new_data()
+        else:
+            if self.inode is not None: self.reset()
+            data = b''
+        if manifest is not None:
+            data += self.read_new_segment_data(manifest)
+        lines = data.decode('utf-8').splitlines(True)
+        for line in lines:
+            self.parse_line(line)
+        return len(lines)
+
+class SitesReader(TailReader):
+
+    def clear(self):
+        self.sites = {}
+
+    def parse_line(self,line):
+        parse_sites_line(self.sites,line)
+
+class ContactsReader(TailReader):
+
+    def clear(self):
+        self.contacts = {}
+
+    def parse_line(self,line):
+        parse_contacts_line(self.contacts,line)
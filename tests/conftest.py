@@ -0,0 +1,15 @@
+import os
+import sys
+import tempfile
+
+# darpins builds its folders under $HOME at import time, so the tests get a
+# home of their own before any module of the repo is imported
+os.environ['HOME'] = tempfile.mkdtemp(prefix='darpins-tests-')
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+@pytest.fixture
+def designs(tmp_path):
+    from storage import SqliteCollection
+    return SqliteCollection(str(tmp_path / 'designs.sqlite'),'designs')
@@ -0,0 +1,20 @@
+import numpy as np
+from darpins import hash
+from design import DesignEngine, get_parser
+
+def get_args(*argv):
+    return get_parser().parse_args(list(argv))
+
+def test_batch_compares_accepted_candidates_with_levenshtein(designs,tmp_path):
+    seq = 'ACACAC'
+    engine = DesignEngine(designs,hash(seq),seq,{ 'merged': [1]*len(seq) },
+                          folder=str(tmp_path),emit=lambda d: None)
+    args = get_args('--lev_full','--lev_python','-l','3','--batch','10','--no_insert')
+    engine.set_state(args)
+    engine.naccepted = 0
+    # hamming distance 6, levenshtein distance 2
+    cands = [ 'ACACAC', 'CACACA' ]
+    batch = np.array([ list(bytes(c,'ascii')) for c in cands ],dtype=np.uint8)
+    mutmasks = np.ones(batch.shape,dtype=np.uint8)
+    accepted = engine.accept_candidates(batch,mutmasks,[ hash(c) for c in cands ],args,10)
+    assert len(accepted) == 1
@@ -0,0 +1,21 @@
+from interfaces import open_interface_index
+
+def write_sites(file,poses):
+    with open(file,'w') as out:
+        for design, mol, top, residues in poses:
+            out.write("%s\tT\t%s\t%d\t%s\n" % (design,mol,top,','.join(residues)))
+
+def test_overlap_numbers_residues_per_mol(tmp_path):
+    # both mols have a residue R5, which must not count as the same residue
+    file = str(tmp_path / 'x.sites')
+    write_sites(file,[ ('d1','A',0,[ 'R1','R5' ]), ('d1','B',0,[ 'R5','R9' ]),
+                       ('d2','A',0,[ 'R9' ]), ('d2','B',0,[ 'R1','R5' ]) ])
+    index = open_interface_index(file)
+    ref = index.get_bitset('T','A',[ 'R1','R5' ])
+    res = { d: j for d, top, j in index.overlap(ref,'T') }
+    # d1: {A:R1,A:R5,B:R5,B:R9} vs {A:R1,A:R5}; d2 shares no (mol, residue)
+    assert res['d1'] == 0.5
+    assert res['d2'] == 0.0
+    res = { d: j for d, top, j in index.overlap(ref,'T',mol='A') }
+    assert res == { 'd1': 1.0, 'd2': 0.0 }
+    assert not (index.get_bitset('T','B',[ 'R1' ]) & index.get_bitset('T','A',[ 'R1' ])).any()
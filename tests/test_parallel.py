@@ -0,0 +1,24 @@
+import numpy as np
+import parallel
+
+def test_worker_reads_only_the_new_accepted_rows(tmp_path):
+    seq = 'ACDEFG'
+    mask = [1]*len(seq)
+    base = np.frombuffer(b'ACDEFG',dtype=np.uint8).reshape(1,-1)
+    params = { 'metric': 'hamming', 'backend': 'numpy', 'alphabet_change': False,
+               'weights': None, 'pivots': 0 }
+    rowsfile = str(tmp_path / 'accepted.rows')
+    open(rowsfile,'wb').close()
+    parallel.init_worker(seq,mask,'',base,rowsfile,params)
+    library = parallel.worker['library']
+    rows = [ b'CCCCCC', b'DDDDDD', b'EEEEEE' ]
+    with open(rowsfile,'ab') as out:
+        out.write(b''.join(rows[0:2]))
+        out.flush()
+        parallel.read_accepted_rows(2)
+        out.write(rows[2])
+        out.flush()
+        parallel.read_accepted_rows(3)
+        # a task submitted earlier does not read anything again
+        parallel.read_accepted_rows(2)
+    assert [ bytes(r) for r in library.rows() ] == rows
@@ -0,0 +1,24 @@
+import os
+from darpins import is_prepared
+from prepmanifest import PreparationManifest
+
+def write_file(path,data='x'):
+    os.makedirs(os.path.dirname(path),exist_ok=True)
+    with open(path,'w') as out:
+        out.write(data)
+
+def test_manifest_pairs_models_like_is_prepared(tmp_path):
+    root = str(tmp_path / 'models')
+    write_file(os.path.join(root,'a','mol2','d1.mol2'))
+    write_file(os.path.join(root,'a','prmtop','d1.prmtop'))
+    write_file(os.path.join(root,'a','mol2','d2.mol2'))
+    write_file(os.path.join(root,'a','mol2','d2.prmtop'))
+    write_file(os.path.join(root,'b','d3.mol2'))
+    write_file(os.path.join(root,'b','d3.prmtop'),'')
+    manifest = PreparationManifest(root,folder=str(tmp_path))
+    manifest.refresh()
+    for name, dir in [ ('d1','a/mol2'), ('d2','a/mol2'), ('d3','b') ]:
+        mol2file = os.path.join(root,dir,name + '.mol2')
+        assert manifest.is_prepared(mol2file) == is_prepared(mol2file)
+    assert manifest.get_prepared_files('d1') == [ os.path.join(root,'a','mol2','d1.mol2') ]
+    assert len(manifest) == 1
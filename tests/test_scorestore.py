@@ -0,0 +1,17 @@
+from scorestore import ScoreStore
+
+def test_rewritten_key_keeps_the_last_value(tmp_path):
+    file = str(tmp_path / 'scores.tsv')
+    with open(file,'w') as out:
+        out.write('d1\tt1\t1\tenergy\t-5.0\nd2\tt1\t1\tenergy\t-3.0\n')
+    store = ScoreStore(file)
+    # appended lines are merged into the saved columns
+    with open(file,'a') as out:
+        out.write('d1\tt1\t1\tenergy\t-8.0\n')
+    store = ScoreStore(file)
+    assert len(store) == 2
+    assert store.top_designs('energy',agg='max') == [ ('d1',-8.0), ('d2',-3.0) ]
+    # and in-memory lines on top of them
+    store.add_lines([ 'd2\tt1\t1\tenergy\t-9.0\n' ])
+    assert store.top_designs('energy',agg='max') == [ ('d2',-9.0), ('d1',-8.0) ]
+    assert store.view()['d2']['t1'] == { 1: { 'energy': -9.0 } }
@@ -0,0 +1,19 @@
+from darpins import hash
+from seqindex import MaskedIndex, write_json_atomic
+
+def insert_designs(designs,seqs):
+    designs.insert_many([ { 'uid': hash(s), 'seq': s, 'type': 'test', 'parent': 'p' } for s in seqs ])
+
+def test_sync_adds_designs_inserted_below_the_high_water_mark(designs,tmp_path):
+    index = MaskedIndex('p','test',[1,1,1],folder=str(tmp_path))
+    insert_designs(designs,[ 'AAA', 'CCC' ])
+    index.sync(designs)
+    insert_designs(designs,[ 'GGG', 'TTT' ])
+    # a concurrent writer: TTT was synced first, GGG got an _id below it
+    index.meta['hwm'] = str(designs.find_one({ 'seq': 'GGG' })['_id'])
+    index.fetch(designs)
+    write_json_atomic(index.metafile,index.meta)
+    index.sync(designs)
+    assert len(index) == 4
+    # appended from the window below the mark, not rebuilt in _id order
+    assert [ bytes(u).hex() for u in index.uids ] == [ hash(s) for s in [ 'AAA', 'CCC', 'TTT', 'GGG' ] ]
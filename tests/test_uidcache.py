@@ -0,0 +1,13 @@
+from darpins import hash
+from uidcache import UidCache
+
+def test_refresh_finds_uids_inserted_below_the_high_water_mark(designs,tmp_path):
+    uids = [ hash('design%d' % i) for i in range(3) ]
+    designs.insert_many([ { 'uid': u } for u in uids[0:2] ])
+    cache = UidCache(designs,folder=str(tmp_path))
+    designs.insert_one({ 'uid': uids[2] })
+    # another writer's _id sorted below the one already fetched
+    cache.meta['hwm'] = str(designs.find_one({ 'uid': uids[2] })['_id'])
+    cache.refresh()
+    assert cache.meta['nuids'] == 3
+    assert cache.find_existing(uids) == set(uids)
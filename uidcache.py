@@ -0,0 +1,136 @@
+from darpins import *
+from seqindex import write_json_atomic
+from storage import find_after
+import json
+import math
+import numpy as np
+
+# existence cache for design uids: a bloom filter answers "surely new" for
+# almost every candidate, mongo is only asked when the filter reports a hit.
+# The filter is saved in datadir as <collection>.bloom with a json header
+# holding the number of uids and the high-water mark (last mongo _id added).
+BLOOM_VERSION = 1
+BLOOM_HASHES = 10
+BLOOM_ERROR = 0.001
+BLOOM_MIN_CAPACITY = 1 << 20
+
+def get_bloom_nbits(capacity,error=BLOOM_ERROR):
+    nbits = int(-capacity * math.log(error) / (math.log(2) ** 2))
+    return (nbits + 63) // 64 * 64
+
+def get_bloom_positions(uids,nbits,k=BLOOM_HASHES):
+    # uids are sha224 hex digests already, so two 64-bit slices of them give
+    # the double hashing h1 + i*h2
+    h = np.array([ (int(u[0:16],16),int(u[16:32],16)) for u in uids ],dtype=np.uint64).reshape(-1,2)
+    i = np.arange(k,dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        pos = h[:,0:1] + i[None,:] * (h[:,1:2] | np.uint64(1))
+    return pos % np.uint64(nbits)
+
+class BloomFilter:
+
+    def __init__(self,capacity,bits=None):
+        self.capacity = capacity
+        self.nbits = get_bloom_nbits(capacity)
+        self.bits = bits if bits is not None else np.zeros(self.nbits // 8,dtype=np.uint8)
+
+    def add(self,uids):
+        pos = get_bloom_positions(uids,self.nbits)
+        np.bitwise_or.at(self.bits,(pos >> np.uint64(3)).astype(np.int64),
+                         (np.uint8(1) << (pos & np.uint64(7)).astype(np.uint8)))
+
+    def might_contain(self,uids):
+        pos = get_bloom_positions(uids,self.nbits)
+        hit = self.bits[(pos >> np.uint64(3)).astype(np.int64)] >> (pos & np.uint64(7)).astype(np.uint8)
+        return np.all(hit & 1,axis=1)
+
+class UidCache:
+
+    def __init__(self,designs,folder=datadir):
+        self.designs = designs
+        prefix = os.path.join(folder,'%s.bloom' % designs.name)
+        self.bloomfile = prefix
+        self.metafile = prefix + '.json'
+        self.lockfile = prefix + '.lock'
+        self.added = set()
+        self.load()
+
+    def empty(self,capacity):
+        self.bloom = BloomFilter(max(BLOOM_MIN_CAPACITY,2*capacity))
+        self.meta = { 'version': BLOOM_VERSION, 'capacity': self.bloom.capacity,
+                      'nuids': 0, 'hwm': None }
+
+    def read(self):
+        if not os.path.isfile(self.metafile) or not os.path.isfile(self.bloomfile):
+            return False
+        meta = json.load(open(self.metafile))
+        if meta.get('version') != BLOOM_VERSION: return False
+        bits = np.fromfile(self.bloomfile,dtype=np.uint8)
+        bloom = BloomFilter(meta['capacity'],bits=bits)
+        if len(bits) != bloom.nbits // 8: return False
+        self.bloom = bloom
+        self.meta = meta
+        return True
+
+    def fetch(self):
+        uids = []
+        hwm = self.meta['hwm']
+        for d in find_after(self.designs,{},{ 'uid': 1 },hwm):
+            uids.append(d['uid'])
+            hwm = str(d['_id'])
+        if uids:
+            self.bloom.add(uids)
+        self.meta['nuids'] += len(uids)
+        self.meta['hwm'] = hwm
+
+    def load(self):
+        # reads the saved filter and adds the uids inserted since it was saved;
+        # rebuilds from the whole collection when counts disagree or the filter
+        # is getting full
+        with open(self.lockfile,'a') as lock:
+            fcntl.flock(lock,fcntl.LOCK_EX)
+            self.count = count = self.designs.count()
+            if not self.read() or self.meta['nuids'] > count or count > self.meta['capacity']:
+                self.empty(count)
+            nuids = self.meta['nuids']
+            self.fetch()
+            if self.meta['nuids'] < count:
+                self.empty(count)
+                self.fetch()
+            if self.meta['nuids'] != nuids:
+                self.bloom.bits.tofile(self.bloomfile + '.%d.tmp' % os.getpid())
+                os.replace(self.bloomfile + '.%d.tmp' % os.getpid(),self.bloomfile)
+                write_json_atomic(self.metafile,self.meta)
+            fcntl.flock(lock,fcntl.LOCK_UN)
+
+    def refresh(self):
+        # adds the uids other processes inserted since the load, for long-lived
+        # caches; only the count is asked while the collection does not change
+        count = self.designs.count()
+        if count != self.count:
+            self.fetch()
+            if self.meta['nuids'] < count:
+                # a uid inserted below the high-water mark: same rebuild as load()
+                self.empty(count)
+                self.fetch()
+                if self.added:
+                    self.bloom.add(list(self.added))
+            self.count = count
+
+    def add(self,uids):
+        # uids accepted by this process (possibly not written yet); they reach
+        # the saved filter on the next load
+        self.bloom.add(uids)
+        self.added.update(uids)
+
+    def find_existing(self,uids):
+        # subset of <uids> already in the database or accepted by this process
+        if not uids: return set()
+        found = set([ u for u in uids if u in self.added ])
+        maybe = [ u for u,hit in zip(uids,self.bloom.might_contain(uids)) if hit and u not in found ]
+        if not maybe: return found
+        found.update([ d['uid'] for d in self.designs.find({ 'uid': { '$in': maybe } },{ 'uid': 1 }) ])
+        return found
+
+    def exists(self,uid):
+        return uid in self.find_existing([uid])
@@ -0,0 +1,76 @@
+from darpins import *
+from storage import BULK_WRITE_ERRORS, DUPLICATE_KEY_ERROR
+import atexit
+import signal
+import time
+
+# writers of this process, flushed on SIGTERM once handle_sigterm() is called
+writers = []
+
+class DesignWriter:
+
+    # collects accepted design documents and writes them with insert_many
+    # once <size> documents are pending or <interval> seconds went by;
+    # pending documents are flushed at exit and on SIGTERM (see
+    # handle_sigterm); documents that fail for another reason than being
+    # duplicates stay pending. With metrics, the latency of every insert_many
+    # goes to the 'mongo_insert' histogram
+
+    def __init__(self,designs,size=1000,interval=10.0,metrics=None):
+        self.designs = designs
+        self.metrics = metrics
+        self.size = size
+        self.interval = interval
+        self.pending = []
+        self.last = time.time()
+        self.ninserted = 0
+        ensure_design_indexes(designs)
+        atexit.register(self.flush)
+        writers.append(self)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self,d):
+        self.pending.append(d)
+        self.poll()
+
+    def poll(self):
+        if len(self.pending) >= self.size or \
+           (self.pending and time.time() - self.last >= self.interval):
+            self.flush()
+
+    def flush(self):
+        self.last = time.time()
+        if not self.pending: return
+        docs = self.pending
+        t0 = time.perf_counter()
+        try:
+            res = self.designs.insert_many(docs,ordered=False)
+            self.ninserted += len(res.inserted_ids)
+            self.pending = []
+        except BULK_WRITE_ERRORS as e:
+            errors = e.details.get('writeErrors',[])
+            others = [ err for err in errors if err.get('code') != DUPLICATE_KEY_ERROR ]
+            self.ninserted += e.details.get('nInserted',0)
+            for err in errors:
+                if err.get('code') == DUPLICATE_KEY_ERROR:
+                    sys.stderr.write("WARNING: design '%s' already exists, skipped\n" %
+                                     docs[err['index']]['uid'])
+            self.pending = [ docs[err['index']] for err in others ]
+            if others:
+                raise
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe('mongo_insert',time.perf_counter() - t0,histogram=True)
+
+def terminate(signum,frame):
+    for writer in writers:
+        sys.stderr.write("WARNING: terminated, flushing %d designs\n" % len(writer))
+        writer.flush()
+    sys.exit(1)
+
+def handle_sigterm():
+    # installed once by the main() of a script, signal handlers can only be
+    # set from the main thread
+    signal.signal(signal.SIGTERM,terminate)